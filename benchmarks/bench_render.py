@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for `AnalyticsWriter.render()` and `AnalyticsWriter.render_head()`
+
+usage:
+
+    python benchmarks/bench_render.py
+    python benchmarks/bench_render.py --output results.json
+    python benchmarks/bench_render.py --compare baseline.json --output results.json
+    python benchmarks/bench_render.py --filter gtag --number 500
+    python benchmarks/bench_render.py --json-encoder orjson
+
+Every case is a combination of a `mode` and a data `shape`. Each case reports:
+
+    ops_per_sec     renders per second; the best of `--repeat` timing runs
+    usec_per_op     the inverse of `ops_per_sec`, in microseconds
+    alloc_blocks    memory blocks allocated by a render and still held after it
+                    (the output, anything the writer cached, and blocks kept
+                    on the interpreter's free lists)
+    alloc_bytes     the size of `alloc_blocks`
+    peak_bytes      the peak traced memory above the baseline during a render
+
+The memory columns require `tracemalloc` (Python 3.4+); on Python 2 they are
+reported as `None`.
+
+The `--output` file is JSON, and is meant to be compared across runs with
+`--compare`. Timings are only comparable on the same machine.
+"""
+from __future__ import print_function
+
+# stdlib
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# allow running from a checkout without installing
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(_HERE), "src"))
+
+# local
+import g_analytics_writer  # noqa: E402
+from g_analytics_writer import AnalyticsMode  # noqa: E402
+from g_analytics_writer import AnalyticsWriter  # noqa: E402
+from g_analytics_writer import WriterConfig  # noqa: E402
+from g_analytics_writer import get_json_encoder  # noqa: E402
+
+
+# ==============================================================================
+
+
+# bump this if the structure of the output file changes
+FORMAT_VERSION = 1
+
+ACCOUNT_ID = "UA-123123-1"
+
+# name: (mode, config kwargs)
+MODES = (
+    ("ga_js", (AnalyticsMode.GA_JS, {"single_push": False})),
+    ("ga_js-single_push", (AnalyticsMode.GA_JS, {"single_push": True})),
+    ("analytics", (AnalyticsMode.ANALYTICS, {})),
+    ("gtag", (AnalyticsMode.GTAG, {})),
+    ("amp", (AnalyticsMode.AMP, {})),
+)
+
+
+def shape__pageview(writer):
+    pass
+
+
+def shape__dimensions_20(writer):
+    for idx in range(1, 21):
+        writer.set_custom_dimension(idx, "name_%s" % idx, "value_%s" % idx)
+
+
+def shape__events_100(writer):
+    for idx in range(100):
+        writer.track_event(
+            {
+                "*category": "category_%s" % (idx % 10),
+                "*action": "action_%s" % idx,
+                "*label": "label",
+                "*value": idx,
+                "*non_interaction": bool(idx % 2),
+            }
+        )
+
+
+def shape__transaction_500(writer):
+    writer.add_transaction(
+        {
+            "*id": 1234,
+            "*affiliation": "benchmark",
+            "*total": "50000.00",
+            "*revenue": "50000.00",
+            "*tax": "10.00",
+            "*shipping": "5.00",
+            "*city": "brooklyn",
+            "*state": "new york",
+            "*country": "usa",
+        }
+    )
+    for idx in range(500):
+        writer.add_transaction_item(
+            {
+                "*transaction_id": 1234,
+                "*name": "Item %s" % idx,
+                "*sku": "SKU-%s" % idx,
+                "*category": u"Greeñ",
+                "*price": "100.00",
+                "*quantity": "1",
+            }
+        )
+
+
+def shape__accounts_5(writer):
+    for idx in range(2, 6):
+        writer.set_account_additional__add("UA-123123-%s" % idx)
+    shape__dimensions_20(writer)
+    for idx in range(10):
+        writer.track_event(
+            {"*category": "category", "*action": "action_%s" % idx, "*value": idx}
+        )
+
+
+# name: populating callable
+SHAPES = (
+    ("pageview", shape__pageview),
+    ("dimensions_20", shape__dimensions_20),
+    ("events_100", shape__events_100),
+    ("transaction_500", shape__transaction_500),
+    ("accounts_5", shape__accounts_5),
+)
+
+
+# ==============================================================================
+
+
+def render_uncached(writer):
+    """
+    returns a callable which renders `writer`. A writer keeps its last render
+    until its data is changed, so the data is marked as changed before each
+    render; otherwise only the first render would be measured.
+    """
+
+    def _render():
+        writer._touch()
+        return writer.render()
+
+    return _render
+
+
+def build_cases(name_filter=None, json_encoder="stdlib"):
+    """
+    returns a list of `(name, writer, callable)`
+    """
+    json_dumps_callable = get_json_encoder(json_encoder)
+    cases = []
+    for (mode_name, (mode, config_kwargs)) in MODES:
+        config = WriterConfig(
+            mode=mode, json_dumps_callable=json_dumps_callable, **config_kwargs
+        )
+        writer = AnalyticsWriter(ACCOUNT_ID, config=config)
+        cases.append(("%s/render_head" % mode_name, writer, writer.render_head))
+        for (shape_name, populate) in SHAPES:
+            writer = AnalyticsWriter(ACCOUNT_ID, config=config)
+            populate(writer)
+            cases.append(
+                ("%s/%s" % (mode_name, shape_name), writer, render_uncached(writer))
+            )
+    if name_filter:
+        cases = [c for c in cases if name_filter in c[0]]
+    return cases
+
+
+def measure_memory(func):
+    """
+    returns `(alloc_blocks, alloc_bytes, peak_bytes)` for a single call
+    """
+    if tracemalloc is None:
+        return (None, None, None)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        (baseline, _peak) = tracemalloc.get_traced_memory()
+        result = func()  # noqa: F841; the result is held for the snapshot
+        (_current, peak) = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    # ignore the bookkeeping of this module and of `tracemalloc` itself
+    filters = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    )
+    stats = after.filter_traces(filters).compare_to(
+        before.filter_traces(filters), "filename"
+    )
+    alloc_blocks = sum(s.count_diff for s in stats)
+    alloc_bytes = sum(s.size_diff for s in stats)
+    return (alloc_blocks, alloc_bytes, peak - baseline)
+
+
+def run_case(func, number, repeat):
+    # warm up; the first render builds the shared `RenderPlan`
+    func()
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    best = min(timings) / number
+    (alloc_blocks, alloc_bytes, peak_bytes) = measure_memory(func)
+    return {
+        "ops_per_sec": round(1.0 / best, 1),
+        "usec_per_op": round(best * 1000000, 3),
+        "alloc_blocks": alloc_blocks,
+        "alloc_bytes": alloc_bytes,
+        "peak_bytes": peak_bytes,
+        "output_length": len(func()),
+    }
+
+
+def run(number=1000, repeat=5, name_filter=None, json_encoder="stdlib", verbose=True):
+    results = {}
+    for (name, writer, func) in build_cases(
+        name_filter=name_filter, json_encoder=json_encoder
+    ):
+        results[name] = run_case(func, number, repeat)
+        if verbose:
+            print(format_row(name, results[name]))
+    return {
+        "format_version": FORMAT_VERSION,
+        "meta": {
+            "g_analytics_writer": g_analytics_writer.__VERSION__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "number": number,
+            "repeat": repeat,
+            "json_encoder": json_encoder,
+        },
+        "results": results,
+    }
+
+
+# ==============================================================================
+
+
+_ROW = "%-32s %12s %12s %12s %12s %12s"
+
+
+def format_header():
+    return _ROW % (
+        "case",
+        "ops/sec",
+        "usec/op",
+        "alloc_blocks",
+        "alloc_bytes",
+        "peak_bytes",
+    )
+
+
+def format_row(name, result):
+    return _ROW % (
+        name,
+        result["ops_per_sec"],
+        result["usec_per_op"],
+        result["alloc_blocks"],
+        result["alloc_bytes"],
+        result["peak_bytes"],
+    )
+
+
+def compare(baseline, current):
+    """
+    returns a list of lines describing the change of every case in `current`
+    from `baseline`. ops/sec is reported as a percentage; positive is faster.
+    """
+    lines = [
+        "%-32s %12s %12s %12s" % ("case", "ops/sec", "alloc_bytes", "peak_bytes")
+    ]
+    for (name, result) in sorted(current["results"].items()):
+        base = baseline["results"].get(name)
+        if base is None:
+            lines.append("%-32s %12s" % (name, "new"))
+            continue
+        ops = "%+.1f%%" % (
+            (result["ops_per_sec"] - base["ops_per_sec"]) * 100.0 / base["ops_per_sec"]
+        )
+        deltas = []
+        for key in ("alloc_bytes", "peak_bytes"):
+            if result[key] is None or base[key] is None:
+                deltas.append("-")
+            else:
+                deltas.append("%+d" % (result[key] - base[key]))
+        lines.append("%-32s %12s %12s %12s" % (name, ops, deltas[0], deltas[1]))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--number", type=int, default=1000, help="renders per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per case")
+    parser.add_argument("--filter", default=None, help="only run matching cases")
+    parser.add_argument(
+        "--json-encoder",
+        default="stdlib",
+        help="a `get_json_encoder` backend: stdlib, orjson or auto",
+    )
+    parser.add_argument("--output", default=None, help="write results as JSON")
+    parser.add_argument("--compare", default=None, help="compare to a JSON result")
+    options = parser.parse_args(argv)
+
+    print(format_header())
+    results = run(
+        number=options.number,
+        repeat=options.repeat,
+        name_filter=options.filter,
+        json_encoder=options.json_encoder,
+    )
+    if options.output:
+        with open(options.output, "w") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as fh:
+            baseline = json.load(fh)
+        if baseline.get("format_version") != FORMAT_VERSION:
+            print("`%s` uses an incompatible format" % options.compare)
+            return 1
+        print("")
+        print("\n".join(compare(baseline, results)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
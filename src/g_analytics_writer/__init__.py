@@ -1,4 +1,36 @@
+from collections import namedtuple
+from collections import OrderedDict
+from decimal import Decimal
+from itertools import chain
 from json import dumps as _json_dumps
+import threading
+import time
+from types import GeneratorType
+
+try:
+    from collections.abc import Mapping
+    from collections.abc import MutableMapping
+except ImportError:
+    # Python2
+    from collections import Mapping
+    from collections import MutableMapping
+
+try:
+    _monotonic = time.monotonic
+except AttributeError:
+    # Python2
+    _monotonic = time.time
+
+try:
+    _perf_counter = time.perf_counter
+except AttributeError:
+    # Python2
+    _perf_counter = time.time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # logging
@@ -28,6 +60,14 @@ their Creative Commons Attribution 3.0 License
 PREFIXLEN_dimension = len("dimension")
 PREFIXLEN_metric = len("metric")
 
+# Google's collectors reject hits over 8192 bytes. `gtag.js` purchases are
+# split into several calls to keep their JSON under this size, which leaves
+# room for the parameters `gtag.js` adds to the hit (client id, page, etc).
+GTAG_PURCHASE_MAX_BYTES = 6144
+
+# stands in for the items of a `gtag.js` purchase, which are encoded apart
+_GTAG_ITEMS_PLACEHOLDER = "__g_analytics_writer__items__"
+
 
 def json_dumps(data):
     """
@@ -42,6 +82,45 @@ def json_dumps(data):
     return _json_dumps(data, separators=(",", ":"))
 
 
+def json_dumps__orjson(data):
+    """
+    a `json_dumps_callable` backed by `orjson`, which must be installed.
+
+    `orjson` is considerably faster than the stdlib. Its output is compact, like
+    `json_dumps`, but non-ASCII characters are written as UTF-8 instead of
+    being escaped. Data `orjson` can not encode, such as integers larger than
+    64 bits, is encoded by `json_dumps` instead.
+    """
+    try:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        # `orjson.JSONEncodeError` is a `TypeError`
+        return json_dumps(data)
+
+
+# the `json_dumps_callable` backends that may be selected by name
+JSON_ENCODERS = {"stdlib": json_dumps}
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = json_dumps__orjson
+
+
+def get_json_encoder(name="auto"):
+    """
+    returns the `json_dumps_callable` for the encoder backend `name`:
+
+        "stdlib" - `json_dumps`
+        "orjson" - `json_dumps__orjson`; requires `orjson`
+        "auto" - `orjson` if it is installed, otherwise `stdlib`
+
+    raises a `ValueError` if the backend is unknown or not installed.
+    """
+    if name == "auto":
+        name = "orjson" if "orjson" in JSON_ENCODERS else "stdlib"
+    if name not in JSON_ENCODERS:
+        raise ValueError("invalid or unavailable json encoder: %s" % name)
+    return JSON_ENCODERS[name]
+
+
 def generate_tracker_name(secondary_account):
     """
     this is used by `ga.js` and `analytics.js` to generate unique tracker names
@@ -252,42 +331,119 @@ field_requirements = {
 }
 
 
+def compile_translation_matrix(matrix):
+    """
+    flattens a `translation_matrix` into a dict of lookup tables, keyed by
+    `(api_concept, api_mode)`. each table maps a `local_key` to its `api_key`;
+    keys which are not used by an `api_mode` (`None`) are omitted.
+    """
+    tables = {}
+    for (api_concept, local_keys) in matrix.items():
+        for (local_key, api_modes) in local_keys.items():
+            for (api_mode, api_key) in api_modes.items():
+                table = tables.setdefault((api_concept, api_mode), {})
+                if api_key is not None:
+                    table[local_key] = api_key
+    return tables
+
+
+# compiled once, at import.
+# if `translation_matrix` is altered, this must be recompiled
+translation_tables = compile_translation_matrix(translation_matrix)
+
+
 def source_dict_to_api_dict(source_dict, api_concept, api_mode):
-    output = {}
-    for local_key, value in source_dict.items():
-        try:
-            api_key = translation_matrix[api_concept][local_key][api_mode]
-            if api_key is not None:
-                output[api_key] = value
-        except KeyError:
-            pass
-    return output
+    table = translation_tables.get((api_concept, api_mode))
+    if not table:
+        return {}
+    return {table[k]: v for (k, v) in source_dict.items() if k in table}
+
+
+def compile_field_requirements(requirements):
+    """
+    compiles `field_requirements` into a dict of validators, keyed by
+    `api_concept`. each validator is a tuple of `(api_mode, required)` pairs,
+    in which `required` is a frozenset of the fields the mode requires.
+    """
+    validators = {}
+    for (api_concept, api_modes) in requirements.items():
+        validators[api_concept] = tuple(
+            (api_mode, frozenset(_reqs["required"]))
+            for (api_mode, _reqs) in sorted(api_modes.items())
+        )
+    return validators
+
+
+# compiled once, at import.
+# if `field_requirements` is altered, this must be recompiled
+field_validators = compile_field_requirements(field_requirements)
+
+
+def source_dict_api_modes(source_dict, api_concept):
+    """
+    returns a frozenset of the `api_mode`s for which `source_dict` has every
+    required field of `api_concept`. a field is missing if its value is `None`.
+    """
+    present = {k for (k, v) in source_dict.items() if v is not None}
+    return frozenset(
+        api_mode
+        for (api_mode, required) in field_validators[api_concept]
+        if required <= present
+    )
+
+
+# javascript formatters for the values of ordered args, by type.
+# any other type is rendered as a quoted string.
+_JS_ARG_FORMATTERS = {
+    int: str,
+    float: str,
+    bool: lambda v: "true" if v else "false",
+}
+
+
+def encode_ordered_args(records, args_order, remove_undefined=None):
+    """
+    encodes a batch of `records` into javascript arguments, for apis such as
+    `ga.js` which expect positional arguments.
+
+    args:
+        records = an iterable of objects with a dict-like `get`, such as source
+                  dicts or `Event`s
+        args_order = the keys of the arguments, in order
+        remove_undefined = if ``True``, trailing `undefined` args are removed
+    returns:
+        a list with one list of formatted arguments per record.
+        `None` is rendered as `undefined`, the javascript keyword.
+    """
+    _formatter_get = _JS_ARG_FORMATTERS.get
+    rval = []
+    for record in records:
+        _get = record.get
+        args = []
+        # the length of `args`, up to the last defined value
+        _defined = 0
+        for _field in args_order:
+            _value = _get(_field)
+            if _value is None:
+                args.append("undefined")
+                continue
+            _formatter = _formatter_get(type(_value))
+            if _formatter is None:
+                args.append("'%s'" % _value)
+            else:
+                args.append(_formatter(_value))
+            _defined = len(args)
+        if remove_undefined:
+            del args[_defined:]
+        rval.append(args)
+    return rval
 
 
 def source_dict_to_ordered_args(source_dict, args_order, remove_undefined=None):
-    item_args = []
-    for _field in args_order:
-        _value = source_dict.get(_field, None)
-        if _value is None:
-            _value = "undefined"  # it's undefined(js) keyword
-        elif type(_value) in (int, float):
-            _value = "%s" % _value  # turn it into a string
-        elif type(_value) is bool:
-            _value = ("%s" % _value).lower()  # turn it into a string
-        else:
-            _value = "'%s'" % _value  # pop it in a quote
-        item_args.append(_value)
-    if remove_undefined:
-        _max_defined = None
-        for _idx, _value in enumerate(item_args):
-            if _value != "undefined":
-                _max_defined = _idx
-        if _max_defined is not None:
-            item_args = item_args[: (_max_defined + 1)]
-        else:
-            # TODO: log/error
-            item_args = []
-    return item_args
+    """
+    encodes a single `source_dict`; see `encode_ordered_args`
+    """
+    return encode_ordered_args((source_dict,), args_order, remove_undefined)[0]
 
 
 class InvalidTag(Exception):
@@ -306,26 +462,286 @@ INVALID_TAG = InvalidTag()
 # ==============================================================================
 
 
-class AnalyticsWriter(object):
-    data_struct = None
-    mode = AnalyticsMode._default
-    use_comments = True
-    single_push = False
-    force_ssl = None
-    global_custom_data = True
-    gtag_dimensions_strategy = GtagDimensionsStrategy.SET_CONFIG
-    amp_clientid_integration = None
-    _json_dumps = None
+class RenderCache(object):
+    """
+    A bounded, thread-safe, LRU cache of rendered output.
 
-    # for convenience, makes these classes available on the instances of ``AnalyticsWriter``
-    # this allows for usage like this:
-    # ``request.g_analytics_writer.render(mode=request.g_analytics_writer.AnalyticsMode.AMP)``
-    AnalyticsMode = AnalyticsMode
-    GtagDimensionsStrategy = GtagDimensionsStrategy
+    Writers opt in with `WriterConfig(render_cache=...)`. Renders are keyed by
+    the writer's configuration, account, mode and a fingerprint of its data,
+    so writers with identical data (e.g. anonymous visitors of a landing page)
+    share a single render.
 
-    def __init__(
-        self,
-        account_id,
+    args/kwargs:
+        max_size = the maximum number of renders to keep. when full, the least
+                   recently used render is evicted.
+        ttl = seconds a render is kept for; `None` keeps it until evicted.
+
+    The counters `hits`, `misses`, `evictions` (by size) and `expirations` (by
+    ttl) are available via `stats()`.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        if max_size < 1:
+            raise ValueError("invalid max_size")
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        returns the render cached for `key`, or `None`
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if (entry[0] is not None) and (entry[0] < _monotonic()):
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # re-inserting marks this key as the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, rendered):
+        expires = (_monotonic() + self.ttl) if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, rendered)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        removes every render; the counters are not reset
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# the per-process cache used by `WriterConfig(render_cache=True)`
+default_render_cache = RenderCache()
+
+
+# the names of the modes, as used by `MetricsRegistry.render_prometheus`
+_mode_names = {
+    AnalyticsMode.GA_JS: "ga_js",
+    AnalyticsMode.ANALYTICS: "analytics",
+    AnalyticsMode.GTAG: "gtag",
+    AnalyticsMode.AMP: "amp",
+}
+
+
+class MetricsRegistry(object):
+    """
+    A thread-safe, in-process registry of counters and latency histograms.
+
+    Writers opt in with `WriterConfig(metrics=...)`. The registry counts, by
+    mode:
+
+        writers_created, writers_rendered, writers_discarded
+        events_recorded, transactions_recorded, items_recorded
+        invalid_tags = invalid transactions, items and events rendered
+        renders, render_bytes
+
+    and records the `render_seconds` of every render in a histogram.
+    Renders are reported through the writer's `instrumentation`, which
+    defaults to the registry itself; a registry may be called with the
+    report of any instrumented render.
+
+    args/kwargs:
+        buckets = the upper bounds of the histogram buckets, in seconds
+
+    `collect()` returns a snapshot for a metrics scraper, and
+    `render_prometheus()` renders one in the Prometheus text format.
+    """
+
+    default_buckets = (
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+    )
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self._lock = threading.Lock()
+        self._counters = {}  # by `(name, mode)`
+        self._histograms = {}  # by `(name, mode)`: [bucket counts, sum, count]
+
+    def increment(self, name, mode=None, value=1):
+        key = (name, mode)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, mode=None):
+        key = (name, mode)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0]
+            for (idx, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][idx] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def __call__(self, report):
+        """
+        records the report of a render; see `AnalyticsWriter.render`
+        """
+        mode = report["mode"]
+        self.increment("renders", mode)
+        self.increment("render_bytes", mode, report["bytes"])
+        if report["invalid"]:
+            self.increment("invalid_tags", mode, report["invalid"])
+        self.observe("render_seconds", report["duration"], mode)
+
+    def collect(self):
+        """
+        returns a snapshot of the registry:
+
+            {"counters": {name: {mode: value}},
+             "histograms": {name: {mode: {"buckets": [(bound, cumulative count)],
+                                          "sum": seconds,
+                                          "count": observations}}}}
+
+        the last bucket of a histogram has the bound `inf`.
+        """
+        with self._lock:
+            counters = {}
+            for ((name, mode), value) in self._counters.items():
+                counters.setdefault(name, {})[mode] = value
+            histograms = {}
+            for ((name, mode), (counts, total, count)) in self._histograms.items():
+                buckets = []
+                cumulative = 0
+                for (bound, bucket_count) in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    buckets.append((bound, cumulative))
+                buckets.append((float("inf"), count))
+                histograms.setdefault(name, {})[mode] = {
+                    "buckets": buckets,
+                    "sum": total,
+                    "count": count,
+                }
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self, prefix="g_analytics_writer_"):
+        """
+        returns the `collect()` snapshot in the Prometheus text format
+        """
+        snapshot = self.collect()
+        lines = []
+        for name in sorted(snapshot["counters"]):
+            lines.append("# TYPE %s%s counter" % (prefix, name))
+            for (mode, value) in sorted(snapshot["counters"][name].items()):
+                lines.append(
+                    '%s%s{mode="%s"} %s' % (prefix, name, _mode_names.get(mode), value)
+                )
+        for name in sorted(snapshot["histograms"]):
+            lines.append("# TYPE %s%s histogram" % (prefix, name))
+            for (mode, histogram) in sorted(snapshot["histograms"][name].items()):
+                label = _mode_names.get(mode)
+                for (bound, count) in histogram["buckets"]:
+                    lines.append(
+                        '%s%s_bucket{mode="%s",le="%s"} %s'
+                        % (
+                            prefix,
+                            name,
+                            label,
+                            "+Inf" if bound == float("inf") else repr(bound),
+                            count,
+                        )
+                    )
+                lines.append(
+                    '%s%s_sum{mode="%s"} %r' % (prefix, name, label, histogram["sum"])
+                )
+                lines.append(
+                    '%s%s_count{mode="%s"} %s'
+                    % (prefix, name, label, histogram["count"])
+                )
+        return "".join("%s\n" % line for line in lines)
+
+    def reset(self):
+        """
+        resets every counter and histogram
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+# the per-process registry used by `WriterConfig(metrics=True)`
+default_metrics = MetricsRegistry()
+
+
+_WriterConfig = namedtuple(
+    "WriterConfig",
+    (
+        "mode",
+        "use_comments",
+        "single_push",
+        "force_ssl",
+        "global_custom_data",
+        "gtag_dimensions_strategy",
+        "amp_clientid_integration",
+        "json_dumps_callable",
+        "render_cache",
+        "instrumentation",
+        "metrics",
+        "columnar_items",
+    ),
+)
+
+
+class WriterConfig(_WriterConfig):
+    """
+    An immutable, pre-validated configuration for `AnalyticsWriter` objects.
+
+    A `WriterConfig` is meant to be built once, at application setup, and
+    shared by every writer (and thread) of an application:
+
+        config = WriterConfig(mode=AnalyticsMode.GTAG, use_comments=False)
+        writer = AnalyticsWriter("UA-123123-1", config=config)
+
+    The kwargs are identical to those of `AnalyticsWriter.__init__`, which
+    documents them.
+
+    Use `replace` to derive a new configuration.
+    """
+
+    __slots__ = ()
+
+    def __new__(
+        cls,
         mode=AnalyticsMode._default,
         use_comments=True,
         single_push=False,
@@ -334,194 +750,1177 @@ class AnalyticsWriter(object):
         gtag_dimensions_strategy=GtagDimensionsStrategy.SET_CONFIG,
         amp_clientid_integration=None,
         json_dumps_callable=json_dumps,
+        render_cache=None,
+        instrumentation=None,
+        metrics=None,
+        columnar_items=False,
     ):
-        """
-        Sets up self.data_struct dict which we use for storage.
+        if mode not in AnalyticsMode._valid_modes:
+            raise ValueError("invalid mode")
+        if gtag_dimensions_strategy not in GtagDimensionsStrategy._valid:
+            raise ValueError("invalid gtag_dimensions_strategy")
+        if not callable(json_dumps_callable):
+            raise ValueError("invalid json_dumps_callable")
+        if (render_cache is None) or (render_cache is False):
+            render_cache = None
+        elif render_cache is True:
+            render_cache = default_render_cache
+        elif not isinstance(render_cache, RenderCache):
+            raise ValueError("invalid render_cache")
+        if (instrumentation is not None) and not callable(instrumentation):
+            raise ValueError("invalid instrumentation")
+        if (metrics is None) or (metrics is False):
+            metrics = None
+        elif metrics is True:
+            metrics = default_metrics
+        elif not isinstance(metrics, MetricsRegistry):
+            raise ValueError("invalid metrics")
+        if (metrics is not None) and (instrumentation is None):
+            # the registry records the reports of renders
+            instrumentation = metrics
+        return _WriterConfig.__new__(
+            cls,
+            mode,
+            use_comments,
+            single_push,
+            force_ssl,
+            global_custom_data,
+            gtag_dimensions_strategy,
+            amp_clientid_integration,
+            json_dumps_callable,
+            render_cache,
+            instrumentation,
+            metrics,
+            columnar_items,
+        )
 
-        You'd probably have something like this in your pyramid app:
+    def replace(self, **kwargs):
+        """
+        returns a new, validated, `WriterConfig` with the kwargs replaced
+        """
+        _kwargs = self._asdict()
+        if (self.metrics is not None) and (self.instrumentation is self.metrics):
+            # the default `instrumentation` follows `metrics`
+            _kwargs["instrumentation"] = None
+        _kwargs.update(kwargs)
+        return self.__class__(**_kwargs)
 
-            config.include('g_analytics_writer.pyramid_integration')
 
-        That will mount a custom configured ``AnalyticsWriter`` object on the
-        Pyramid ``request`` as `request.g_analytics_writer`
+# the defaults are used for class-level access on `AnalyticsWriter`
+_default_config = WriterConfig()
 
-        args-
-            :account_id
-                STRING
-                The Google Analytics account id.
-                example: UA-123123123-1
-        kwargs-
-            :mode
-                INT
-                default: `AnalyticsMode._default` == `analytics.js`
-                The INT from the ``AnalyticsMode`` class specifiying the
-                output type.
-                This can not be changed after instantiation, because it is used
-                by some helper functions.
-            :use_comments
-                BOOLEAN
-                default: True
-                If ``True``, this package will generate the leading/trailing
-                HTML comments that surround the HTML block. Disabling this can
-                optimize HTML size.
-            :single_push
-                BOOLEAN
-                default: False
-                If ``True``, this package will output the entirety of a `ga.js`
-                command in a single 'push'. Enabling this can
-                optimize HTML size and Javascript execution.
-            :force_ssl
-                BOOLEAN
-                default: None
-                If ``True``, this package will instruct google_analytics to
-                force a html connection on http connections.
-            :global_custom_data
-                BOOLEAN
-                default: True
-                If ``True``, will register the custom metrics/data for all page hits.
-                This is only supported on `analytics.js`; `gtag.js` does not seem to have an option
-            :amp_clientid_integration
-                BOOLEAN
-                default: None
-                If ``True``, will handle client_id integration for amp pages.
-                see https://support.google.com/analytics/answer/7486764
-                This requires two parts:
-                1. opt in on AMP pages, by adding to <HEAD>
-                    <meta name="amp-google-client-id-api" content="googleanalytics">
-                2. opt in on non-AMP pages, by adding to:
-                    analytics.js
-                        ga('create', 'UA-XXXXX-Y', 'auto', {'useAmpClientId': true});
-                    gtag.js
-                        gtag('config', 'UA-XXXXX-Y', {'use_amp_client_id': true});
-                3. set up referral exclusion on `cdn.ampproject.org` and subdomains if needed.
-            :json_dumps_callable
-                CALLABLE
-                default: ``g_analytics_writer.json_dumps```
-                This callable is used to dump dicts into json.  It may need to
-                be overridden to support your preferred encoding. See the
-                `json_dumps` function for detailed documentation.
-        """
-        if mode not in AnalyticsMode._valid_modes:
-            raise ValueError("invalid mode")
-        self.mode = mode
-        self.use_comments = use_comments
-        self.single_push = single_push
-        self.amp_clientid_integration = amp_clientid_integration
-        self._json_dumps = json_dumps_callable
-
-        # `ga.js` allows a force of ssl
-        # https://developers.google.com/analytics/devguides/collection/gajs/#ssl
-        self.force_ssl = force_ssl
-
-        self.global_custom_data = global_custom_data  # this is public!
-        self.gtag_dimensions_strategy = gtag_dimensions_strategy
-
-        self.data_struct = {
-            "*account_id": account_id,
-            "*additional_accounts": [],
-            "*tracked_events": [],
-            "*custom_dimensions": {},
-            "*custom_metrics": {},
-            "*transaction": {},  # dict of k/v by transactionId
-            "*transaction_items": {},  # dict of k:LIST by transactionId
-            "*crossdomain_tracking": None,
-            "*user_id": None,
-        }
 
-    def set_account(self, account_id):
-        """This should really never be called, best to setup during __init__, where it is required"""
-        self.data_struct["*account_id"] = account_id
+class _ConfigOption(object):
+    """
+    Exposes a `WriterConfig` field as an attribute of `AnalyticsWriter`.
 
-    def set_account_additional__add(self, account_id):
-        """add an additional account id to send the data to.  please note - this is only tested to work with the async method."""
-        if account_id not in self.data_struct["*additional_accounts"]:
-            self.data_struct["*additional_accounts"].append(account_id)
+    Setting the attribute on a writer will replace the writer's config with a
+    derived `WriterConfig`, so the shared config object is never mutated.
+    """
 
-    def set_account_additional__del(self, account_id):
-        self.data_struct["*additional_accounts"] = [
-            i for i in self.data_struct["*additional_accounts"] if i != account_id
-        ]
+    def __init__(self, field):
+        self.field = field
 
-    def track_event(self, track_dict):
-        """
-        The tracking dict should be in this format:
-            {'*category': the category
-             '*action': the action
-            }
-        Notice the leading asterisk `*` on certain keys. An asterisk is the
-        prefix for identifying `g_analytics_writer` native commands. These keys
-        will be mapped onto relevant Google Analytics fields upon rendering.
+    def __get__(self, instance, owner):
+        if instance is None:
+            return getattr(_default_config, self.field)
+        return getattr(instance._config, self.field)
 
-        Keys without an prefixed asterisk will be interpreted as extra data to
-        be submitted by fieldobjects or other methods.
+    def __set__(self, instance, value):
+        instance._config = instance._config.replace(**{self.field: value})
 
-        =========================================================================
-        Chart of translated items
-        *** note: items in this chart with a leading `{` are fieldObject keys ***
-        *** note: other items are args ***
-        =========================================================================
-        native           | `ga.js`            | `analytics.js`  | `gtag.js`
-        -----------------+--------------------+-----------------+-----------------
-        *action          | action             | {eventAction    | action/"event name"
-        *category        | category           | {eventCategory  | {event_category
-        *label           | opt_label          | {eventLabel     | {event_label
-        *value           | opt_value          | {eventValue     | {value
-        *non_interaction | opt_noninteraction | {nonInteraction | {non_interaction
-        -----------------+--------------------+-----------------+-----------------
-        `non_interaction` must be a boolean.
-        other values will be rendered as-is.
-        - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-        Platform Version Notes:
 
-        gtag.js:
-        --------
-            * `category` is OPTIONAL
-            * each default `action` has a default `category`
-            * each default `action` *might* have a default `label`
-            * custom events (`action`) have a default `category` of 'engagement'
-              and a default `label` of 'not set'.
+class Event(Mapping):
+    """
+    A tracked event.
 
-        ========================================================================
+    `AnalyticsWriter.track_event` accepts either an `Event` or a dict of the
+    native `*category`, `*action`, `*label`, `*value` and `*non_interaction`
+    keys; dicts are converted into an `Event` when they are tracked.
 
-        Google Documentation
-        --------------------
+    Events are validated and normalized once, when they are created, so they
+    should be treated as immutable.
 
-        gtag.js
-        -------
-        Docs:   https://developers.google.com/analytics/devguides/collection/gtagjs/events#send_events
+    Keys without a leading asterisk are kept in `extra`.
 
-        Example:
-            gtag('event', <action>, {
-              'event_category': <category>,
-              'event_label': <label>,
-              'value': <value>
-            });
-            gtag('event', 'video_auto_play_start', {
-              'event_label': 'My promotional video',
-              'event_category': 'video_auto_play',
-              'non_interaction': true
-            });
+    An `Event` can be read like the dict it was created from (via the
+    `Mapping` interface), and compares equal to that dict.
+    """
 
-        Fields Reference:
-            `<action>` is the string that will appear as the event action in Google Analytics Event reports.
-            `<category>` is the string that will appear as the event category.
-            `<label>` is the string that will appear as the event label.
-            `<value>` is a non-negative integer that will appear as the event value.
+    __slots__ = (
+        "category",
+        "action",
+        "label",
+        "value",
+        "non_interaction",
+        "extra",
+        "has_action",  # required by `gtag.js`
+        "has_category_action",  # required by `ga.js` and `analytics.js`
+        "_api_dicts",
+    )
 
-        g_analytics_writer notes:
-            * only `action` is required
-            * user timings have also shifted:
-                https://developers.google.com/analytics/devguides/collection/gtagjs/migration
-                `analytics.js`  | `gtag.js`
-                ----------------+--------
-                timingValue     | value
-                timingVar       | name
+    _native_keys = ("*category", "*action", "*label", "*value", "*non_interaction")
 
-        analytics.js
-        ------------
-        Docs:   https://developers.google.com/analytics/devguides/collection/analyticsjs/events#implementation
+    def __init__(
+        self,
+        category=None,
+        action=None,
+        label=None,
+        value=None,
+        non_interaction=None,
+        extra=None,
+    ):
+        self.category = category
+        self.action = action
+        self.label = label
+        self.value = value
+        self.non_interaction = non_interaction
+        self.extra = extra
+        self.has_action = bool(action)
+        self.has_category_action = bool(category and action)
+        self._api_dicts = None
+
+    @classmethod
+    def from_dict(cls, track_dict):
+        """creates an `Event` from a `track_event` style dict"""
+        extra = None
+        for _key in track_dict:
+            if _key not in cls._native_keys:
+                if extra is None:
+                    extra = {}
+                extra[_key] = track_dict[_key]
+        _get = track_dict.get
+        return cls(
+            category=_get("*category"),
+            action=_get("*action"),
+            label=_get("*label"),
+            value=_get("*value"),
+            non_interaction=_get("*non_interaction"),
+            extra=extra,
+        )
 
-        Example:
+    def as_dict(self):
+        """returns the `track_event` style dict for this `Event`"""
+        rval = {}
+        for _key in self._native_keys:
+            _value = getattr(self, _key[1:])
+            if _value is not None:
+                rval[_key] = _value
+        if self.extra:
+            rval.update(self.extra)
+        return rval
+
+    def get(self, key, default=None):
+        """dict-style access to the `track_event` style keys"""
+        if key in self._native_keys:
+            _value = getattr(self, key[1:])
+            return default if _value is None else _value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __getitem__(self, key):
+        if key in self._native_keys:
+            _value = getattr(self, key[1:])
+            if _value is not None:
+                return _value
+        elif self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.as_dict())
+
+    def __len__(self):
+        return len(self.as_dict())
+
+    def api_dict(self, api_mode):
+        """
+        returns the fields of this event that are set, translated to the api
+        fields of `api_mode` via the compiled `translation_matrix`.
+        the result is cached; do not mutate it.
+        """
+        if self._api_dicts is None:
+            self._api_dicts = {}
+        elif api_mode in self._api_dicts:
+            return self._api_dicts[api_mode]
+        rval = {}
+        _table = translation_tables.get(("*event", api_mode), {})
+        for (_key, _api_key) in _table.items():
+            _value = getattr(self, _key[1:])
+            if _value is not None:
+                rval[_api_key] = _value
+        self._api_dicts[api_mode] = rval
+        return rval
+
+    def __eq__(self, other):
+        if isinstance(other, Mapping):
+            return self.as_dict() == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, Mapping):
+            return self.as_dict() != dict(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def fingerprint(self):
+        """
+        returns a hashable representation of this event; see `fingerprint`
+        """
+        return (
+            Event,
+            self.category,
+            self.action,
+            self.label,
+            fingerprint(self.value),
+            fingerprint(self.non_interaction),
+            fingerprint(self.extra),
+        )
+
+    def __repr__(self):
+        return "<Event %r>" % self.as_dict()
+
+
+# marks the fields an item of `ItemColumns` does not have
+_MISSING = object()
+
+
+class ItemColumns(object):
+    """
+    Columnar storage for the items of a transaction.
+
+    Writers opt in with `WriterConfig(columnar_items=True)`. Instead of a list
+    of dicts, each field is stored as one list of values, so an item costs a
+    slot per field rather than a dict. Items are validated and translated
+    column by column when rendered.
+
+    `ItemColumns` behaves as a read-only sequence of item dicts; the dicts
+    are built when accessed, so altering them does not alter the storage.
+    """
+
+    __slots__ = ("columns", "_length")
+
+    def __init__(self, item_dicts=()):
+        self.columns = OrderedDict()  # a list of values, by field
+        self._length = 0
+        self.extend(item_dicts)
+
+    def __len__(self):
+        return self._length
+
+    def append(self, item_dict):
+        columns = self.columns
+        for key in item_dict:
+            if key not in columns:
+                columns[key] = [_MISSING] * self._length
+        _get = item_dict.get
+        for (key, column) in columns.items():
+            column.append(_get(key, _MISSING))
+        self._length += 1
+
+    def extend(self, item_dicts):
+        for item_dict in item_dicts:
+            self.append(item_dict)
+
+    def _rows(self, columns):
+        """yields a dict per item, of the `(key, column)` pairs in `columns`"""
+        if not columns:
+            for _idx in range(self._length):
+                yield {}
+            return
+        keys = tuple(k for (k, _column) in columns)
+        for values in zip(*(column for (_k, column) in columns)):
+            yield {k: v for (k, v) in zip(keys, values) if v is not _MISSING}
+
+    def __iter__(self):
+        return self._rows(list(self.columns.items()))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return list(self)[idx]
+        if idx < 0:
+            idx += self._length
+        if not 0 <= idx < self._length:
+            raise IndexError(idx)
+        return {
+            k: column[idx]
+            for (k, column) in self.columns.items()
+            if column[idx] is not _MISSING
+        }
+
+    def api_dicts(self, api_concept, api_mode):
+        """
+        yields `source_dict_to_api_dict` of each item, translating the
+        fields once per column instead of once per item
+        """
+        table = translation_tables.get((api_concept, api_mode)) or {}
+        return self._rows(
+            [(table[k], column) for (k, column) in self.columns.items() if k in table]
+        )
+
+    def api_modes(self, api_concept, start=0):
+        """
+        returns a list of `source_dict_api_modes` of the items from `start`,
+        checking the required fields column by column
+        """
+        count = self._length - start
+        valid = []
+        for (api_mode, required) in field_validators[api_concept]:
+            present = [True] * count
+            for field in required:
+                column = self.columns.get(field)
+                if column is None:
+                    present = [False] * count
+                    break
+                present = [
+                    p and (v is not None) and (v is not _MISSING)
+                    for (p, v) in zip(present, column[start:])
+                ]
+            valid.append((api_mode, present))
+        # most items share the same few sets of modes
+        modes = {}
+        rval = []
+        for flags in zip(*(present for (_api_mode, present) in valid)):
+            _modes = modes.get(flags)
+            if _modes is None:
+                _modes = modes[flags] = frozenset(
+                    api_mode for ((api_mode, _p), f) in zip(valid, flags) if f
+                )
+            rval.append(_modes)
+        return rval
+
+    def fingerprint(self):
+        """
+        returns a hashable representation of the items; see `fingerprint`
+        """
+        return (ItemColumns,) + tuple(
+            (k, tuple(fingerprint(v) for v in column))
+            for (k, column) in self.columns.items()
+        )
+
+    def __repr__(self):
+        return "<ItemColumns %r>" % list(self)
+
+
+def iter_api_dicts(source_dicts, api_concept, api_mode):
+    """
+    yields `source_dict_to_api_dict` of each of `source_dicts`; an
+    `ItemColumns` is translated column by column
+    """
+    if isinstance(source_dicts, ItemColumns):
+        return source_dicts.api_dicts(api_concept, api_mode)
+    return (source_dict_to_api_dict(d, api_concept, api_mode) for d in source_dicts)
+
+
+class WriterData(object):
+    """
+    Compact storage for the data recorded on an `AnalyticsWriter`.
+
+    The fields mirror the historical `data_struct` keys, without the leading
+    asterisk (`*tracked_events` is stored as `tracked_events`).
+    """
+
+    __slots__ = (
+        "additional_accounts",
+        "tracked_events",
+        "custom_dimensions",
+        "custom_metrics",
+        "transaction",  # dict of k/v by transactionId
+        "transaction_items",  # dict of k:LIST (or `ItemColumns`) by transactionId
+        "crossdomain_tracking",
+        "user_id",
+        "_transaction_modes",  # cached `source_dict_api_modes` by transactionId
+        "_transaction_item_modes",  # as above; a LIST parallel to the items
+        "_version",  # incremented on every change
+        "_exposed",  # the fields handed out by `data_struct`, or `None`
+    )
+
+    def __init__(self):
+        self.additional_accounts = []
+        self.tracked_events = []
+        self.custom_dimensions = {}
+        self.custom_metrics = {}
+        self.transaction = {}
+        self.transaction_items = {}
+        self.crossdomain_tracking = None
+        self.user_id = None
+        self._transaction_modes = {}
+        self._transaction_item_modes = {}
+        self._version = 0
+        self._exposed = None
+
+    def touch(self):
+        """
+        records that the data has (or may have) been changed, which
+        invalidates the last renders of the writer.
+        """
+        self._version += 1
+
+    def transaction_api_modes(self, transaction_id):
+        """
+        returns the `api_mode`s a transaction is valid for; this is computed
+        once per transaction, then cached.
+        """
+        modes = self._transaction_modes.get(transaction_id)
+        if modes is None:
+            modes = self._transaction_modes[transaction_id] = source_dict_api_modes(
+                self.transaction[transaction_id], "*transaction"
+            )
+        return modes
+
+    def transaction_item_api_modes(self, transaction_id):
+        """
+        returns a list of the `api_mode`s each item of a transaction is valid
+        for, in the order of `transaction_items[transaction_id]`; this is
+        computed once per item, then cached.
+        """
+        items = self.transaction_items[transaction_id]
+        modes = self._transaction_item_modes.setdefault(transaction_id, [])
+        if len(modes) < len(items):
+            if isinstance(items, ItemColumns):
+                modes.extend(items.api_modes("*transaction_item", start=len(modes)))
+            else:
+                modes.extend(
+                    source_dict_api_modes(_item, "*transaction_item")
+                    for _item in items[len(modes) :]
+                )
+        return modes
+
+    def clear_api_modes(self):
+        """
+        resets the cached validation of transactions and their items
+        """
+        self._transaction_modes = {}
+        self._transaction_item_modes = {}
+
+    def expose(self, field):
+        """
+        records that `field` was handed out by `data_struct`, so it may be
+        altered in place at any time
+        """
+        if self._exposed is None:
+            self._exposed = set()
+        self._exposed.add(field)
+
+    def refresh(self):
+        """
+        prepares the fields handed out by `data_struct` for a render: they are
+        assumed to have changed, so transactions and items are validated
+        again, and `track_event` style dicts appended to `tracked_events` are
+        converted into `Event`s.
+        """
+        exposed = self._exposed
+        if not exposed:
+            return
+        self.touch()
+        if ("transaction" in exposed) or ("transaction_items" in exposed):
+            self.clear_api_modes()
+        if "tracked_events" in exposed:
+            events = self.tracked_events
+            for (idx, event) in enumerate(events):
+                if not isinstance(event, Event):
+                    events[idx] = Event.from_dict(event)
+
+
+# shared by renders of writers without data; this must never be mutated.
+_empty_data = WriterData()
+
+# the fields of `WriterData` that affect a render
+_WriterData_fields = tuple(k for k in WriterData.__slots__ if k[0] != "_")
+
+
+def fingerprint(value):
+    """
+    returns a hashable representation of `value`, which is used to key the
+    `RenderCache`. Containers are converted into tuples, and numbers are
+    tagged with their type, as `True`, `1`, `1.0` and `Decimal("1.00")` are
+    equal but render differently; a `Decimal` is kept as its `str`. Values
+    which can not be hashed are left as-is; the caller must handle the
+    `TypeError` raised when the result is hashed.
+    """
+    _type = type(value)
+    if _type is dict:
+        return (dict,) + tuple((k, fingerprint(v)) for (k, v) in value.items())
+    if (_type is list) or (_type is tuple):
+        return tuple(fingerprint(v) for v in value)
+    if (_type is bool) or (_type is int) or (_type is float):
+        return (_type, value)
+    if _type is Decimal:
+        return (_type, str(value))
+    if (_type is Event) or (_type is ItemColumns):
+        return value.fingerprint()
+    return value
+
+
+class DataStructView(MutableMapping):
+    """
+    A dict-like view of an `AnalyticsWriter`'s data, offered for compatibility
+    with code written against the historical `data_struct` dict.
+
+    Reading any key will allocate the writer's `WriterData` storage.
+    Keys can not be added or removed.
+    """
+
+    __slots__ = ("_writer",)
+
+    _keys = ("*account_id",) + tuple(
+        "*%s" % k for k in WriterData.__slots__ if k[0] != "_"
+    )
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def __getitem__(self, key):
+        if key == "*account_id":
+            return self._writer._account_id
+        if key not in self._keys:
+            raise KeyError(key)
+        # the value is mutable, so it is assumed to change
+        data = self._writer._touch()
+        if key != "*user_id":
+            data.expose(key[1:])
+        return getattr(data, key[1:])
+
+    def __setitem__(self, key, value):
+        if key == "*account_id":
+            self._writer._account_id = value
+            return
+        if key not in self._keys:
+            raise KeyError(key)
+        data = self._writer._touch()
+        setattr(data, key[1:], value)
+        if key != "*user_id":
+            # the caller may keep a reference to the value
+            data.expose(key[1:])
+        if key in ("*transaction", "*transaction_items"):
+            data.clear_api_modes()
+
+    def __delitem__(self, key):
+        raise TypeError("`data_struct` keys can not be removed")
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+# the optional positional args of an event, which follow category and action
+_EVENT_ARGS_OPTIONAL__GA_JS = ("*label", "*value", "*non_interaction")
+_EVENT_ARGS_OPTIONAL__ANALYTICS = ("*label", "*value")
+
+_BOOTSTRAP__GA_JS = u"""\
+(function() {
+var ga = document.createElement('script'); ga.type = 'text/javascript'; ga.async = true;
+ga.src = ('https:' == document.location.protocol ? 'https://ssl': 'http://www') + '.google-analytics.com/ga.js';
+var s = document.getElementsByTagName('script')[0]; s.parentNode.insertBefore(ga, s);
+})();"""
+
+_BOOTSTRAP__ANALYTICS = u"""\
+(function(i,s,o,g,r,a,m){i['GoogleAnalyticsObject']=r;i[r]=i[r]||function(){
+(i[r].q=i[r].q||[]).push(arguments)},i[r].l=1*new Date();a=s.createElement(o),
+m=s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m)
+})(window,document,'script','https://www.google-analytics.com/analytics.js','ga');"""
+
+_BOOTSTRAP__GTAG = u"""\
+<script async src="https://www.googletagmanager.com/gtag/js?id=%(account_id)s"></script>
+<script>
+  window.dataLayer = window.dataLayer || [];
+  function gtag(){dataLayer.push(arguments);}
+  gtag('js', new Date());
+"""
+
+_HEAD__AMP = u"""<script async custom-element="amp-analytics" src="https://cdn.ampproject.org/v0/amp-analytics-0.1.js"></script>"""
+_HEAD__AMP_CLIENTID = u"""<meta name="amp-google-client-id-api" content="googleanalytics">"""
+
+
+class RenderPlan(object):
+    """
+    A `RenderPlan` holds every fragment of a render that is derived only from
+    the writer's `WriterConfig`, the primary account and the output mode.
+
+    Plans are built once by `get_render_plan` and shared by every writer with
+    the same configuration, so a render only needs to generate the fragments
+    for the data recorded on the writer (events, dimensions, transactions...).
+
+    Plans must be treated as read-only, with the exception of `empty_html`,
+    which is populated by the first render of a writer without any data.
+    """
+
+    __slots__ = (
+        "mode",
+        "account_id",
+        "head",  # tuple of lines preceding the dynamic content
+        "tail",  # tuple of lines following the dynamic content
+        "gajs_push",  # `ga.js` - format string for a single command
+        "gajs_push_open",  # `ga.js` - precedes the tracker prefix of a command
+        "gajs_push_close",  # `ga.js` - closes a command
+        "gajs_force_ssl",  # `ga.js` - formatted `_forceSSL` command, or None
+        "create_args",  # `analytics.js`/`gtag.js` - static create/config args
+        "create_line",  # `analytics.js`/`gtag.js` - create/config if no args
+        "create_args_json",  # `analytics.js`/`gtag.js` - serialized create_args
+        "gtag_set_before_config",  # `gtag.js` - custom data strategy
+        "gtag_set_after_config",  # `gtag.js` - custom data strategy
+        "gtag_event_pageview",  # `gtag.js` - custom data strategy
+        "gtag_send_page_view",  # `gtag.js` - custom data strategy
+        "head_html",  # output of `render_head`
+        "empty_html",  # output of `render` for a writer without data
+    )
+
+    def __init__(self, config, account_id, mode):
+        use_comments = config.use_comments
+        single_push = config.single_push
+        force_ssl = config.force_ssl
+        global_custom_data = config.global_custom_data
+        gtag_dimensions_strategy = config.gtag_dimensions_strategy
+        amp_clientid_integration = config.amp_clientid_integration
+        json_dumps_callable = config.json_dumps_callable
+
+        self.mode = mode
+        self.account_id = account_id
+        self.gajs_push = None
+        self.gajs_push_open = None
+        self.gajs_push_close = None
+        self.gajs_force_ssl = None
+        self.create_args = None
+        self.create_line = None
+        self.create_args_json = None
+        self.gtag_set_before_config = False
+        self.gtag_set_after_config = False
+        self.gtag_event_pageview = False
+        self.gtag_send_page_view = True
+        self.head_html = ""
+        self.empty_html = None
+
+        head = []
+        tail = []
+        if mode == AnalyticsMode.GA_JS:
+            if use_comments:
+                head.append(u"""<!-- Google Analytics -->""")
+            head.append(u"""<script type="text/javascript">""")
+            head.append(u"""var _gaq = _gaq || [];""")
+            if single_push:
+                head.append(u"""_gaq.push(""")
+                tail.append(u""");""")
+                self.gajs_push = u"""%s"""
+                self.gajs_push_open = u"""['"""
+                self.gajs_push_close = u""""""
+            else:
+                self.gajs_push = u"""_gaq.push(%s);"""
+                self.gajs_push_open = u"""_gaq.push(['"""
+                self.gajs_push_close = u""");"""
+            if force_ssl is True:
+                # `ga.js` allows a force of ssl
+                # https://developers.google.com/analytics/devguides/collection/gajs/#ssl
+                self.gajs_force_ssl = self.gajs_push % u"""['_gat._forceSSL']"""
+            tail.append(_BOOTSTRAP__GA_JS)
+            tail.append(u"""</script>""")
+            if use_comments:
+                tail.append(u"""<!-- End Google Analytics -->""")
+
+        elif mode == AnalyticsMode.ANALYTICS:
+            if use_comments:
+                head.append(u"""<!-- Google Analytics -->""")
+            head.append(u"""<script type="text/javascript">""")
+            head.append(_BOOTSTRAP__ANALYTICS)
+            create_args = {}
+            if amp_clientid_integration:
+                create_args["useAmpClientId"] = True
+            self.create_args = create_args
+            if create_args:
+                self.create_args_json = json_dumps_callable(create_args)
+                self.create_line = u"""ga('create','%s','auto',%s);""" % (
+                    account_id,
+                    self.create_args_json,
+                )
+            else:
+                self.create_line = u"""ga('create','%s','auto');""" % account_id
+            tail.append(u"""</script>""")
+            if use_comments:
+                tail.append(u"""<!-- End Google Analytics -->""")
+
+        elif mode == AnalyticsMode.GTAG:
+            if use_comments:
+                head.append(
+                    u"""<!-- Global site tag (gtag.js) - Google Analytics -->"""
+                )
+            head.append(_BOOTSTRAP__GTAG % {"account_id": account_id})
+            create_args = {}
+            if amp_clientid_integration:
+                create_args["use_amp_client_id"] = True
+            self.create_args = create_args
+            if create_args:
+                self.create_args_json = json_dumps_callable(create_args)
+                self.create_line = u"""gtag('config','%s',%s);""" % (
+                    account_id,
+                    self.create_args_json,
+                )
+            else:
+                self.create_line = u"""gtag('config','%s');""" % account_id
+            if gtag_dimensions_strategy == GtagDimensionsStrategy.SET_CONFIG:
+                if global_custom_data:
+                    self.gtag_set_before_config = True
+                else:
+                    self.gtag_event_pageview = True
+            elif (
+                gtag_dimensions_strategy
+                == GtagDimensionsStrategy.CONFIGNOPAGEVIEW_SET_EVENT
+            ):
+                self.gtag_send_page_view = False
+                if global_custom_data:
+                    self.gtag_set_after_config = True
+                else:
+                    self.gtag_event_pageview = True
+            tail.append(u"""</script>""")
+            if use_comments:
+                tail.append(u"""<!-- End Google Analytics -->""")
+
+        elif mode == AnalyticsMode.AMP:
+            if use_comments:
+                head.append(u"""<!-- Google Analytics -->""")
+            head.append(u"""<amp-analytics type="googleanalytics">""")
+            head.append(u"""<script type="application/json">""")
+            tail.append(u"""</script>""")
+            tail.append(u"""</amp-analytics>""")
+            if use_comments:
+                tail.append(u"""<!-- End Google Analytics -->""")
+            if amp_clientid_integration:
+                self.head_html = u"""%s\n%s""" % (_HEAD__AMP_CLIENTID, _HEAD__AMP)
+            else:
+                self.head_html = _HEAD__AMP
+
+        self.head = tuple(head)
+        self.tail = tuple(tail)
+
+
+def _iter_fragments(lines):
+    """
+    joins the `lines` of a render with line breaks, as a generator
+    """
+    lines = iter(lines)
+    for line in lines:
+        yield line
+        break
+    for line in lines:
+        yield u"""\n""" + line
+
+
+# plans are cached by their configuration tuple
+# if an application generates many account_ids, the cache is simply reset
+_render_plans = {}
+_render_plans__max = 256
+
+
+def get_render_plan(config, account_id, mode):
+    """
+    returns the shared `RenderPlan` for a `WriterConfig`, primary account and
+    output mode; building it if needed
+    """
+    key = (config, account_id, mode)
+    plan = _render_plans.get(key)
+    if plan is None:
+        plan = RenderPlan(*key)
+        if len(_render_plans) >= _render_plans__max:
+            _render_plans.clear()
+        _render_plans[key] = plan
+    return plan
+
+
+class _SectionTimer(object):
+    """
+    times the sections of an instrumented render.
+
+    Each section builder is run, and its output materialized, by `run`; the
+    time spent in sections nested within it (e.g. the items of a transaction)
+    is charged to those sections instead.
+    """
+
+    __slots__ = ("sections", "_nested")
+
+    def __init__(self):
+        self.sections = {}
+        self._nested = [0]
+
+    def run(self, section, builder, *args):
+        self._nested.append(0)
+        start = _perf_counter()
+        try:
+            result = builder(*args)
+            if isinstance(result, GeneratorType):
+                result = list(result)
+        finally:
+            elapsed = _perf_counter() - start
+            nested = self._nested.pop()
+            self._nested[-1] += elapsed
+            self.sections[section] = self.sections.get(section, 0) + elapsed - nested
+        return result
+
+
+def _pack_by_size(sizes, capacity):
+    """
+    packs the items of `sizes` into as few bins of `capacity` as it can, using
+    first-fit decreasing. an item larger than `capacity` gets its own bin.
+
+    returns a list of bins, each a list of indexes into `sizes`; the bins and
+    their indexes are in the order of `sizes`.
+    """
+    bins = []  # [free space, indexes]
+    for idx in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        size = sizes[idx]
+        for _bin in bins:
+            if _bin[0] >= size:
+                _bin[0] -= size
+                _bin[1].append(idx)
+                break
+        else:
+            bins.append([capacity - size, [idx]])
+    return sorted(sorted(_bin[1]) for _bin in bins)
+
+
+# ==============================================================================
+
+
+class AnalyticsWriter(object):
+    _data = None
+    _account_id = None
+    _config = _default_config
+    _rendered = False
+    _renders = None  # the last render, by `plan`
+    _timer = None  # the `_SectionTimer` of an instrumented render
+
+    # configuration options are stored on the (shared) `WriterConfig`
+    mode = _ConfigOption("mode")
+    use_comments = _ConfigOption("use_comments")
+    single_push = _ConfigOption("single_push")
+    force_ssl = _ConfigOption("force_ssl")
+    global_custom_data = _ConfigOption("global_custom_data")
+    gtag_dimensions_strategy = _ConfigOption("gtag_dimensions_strategy")
+    amp_clientid_integration = _ConfigOption("amp_clientid_integration")
+    _json_dumps = _ConfigOption("json_dumps_callable")
+
+    # for convenience, makes these classes available on the instances of ``AnalyticsWriter``
+    # this allows for usage like this:
+    # ``request.g_analytics_writer.render(mode=request.g_analytics_writer.AnalyticsMode.AMP)``
+    AnalyticsMode = AnalyticsMode
+    GtagDimensionsStrategy = GtagDimensionsStrategy
+
+    def __init__(
+        self,
+        account_id,
+        mode=AnalyticsMode._default,
+        use_comments=True,
+        single_push=False,
+        force_ssl=None,
+        global_custom_data=True,
+        gtag_dimensions_strategy=GtagDimensionsStrategy.SET_CONFIG,
+        amp_clientid_integration=None,
+        json_dumps_callable=json_dumps,
+        render_cache=None,
+        instrumentation=None,
+        metrics=None,
+        columnar_items=False,
+        config=None,
+    ):
+        """
+        Sets up the writer. The `WriterData` object which we use for storage
+        is only allocated once data is recorded.
+
+        You'd probably have something like this in your pyramid app:
+
+            config.include('g_analytics_writer.pyramid_integration')
+
+        That will mount a custom configured ``AnalyticsWriter`` object on the
+        Pyramid ``request`` as `request.g_analytics_writer`
+
+        args-
+            :account_id
+                STRING
+                The Google Analytics account id.
+                example: UA-123123123-1
+        kwargs-
+            :mode
+                INT
+                default: `AnalyticsMode._default` == `analytics.js`
+                The INT from the ``AnalyticsMode`` class specifiying the
+                output type.
+                This can not be changed after instantiation, because it is used
+                by some helper functions.
+            :use_comments
+                BOOLEAN
+                default: True
+                If ``True``, this package will generate the leading/trailing
+                HTML comments that surround the HTML block. Disabling this can
+                optimize HTML size.
+            :single_push
+                BOOLEAN
+                default: False
+                If ``True``, this package will output the entirety of a `ga.js`
+                command in a single 'push'. Enabling this can
+                optimize HTML size and Javascript execution.
+            :force_ssl
+                BOOLEAN
+                default: None
+                If ``True``, this package will instruct google_analytics to
+                force a html connection on http connections.
+            :global_custom_data
+                BOOLEAN
+                default: True
+                If ``True``, will register the custom metrics/data for all page hits.
+                This is only supported on `analytics.js`; `gtag.js` does not seem to have an option
+            :amp_clientid_integration
+                BOOLEAN
+                default: None
+                If ``True``, will handle client_id integration for amp pages.
+                see https://support.google.com/analytics/answer/7486764
+                This requires two parts:
+                1. opt in on AMP pages, by adding to <HEAD>
+                    <meta name="amp-google-client-id-api" content="googleanalytics">
+                2. opt in on non-AMP pages, by adding to:
+                    analytics.js
+                        ga('create', 'UA-XXXXX-Y', 'auto', {'useAmpClientId': true});
+                    gtag.js
+                        gtag('config', 'UA-XXXXX-Y', {'use_amp_client_id': true});
+                3. set up referral exclusion on `cdn.ampproject.org` and subdomains if needed.
+            :json_dumps_callable
+                CALLABLE
+                default: ``g_analytics_writer.json_dumps```
+                This callable is used to dump dicts into json.  It may need to
+                be overridden to support your preferred encoding. See the
+                `json_dumps` function for detailed documentation.
+                `get_json_encoder` returns a faster backend, such as `orjson`,
+                if one is installed.
+            :render_cache
+                ``RenderCache`` or BOOLEAN
+                default: None
+                If provided, renders are memoized in this ``RenderCache``,
+                keyed by the configuration and a fingerprint of the recorded
+                data. ``True`` uses the per-process `default_render_cache`.
+            :instrumentation
+                CALLABLE
+                default: None
+                If provided, every render calls `instrumentation(report)` with
+                a dict of its timings by section, its size and the number of
+                records rendered. `render` documents the report.
+            :metrics
+                ``MetricsRegistry`` or BOOLEAN
+                default: None
+                If provided, writers, recorded data and renders are counted in
+                this ``MetricsRegistry``. ``True`` uses the per-process
+                `default_metrics`. Unless `instrumentation` is provided, the
+                registry also receives the report of every render.
+            :columnar_items
+                BOOLEAN
+                default: False
+                If ``True``, the items of each transaction are stored in an
+                ``ItemColumns``, one list per field, instead of a list of
+                dicts. This saves memory for very large transactions.
+            :config
+                ``WriterConfig``
+                default: None
+                A pre-validated, shared, ``WriterConfig``.  If provided, the
+                other kwargs are ignored.  This is the fastest way to create
+                writers, as no validation is needed.
+        """
+        if config is None:
+            # `ga.js` allows a force of ssl
+            # https://developers.google.com/analytics/devguides/collection/gajs/#ssl
+            config = WriterConfig(
+                mode=mode,
+                use_comments=use_comments,
+                single_push=single_push,
+                force_ssl=force_ssl,
+                global_custom_data=global_custom_data,  # this is public!
+                gtag_dimensions_strategy=gtag_dimensions_strategy,
+                amp_clientid_integration=amp_clientid_integration,
+                json_dumps_callable=json_dumps_callable,
+                render_cache=render_cache,
+                instrumentation=instrumentation,
+                metrics=metrics,
+                columnar_items=columnar_items,
+            )
+        self._config = config
+        self._account_id = account_id
+        if config.metrics is not None:
+            config.metrics.increment("writers_created", config.mode)
+
+    @property
+    def config(self):
+        """the ``WriterConfig`` for this writer"""
+        return self._config
+
+    @property
+    def data_struct(self):
+        """
+        A dict-like view of the recorded data, keyed by the historical
+        `data_struct` keys (e.g. `*tracked_events`).
+        This is only offered for compatibility; the data is stored on a
+        `WriterData` object.
+        """
+        return DataStructView(self)
+
+    def _get_data(self):
+        """
+        returns the `WriterData` storage, allocating it on first use.
+        writers that never record any data never allocate storage.
+        """
+        data = self._data
+        if data is None:
+            data = self._data = WriterData()
+        return data
+
+    def _touch(self):
+        """
+        returns the `WriterData` storage, after recording that it will be
+        changed.
+        """
+        data = self._get_data()
+        data.touch()
+        return data
+
+    def _get_data_render(self):
+        """
+        returns the `WriterData` storage for a render, without allocating it.
+        """
+        data = self._data
+        if data is None:
+            return _empty_data
+        return data
+
+    def _refresh_data(self):
+        """
+        called before a render; see `WriterData.refresh`
+        """
+        data = self._data
+        if data is not None:
+            data.refresh()
+
+    @property
+    def account_id(self):
+        """the primary account id"""
+        return self._account_id
+
+    @property
+    def has_data(self):
+        """``True`` if any data which affects a render has been recorded"""
+        return not self._is_pageview_only()
+
+    @property
+    def rendered(self):
+        """``True`` if `render` has been called on this writer"""
+        return self._rendered
+
+    def discard(self):
+        """
+        Drops all recorded data (the primary account is kept).
+        This is used for writers which will never be rendered; writers which
+        were not rendered are counted as discarded by the config's `metrics`.
+        """
+        self._data = None
+        self._renders = None
+        if (self._config.metrics is not None) and not self._rendered:
+            self._config.metrics.increment("writers_discarded", self._config.mode)
+
+    def set_account(self, account_id):
+        """This should really never be called, best to setup during __init__, where it is required"""
+        self._account_id = account_id
+
+    def set_account_additional__add(self, account_id):
+        """add an additional account id to send the data to.  please note - this is only tested to work with the async method."""
+        data = self._touch()
+        if account_id not in data.additional_accounts:
+            data.additional_accounts.append(account_id)
+
+    def set_account_additional__del(self, account_id):
+        data = self._touch()
+        data.additional_accounts = [
+            i for i in data.additional_accounts if i != account_id
+        ]
+
+    def track_event(self, track_dict):
+        """
+        The tracking dict should be in this format:
+            {'*category': the category
+             '*action': the action
+            }
+        Notice the leading asterisk `*` on certain keys. An asterisk is the
+        prefix for identifying `g_analytics_writer` native commands. These keys
+        will be mapped onto relevant Google Analytics fields upon rendering.
+
+        Keys without an prefixed asterisk will be interpreted as extra data to
+        be submitted by fieldobjects or other methods.
+
+        An `Event` may be passed in instead of a dict. Dicts are converted to
+        an `Event` - which is validated and normalized once - when tracked.
+
+        =========================================================================
+        Chart of translated items
+        *** note: items in this chart with a leading `{` are fieldObject keys ***
+        *** note: other items are args ***
+        =========================================================================
+        native           | `ga.js`            | `analytics.js`  | `gtag.js`
+        -----------------+--------------------+-----------------+-----------------
+        *action          | action             | {eventAction    | action/"event name"
+        *category        | category           | {eventCategory  | {event_category
+        *label           | opt_label          | {eventLabel     | {event_label
+        *value           | opt_value          | {eventValue     | {value
+        *non_interaction | opt_noninteraction | {nonInteraction | {non_interaction
+        -----------------+--------------------+-----------------+-----------------
+        `non_interaction` must be a boolean.
+        other values will be rendered as-is.
+        - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        Platform Version Notes:
+
+        gtag.js:
+        --------
+            * `category` is OPTIONAL
+            * each default `action` has a default `category`
+            * each default `action` *might* have a default `label`
+            * custom events (`action`) have a default `category` of 'engagement'
+              and a default `label` of 'not set'.
+
+        ========================================================================
+
+        Google Documentation
+        --------------------
+
+        gtag.js
+        -------
+        Docs:   https://developers.google.com/analytics/devguides/collection/gtagjs/events#send_events
+
+        Example:
+            gtag('event', <action>, {
+              'event_category': <category>,
+              'event_label': <label>,
+              'value': <value>
+            });
+            gtag('event', 'video_auto_play_start', {
+              'event_label': 'My promotional video',
+              'event_category': 'video_auto_play',
+              'non_interaction': true
+            });
+
+        Fields Reference:
+            `<action>` is the string that will appear as the event action in Google Analytics Event reports.
+            `<category>` is the string that will appear as the event category.
+            `<label>` is the string that will appear as the event label.
+            `<value>` is a non-negative integer that will appear as the event value.
+
+        g_analytics_writer notes:
+            * only `action` is required
+            * user timings have also shifted:
+                https://developers.google.com/analytics/devguides/collection/gtagjs/migration
+                `analytics.js`  | `gtag.js`
+                ----------------+--------
+                timingValue     | value
+                timingVar       | name
+
+        analytics.js
+        ------------
+        Docs:   https://developers.google.com/analytics/devguides/collection/analyticsjs/events#implementation
+
+        Example:
             ga('send', 'event', [eventCategory], [eventAction], [eventLabel], [eventValue], [fieldsObject]);
             ga('send', 'event', {
               'eventCategory': 'Category',
@@ -551,7 +1950,29 @@ class AnalyticsWriter(object):
             `opt_value`           Int     An optional value associated with the event. You can see your event values in the Overview, Categories, and Actions reports, where they are listed by event or aggregated across events, depending upon your report view.
             `opt_noninteraction`  Boolean Default value is false. By default, the event hit sent by _trackEvent() will impact a visitor's bounce rate. By setting this parameter to true, this event hit will not be used in bounce rate calculations.
         """
-        self.data_struct["*tracked_events"].append(track_dict)
+        if not isinstance(track_dict, Event):
+            track_dict = Event.from_dict(track_dict)
+        self._touch().tracked_events.append(track_dict)
+        if self._config.metrics is not None:
+            self._config.metrics.increment("events_recorded", self._config.mode)
+
+    def track_events(self, track_dicts):
+        """
+        tracks an iterable (or generator) of events, as `track_event` would.
+
+        The whole batch is converted to `Event` objects before any of it is
+        recorded.
+        """
+        events = [
+            t if isinstance(t, Event) else Event.from_dict(t) for t in track_dicts
+        ]
+        if not events:
+            return
+        self._touch().tracked_events.extend(events)
+        if self._config.metrics is not None:
+            self._config.metrics.increment(
+                "events_recorded", self._config.mode, len(events)
+            )
 
     def set_custom_variable(self, index, name, value, opt_scope=None):
         """
@@ -655,7 +2076,28 @@ class AnalyticsWriter(object):
             if index.startswith("dimension"):
                 index = index[PREFIXLEN_dimension:]
 
-        self.data_struct["*custom_dimensions"][index] = (name, value, opt_scope)
+        self._touch().custom_dimensions[index] = (
+            name,
+            value,
+            opt_scope,
+        )
+
+    def set_custom_dimensions(self, dimensions):
+        """
+        sets an iterable (or generator) of custom dimensions, each a tuple of
+        `(index, name, value)` or `(index, name, value, opt_scope)`, as
+        `set_custom_dimension` would.
+        """
+        updates = {}
+        for dimension in dimensions:
+            (index, name, value) = dimension[:3]
+            opt_scope = dimension[3] if len(dimension) > 3 else None
+            if type(index) is not int:
+                if index.startswith("dimension"):
+                    index = index[PREFIXLEN_dimension:]
+            updates[index] = (name, value, opt_scope)
+        if updates:
+            self._touch().custom_dimensions.update(updates)
 
     def set_custom_metric(self, index, name, value):
         """
@@ -670,7 +2112,7 @@ class AnalyticsWriter(object):
         if type(index) is not int:
             if index.startswith("metric"):
                 index = index[PREFIXLEN_metric:]
-        self.data_struct["*custom_metrics"][index] = (name, value)
+        self._touch().custom_metrics[index] = (name, value)
 
     def set_crossdomain_tracking(
         self, domains, decorate_forms=None, accept_incoming=None
@@ -727,7 +2169,7 @@ class AnalyticsWriter(object):
         """
         if type(domains) not in (list, tuple):
             domains = [domains]
-        self.data_struct["*crossdomain_tracking"] = {
+        self._touch().crossdomain_tracking = {
             "domains": domains,
             "decorate_forms": decorate_forms,
             "accept_incoming": accept_incoming,
@@ -743,7 +2185,7 @@ class AnalyticsWriter(object):
         -----
         renders onclick
         """
-        if self.mode == AnalyticsMode.GA_JS:
+        if self._config.mode == AnalyticsMode.GA_JS:
             # should this compare to the domain?
             return '''onclick="_gaq.push(['_link','%s']); return false;"''' % link
         return ""
@@ -764,7 +2206,7 @@ class AnalyticsWriter(object):
         -----
         may not be supported
         """
-        self.data_struct["*user_id"] = user_id
+        self._touch().user_id = user_id
 
     def setrender_user_id(self, user_id):
         """
@@ -786,15 +2228,15 @@ class AnalyticsWriter(object):
             // Setting the userId doesn't send data to Google Analytics.
             // You must also use a pageview or event to send the data.
         """
-        self.data_struct["*user_id"] = user_id
-        if self.mode == AnalyticsMode.ANALYTICS:
+        self._touch().user_id = user_id
+        if self._config.mode == AnalyticsMode.ANALYTICS:
             payload = []
             payload.append("""ga('set','userId','%s');""" % user_id)
             payload.append(
                 """ga('send','event','authentication','user-id available');"""
             )
             for (secondary_account, account_id) in enumerate(
-                self.data_struct["*additional_accounts"]
+                self._get_data().additional_accounts
             ):
                 (secondary_account_name, tracker_prefix) = generate_tracker_name(
                     secondary_account
@@ -807,14 +2249,14 @@ class AnalyticsWriter(object):
                     % tracker_prefix
                 )
             return "\n".join(payload)
-        elif self.mode == AnalyticsMode.GTAG:
+        elif self._config.mode == AnalyticsMode.GTAG:
             # https://developers.google.com/analytics/devguides/collection/gtagjs/cookies-user-id
             payload = []
-            account_id = self.data_struct["*account_id"]
+            account_id = self.account_id
             payload.append(
                 """gtag('config', '%s', {'user_id': '%s'});""" % (account_id, user_id)
             )
-            for alt_account_id in self.data_struct["*additional_accounts"]:
+            for alt_account_id in self._get_data().additional_accounts:
                 payload.append(
                     """gtag('config', '%s', {'user_id': '%s'});"""
                     % (alt_account_id, user_id)
@@ -980,10 +2422,17 @@ class AnalyticsWriter(object):
         _transaction_id = track_dict.get("*id", "")
         if not _transaction_id:
             raise ValueError("missing `*id`")
+        # the writer keeps its own copy, so later changes to `track_dict` do
+        # not leak into a previous render
+        track_dict = dict(track_dict)
         if _transaction_id != str(_transaction_id):
             _transaction_id = str(_transaction_id)
             track_dict["*id"] = _transaction_id
-        self.data_struct["*transaction"][_transaction_id] = track_dict
+        data = self._touch()
+        data.transaction[_transaction_id] = track_dict
+        data._transaction_modes.pop(_transaction_id, None)
+        if self._config.metrics is not None:
+            self._config.metrics.increment("transactions_recorded", self._config.mode)
 
     def add_transaction_item(self, item_dict):
         """
@@ -1076,27 +2525,83 @@ class AnalyticsWriter(object):
             raise ValueError("missing `*transaction_id`")
         if _transaction_id != str(_transaction_id):
             _transaction_id = str(_transaction_id)
+            item_dict = dict(item_dict)
             item_dict["*transaction_id"] = _transaction_id
-        if _transaction_id not in self.data_struct["*transaction_items"]:
-            self.data_struct["*transaction_items"][_transaction_id] = []
-        self.data_struct["*transaction_items"][_transaction_id].append(item_dict)
+        elif not self._config.columnar_items:
+            # the writer keeps its own copy; `ItemColumns` copies the values
+            item_dict = dict(item_dict)
+        data = self._touch()
+        if _transaction_id not in data.transaction_items:
+            data.transaction_items[_transaction_id] = (
+                ItemColumns() if self._config.columnar_items else []
+            )
+        data.transaction_items[_transaction_id].append(item_dict)
+        if self._config.metrics is not None:
+            self._config.metrics.increment("items_recorded", self._config.mode)
+
+    def add_transaction_items(self, item_dicts):
+        """
+        adds an iterable (or generator) of items, as `add_transaction_item`
+        would.
+
+        The whole batch is checked before any of it is recorded; if one item
+        lacks a `*transaction_id`, none are added. Each distinct
+        `*transaction_id` is coerced to a string once. As with
+        `add_transaction_item`, the writer stores copies and the dicts passed
+        in are never altered.
+        """
+        columnar_items = self._config.columnar_items
+        batch = {}  # lists of items, by transaction_id
+        transaction_ids = {}  # coerced `*transaction_id`, by the original
+        count = 0
+        for item_dict in item_dicts:
+            _item_id = item_dict.get("*transaction_id", "")
+            if not _item_id:
+                raise ValueError("missing `*transaction_id`")
+            _transaction_id = transaction_ids.get(_item_id)
+            if _transaction_id is None:
+                _transaction_id = transaction_ids[_item_id] = str(_item_id)
+            if _transaction_id != _item_id:
+                item_dict = dict(item_dict)
+                item_dict["*transaction_id"] = _transaction_id
+            elif not columnar_items:
+                item_dict = dict(item_dict)
+            items = batch.get(_transaction_id)
+            if items is None:
+                items = batch[_transaction_id] = []
+            items.append(item_dict)
+            count += 1
+        if not count:
+            return
+        data = self._touch()
+        for (_transaction_id, items) in batch.items():
+            if _transaction_id in data.transaction_items:
+                data.transaction_items[_transaction_id].extend(items)
+            elif columnar_items:
+                data.transaction_items[_transaction_id] = ItemColumns(items)
+            else:
+                data.transaction_items[_transaction_id] = items
+        if self._config.metrics is not None:
+            self._config.metrics.increment("items_recorded", self._config.mode, count)
 
     # - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = -
     # Internal API render tools below
 
     def _render__ga_js__inner(
-        self, script, nested_script, account_id, secondary_account=False
+        self, plan, account_id, secondary_account=False, payload=None
     ):
         """
         this handles the inner render for `ga.js`
 
         args/kwargs:
-            script = array of script lines
-            nested_script = Array of single-push data
+            plan = the `RenderPlan` for this render
             account_id = current account_id, might be nested
             secondary_account = False or idx(0+).
-        returns:
-            tuple (script, nested_script)
+            payload = the commands of `_render__ga_js__payload`; this is
+                      computed once per render and shared by every account.
+        yields:
+            the commands for this account, which are nested inside a single
+            push if the writer is configured to do so
 
         according to GA docs, the order to submit via javascript is:
         * _setAccount
@@ -1168,29 +2673,41 @@ class AnalyticsWriter(object):
 
            Sends both the transaction and item data to the Google Analytics server. This method should be called after _trackPageview(), and used in conjunction with the _addItem() and addTrans() methods. It should be called after items and transaction elements have been set up.
         """
-        _single_push = self.single_push
+        if payload is None:
+            payload = self._render__ga_js__payload(plan)
         if secondary_account is False:
-            if self.force_ssl is True:
-                # `ga.js` allows a force of ssl
-                # https://developers.google.com/analytics/devguides/collection/gajs/#ssl
-                if _single_push:
-                    nested_script.append(u"""['_gat._forceSSL']""")
-                else:
-                    script.append(u"""_gaq.push(['_gat._forceSSL']);""")
+            # `ga.js` allows a force of ssl; the plan has this pre-formatted
+            if plan.gajs_force_ssl:
+                yield plan.gajs_force_ssl
 
         (secondary_account_name, tracker_prefix) = generate_tracker_name(
             secondary_account
         )
 
         # _setAccount
-        if _single_push:
-            nested_script.append(
-                u"""['%s_setAccount','%s']""" % (tracker_prefix, account_id)
-            )
-        else:
-            script.append(
-                u"""_gaq.push(['%s_setAccount','%s']);""" % (tracker_prefix, account_id)
-            )
+        yield plan.gajs_push % (
+            u"""['%s_setAccount','%s']""" % (tracker_prefix, account_id)
+        )
+
+        # everything else is stamped with the tracker_prefix
+        for (_head, _tail) in payload:
+            if _tail is None:
+                yield _head
+            else:
+                yield _head + tracker_prefix + _tail
+
+    def _render__ga_js__payload(self, plan):
+        """
+        builds the account-independent commands of a `ga.js` render, which
+        follow `_setAccount`.
+
+        yields `(head, tail)` tuples. A command is rendered for an account by
+        placing the account's tracker prefix between `head` and `tail`. If
+        `tail` is `None`, `head` is rendered as-is.
+        """
+        data = self._get_data_render()
+        _open = plan.gajs_push_open
+        _close = plan.gajs_push_close
 
         # crossdomain_tracking
         """
@@ -1257,53 +2774,22 @@ class AnalyticsWriter(object):
                     <a href="http://dogs.example-petstore.com/intro.html"
                        onclick="_gaq.push(['_link', 'http://dogs.example-petstore.com/intro.html']); return false;">
         """
-        if self.data_struct["*crossdomain_tracking"]:
+        if data.crossdomain_tracking:
             # this operates on the FIRST domain
-            if _single_push:
-                nested_script.append(
-                    u"""['%s_setDomainName','%s']"""
-                    % (
-                        tracker_prefix,
-                        self.data_struct["*crossdomain_tracking"]["domains"][0],
-                    )
-                )
-                nested_script.append(
-                    u"""['%s_setAllowLinker',true]""" % (tracker_prefix)
-                )
-            else:
-                script.append(
-                    u"""_gaq.push(['%s_setDomainName','%s']);"""
-                    % (
-                        tracker_prefix,
-                        self.data_struct["*crossdomain_tracking"]["domains"][0],
-                    )
-                )
-                script.append(
-                    u"""_gaq.push(['%s_setAllowLinker',true]);""" % tracker_prefix
-                )
+            yield (
+                _open,
+                u"""_setDomainName','%s']%s"""
+                % (data.crossdomain_tracking["domains"][0], _close),
+            )
+            yield (_open, u"""_setAllowLinker',true]%s""" % _close)
 
         # _setCustomVar is next
-        for index in sorted(self.data_struct["*custom_dimensions"].keys()):
-            # for `ga.js`:
-            # index == str(integer)
-            # _payload == (name, value, opt_scope)
-            _payload = self.data_struct["*custom_dimensions"][index]
-            if not _payload:
-                continue
-            _payload = (tracker_prefix, index, _payload[0], _payload[1], _payload[2])
-            if _payload[4]:
-                formatted = u"""['%s_setCustomVar',%s,'%s','%s',%s]""" % _payload
-            else:
-                formatted = u"""['%s_setCustomVar',%s,'%s','%s']""" % _payload[:4]
-            if _single_push:
-                nested_script.append(formatted)
-            else:
-                script.append(u"""_gaq.push(%s);""" % formatted)
+        for line in self._render_section(
+            "dimensions", self._render__ga_js__dimensions, plan
+        ):
+            yield line
 
-        if _single_push:
-            nested_script.append(u"""['%s_trackPageview']""" % tracker_prefix)
-        else:
-            script.append(u"""_gaq.push(['%s_trackPageview']);""" % tracker_prefix)
+        yield (_open, u"""_trackPageview']%s""" % _close)
 
         # according to GA docs, the order to submit via javascript is:
         # # _trackPageview
@@ -1312,229 +2798,201 @@ class AnalyticsWriter(object):
         # # _trackTrans
 
         # ecommerce
-        if self.data_struct["*transaction"]:
+        for line in self._render_section(
+            "transactions", self._render__ga_js__ecommerce, plan
+        ):
+            yield line
+
+        # events
+        for line in self._render_section("events", self._render__ga_js__events, plan):
+            yield line
+
+    def _render__ga_js__dimensions(self, plan):
+        """
+        yields the `(head, tail)` `_setCustomVar` commands of a `ga.js` render
+        """
+        data = self._get_data_render()
+        _open = plan.gajs_push_open
+        _close = plan.gajs_push_close
+        for index in sorted(data.custom_dimensions.keys()):
+            # for `ga.js`:
+            # index == str(integer)
+            # _payload == (name, value, opt_scope)
+            _payload = data.custom_dimensions[index]
+            if not _payload:
+                continue
+            _payload = (index, _payload[0], _payload[1], _payload[2], _close)
+            if _payload[3]:
+                formatted = u"""_setCustomVar',%s,'%s','%s',%s]%s""" % _payload
+            else:
+                formatted = u"""_setCustomVar',%s,'%s','%s']%s""" % (
+                    _payload[:3] + _payload[4:]
+                )
+            yield (_open, formatted)
+
+    def _render__ga_js__ecommerce(self, plan):
+        """
+        yields the `(head, tail)` ecommerce commands of a `ga.js` render
+        """
+        data = self._get_data_render()
+        _open = plan.gajs_push_open
+        _close = plan.gajs_push_close
+
+        # ecommerce
+        if data.transaction:
             # _addTrans(transactionId, affiliation, total, tax, shipping, city, state, country)
             # _addItem(transactionId, sku, name, category, price, quantity)
-            _txn_fields_required = field_requirements["*transaction"][
-                AnalyticsMode.GA_JS
-            ]["required"]
-            # _txn_fields_optional = field_requirements['*transaction'][AnalyticsMode.GA_JS]['optional']
-            _item_fields_required = field_requirements["*transaction_item"][
-                AnalyticsMode.GA_JS
-            ]["required"]
-            # _item_fields_optional = field_requirements['*transaction_item'][AnalyticsMode.GA_JS]['optional']
+            # records are validated against `field_requirements` once, then cached
 
             _txn_fields_order = field_requirements["*transaction"][AnalyticsMode.GA_JS][
                 "order"
             ]
-            _item_fields_order = field_requirements["*transaction_item"][
-                AnalyticsMode.GA_JS
-            ]["order"]
 
             # used to decide if we `send`
             _valid_transactions = False
-            for transaction_id in self.data_struct["*transaction"].keys():
-                _transaction_dict = self.data_struct["*transaction"][transaction_id]
-                try:
-                    for _field in _txn_fields_required:
-                        _value = _transaction_dict.get(_field, None)
-                        if _value is None:
-                            raise InvalidTag()
-                except Exception as e:
-                    _formatted = "/* invalid transaction */"
-                    if _single_push:
-                        nested_script.append(_formatted)
-                    else:
-                        script.append(u"""_gaq.push(%s);""" % _formatted)
+            for transaction_id in data.transaction.keys():
+                _transaction_dict = data.transaction[transaction_id]
+                if AnalyticsMode.GA_JS not in data.transaction_api_modes(
+                    transaction_id
+                ):
+                    yield (plan.gajs_push % "/* invalid transaction */", None)
                     continue
                 _transaction_args = source_dict_to_ordered_args(
                     _transaction_dict, _txn_fields_order, remove_undefined=True
                 )
-                _formatted = """['%(tracker_prefix)s_addTrans',%(joined_args)s]""" % {
-                    "tracker_prefix": tracker_prefix,
-                    "joined_args": ",".join(_transaction_args),
-                }
-                if _single_push:
-                    nested_script.append(_formatted)
-                else:
-                    script.append(u"""_gaq.push(%s);""" % _formatted)
+                yield (
+                    _open,
+                    u"""_addTrans',%s]%s""" % (",".join(_transaction_args), _close),
+                )
 
                 # enough to `send` !
                 _valid_transactions = True
 
-                if transaction_id in self.data_struct["*transaction_items"]:
-                    for _item_dict in self.data_struct["*transaction_items"][
-                        transaction_id
-                    ]:
-                        try:
-                            for _field in _item_fields_required:
-                                _value = _item_dict.get(_field, None)
-                                if _value is None:
-                                    raise InvalidTag()
-                        except Exception:
-                            _formatted = "/* invalid transaction item */"
-                            if _single_push:
-                                nested_script.append(_formatted)
-                            else:
-                                script.append(u"""_gaq.push(%s);""" % _formatted)
-                            continue
-
-                        _item_args = source_dict_to_ordered_args(
-                            _item_dict, _item_fields_order, remove_undefined=True
-                        )
-                        _formatted = (
-                            """['%(tracker_prefix)s_addItem',%(joined_args)s]"""
-                            % {
-                                "tracker_prefix": tracker_prefix,
-                                "joined_args": ",".join(_item_args),
-                            }
-                        )
-                        if _single_push:
-                            nested_script.append(_formatted)
-                        else:
-                            script.append(u"""_gaq.push(%s);""" % _formatted)
+                if transaction_id in data.transaction_items:
+                    for line in self._render_section(
+                        "items", self._render__ga_js__items, plan, transaction_id
+                    ):
+                        yield line
 
             if _valid_transactions:
                 # send the _trackTransaction
                 # https://developers.google.com/analytics/devguides/collection/gajs/methods/gaJSApiEcommerce?csw=1#_gat.GA_Tracker_._addTrans
                 # Sends both the transaction and item data to the Google Analytics server. This method should be called after _trackPageview(), and used in conjunction with the _addItem() and addTrans() methods. It should be called after items and transaction elements have been set up.
-                if _single_push:
-                    nested_script.append(u"""['%s_trackTrans']""" % tracker_prefix)
-                else:
-                    script.append(u"""_gaq.push(['%s_trackTrans']);""" % tracker_prefix)
+                yield (_open, u"""_trackTrans']%s""" % _close)
 
         else:
-            if self.data_struct["*transaction_items"]:
+            if data.transaction_items:
                 log.error("no transaction registered, but transaction_items added")
 
+    def _render__ga_js__items(self, plan, transaction_id):
+        """
+        yields the `(head, tail)` `_addItem` commands of a `ga.js` transaction
+        """
+        data = self._get_data_render()
+        _open = plan.gajs_push_open
+        _close = plan.gajs_push_close
+        _item_fields_order = field_requirements["*transaction_item"][
+            AnalyticsMode.GA_JS
+        ]["order"]
+        # every item of the transaction is encoded in one batch
+        for (_item_args, _item_modes) in zip(
+            encode_ordered_args(
+                data.transaction_items[transaction_id],
+                _item_fields_order,
+                remove_undefined=True,
+            ),
+            data.transaction_item_api_modes(transaction_id),
+        ):
+            if AnalyticsMode.GA_JS not in _item_modes:
+                yield (plan.gajs_push % "/* invalid transaction item */", None)
+                continue
+            yield (_open, u"""_addItem',%s]%s""" % (",".join(_item_args), _close))
+
+    def _render__ga_js__events(self, plan):
+        """
+        yields the `(head, tail)` event commands of a `ga.js` render
+        """
+        data = self._get_data_render()
+        _open = plan.gajs_push_open
+        _close = plan.gajs_push_close
+
         # EVENTS
         # example: _trackEvent(category, action, opt_label, opt_value, opt_noninteraction)
         # the `_trackEvent` api expects the args in this order. render 'undefined' if we don't have it.
-        _events = []
-        _event_fields_required = ("*category", "*action")
-        _event_fields_optional = ("*label", "*value", "*non_interaction")
-        for _event_dict in self.data_struct["*tracked_events"]:
-            _event_args = []
-            _event_args_optional = []
+        # the optional args of every event are encoded in one batch
+        for (_event, _event_args_optional) in zip(
+            data.tracked_events,
+            encode_ordered_args(
+                data.tracked_events, _EVENT_ARGS_OPTIONAL__GA_JS, remove_undefined=True
+            ),
+        ):
             # events are expected to be a series of args
-            try:
-                for _field in _event_fields_required:
-                    _value = _event_dict.get(_field)
-                    if not _value:
-                        raise InvalidTag()
-                    _value = "'%s'" % _value  # pop it in a quote
-                    _event_args.append(_value)
-            except:
-                # catch all Exceptions
-                _events.append(INVALID_TAG)
+            # the `Event` was validated when it was tracked
+            if not _event.has_category_action:
+                yield ("/* _trackEvent: incompatible event */", None)
                 continue
-            # figure out the optional args, if any...
-            for _field in _event_fields_optional:
-                # set the value to a default of `None`
-                # don't set it to `undefined` yet.
-                # we need the `None` for tests...
-                _value = _event_dict.get(_field, None)
-                _event_args_optional.append(_value)
-            if _event_args_optional:
-                if all(e is None for e in _event_args_optional):
-                    # reset this
-                    _event_args_optional = []
-                else:
-                    # upgrade `None` to `"undefined"`, other items are strings
-                    for _idx, _value in enumerate(_event_args_optional):
-                        if _value is None:
-                            _value = "undefined"  # it's undefined(js keyword)
-                        elif type(_value) in (int, float):
-                            _value = "%s" % _value  # turn it into a string
-                        elif type(_value) is bool:
-                            _value = ("%s" % _value).lower()  # turn it into a string
-                        else:
-                            _value = "'%s'" % _value  # pop it in a quote
-                        _event_args_optional[_idx] = _value
-                    # remove every 'undefined' from the tail of the list
-                    _max_defined = None
-                    for _idx, _value in enumerate(_event_args_optional):
-                        if _value != "undefined":
-                            _max_defined = _idx
-                    if _max_defined is not None:
-                        _event_args_optional = _event_args_optional[
-                            : (_max_defined + 1)
-                        ]
-                    else:
-                        _event_args_optional = []
-            _event_args_all = _event_args + _event_args_optional
-            _events.append(
-                """['%s_trackEvent',%s]""" % (tracker_prefix, ",".join(_event_args_all))
-            )
-        if _events:
-            for _event in _events:
-                if _single_push:
-                    if _event is INVALID_TAG:
-                        nested_script.append("/* _trackEvent: incompatible event */")
-                    else:
-                        nested_script.append(_event)
-                else:
-                    if _event is INVALID_TAG:
-                        script.append("/* _trackEvent: incompatible event */")
-                    else:
-                        script.append(u"""_gaq.push(%s);""" % _event)
-        # end events
-
-        # done
-        return script, nested_script
-
-    def _render__ga_js(self):
-        script = []
-        nested_script = []
-        if self.use_comments:
-            script.append(u"""<!-- Google Analytics -->""")
-        script.append(u"""<script type="text/javascript">""")
-        script.append(u"""var _gaq = _gaq || [];""")
-
-        _single_push = self.single_push
-
-        # start the single push if we elected
-        if _single_push:
-            script.append(u"""_gaq.push(""")
-
-        (script, nested_script) = self._render__ga_js__inner(
-            script,
-            nested_script,
-            self.data_struct["*account_id"],
-            secondary_account=False,
+            _event_args_all = [
+                "'%s'" % _event.category,
+                "'%s'" % _event.action,
+            ] + _event_args_optional
+            yield (_open, u"""_trackEvent',%s]%s""" % (",".join(_event_args_all), _close))
+
+    def _render__ga_js(self, plan):
+        data = self._get_data_render()
+        # the account-independent commands are only computed once
+        payload = self._render__ga_js__payload(plan)
+        if data.additional_accounts:
+            payload = list(payload)
+        lines = self._render__ga_js__inner(
+            plan, plan.account_id, secondary_account=False, payload=payload
         )
-        for (idx, account_id) in enumerate(self.data_struct["*additional_accounts"]):
-            (script, nested_script) = self._render__ga_js__inner(
-                script, nested_script, account_id, secondary_account=idx
+        if data.additional_accounts:
+            lines = chain(
+                lines,
+                *[
+                    self._render__ga_js__inner(
+                        plan, account_id, secondary_account=idx, payload=payload
+                    )
+                    for (idx, account_id) in enumerate(data.additional_accounts)
+                ]
             )
 
-        # close the single push if we elected
-        if _single_push:
-            script.append(u""",\n""".join(nested_script))
-            script.append(u""");""")
+        for line in plan.head:
+            yield line
+        if self._config.single_push:
+            # the plan opens and closes the single push; the commands within
+            # are separated by a comma
+            previous = None
+            for line in lines:
+                if previous is not None:
+                    yield previous + u""","""
+                previous = line
+            if previous is not None:
+                yield previous
+        else:
+            for line in lines:
+                yield line
+        for line in plan.tail:
+            yield line
 
-        script.append(
-            u"""\
-(function() {
-var ga = document.createElement('script'); ga.type = 'text/javascript'; ga.async = true;
-ga.src = ('https:' == document.location.protocol ? 'https://ssl': 'http://www') + '.google-analytics.com/ga.js';
-var s = document.getElementsByTagName('script')[0]; s.parentNode.insertBefore(ga, s);
-})();"""
-        )
-        script.append(u"""</script>""")
-        if self.use_comments:
-            script.append("<!-- End Google Analytics -->")
-        return u"""\n""".join(script)
-
-    def _render__analytics__inner(self, script, account_id, secondary_account=False):
-        # precompute first
-        create_args = {}
-        if self.data_struct["*crossdomain_tracking"]:
-            create_args["allowLinker"] = True
-        if self.data_struct["*user_id"]:
-            create_args["userId"] = self.data_struct["*user_id"]
-        if self.amp_clientid_integration:
-            create_args["useAmpClientId"] = True
+    def _render__analytics__inner(
+        self, plan, account_id, secondary_account=False, create_args=None, payload=None
+    ):
+        """
+        this handles the inner render for `analytics.js`
+
+        args/kwargs:
+            plan = the `RenderPlan` for this render
+            account_id = current account_id, might be nested
+            secondary_account = False or idx(0+).
+            create_args = the result of `_render__analytics__create_args`
+            payload = the commands of `_render__analytics__payload`; this is
+                      computed once per render and shared by every account.
+        yields:
+            the commands for this account
+        """
+        if payload is None:
+            payload = self._render__analytics__payload(plan)
 
         (secondary_account_name, tracker_prefix) = generate_tracker_name(
             secondary_account
@@ -1542,389 +3000,385 @@ var s = document.getElementsByTagName('script')[0]; s.parentNode.insertBefore(ga
 
         # account_id first
         # create([trackingId], [cookieDomain], [name], [fieldsObject]);
-        if not create_args:
-            if secondary_account_name:
-                script.append(
-                    u"""ga('create','%s','auto','%s');"""
-                    % (account_id, secondary_account_name)
-                )
-            else:
-                script.append(u"""ga('create','%s','auto');""" % account_id)
+        if (create_args is None) and (secondary_account is False):
+            # the plan has the primary account's `create` without dynamic args
+            yield plan.create_line
         else:
-            create_args = self._json_dumps(create_args)
-            if secondary_account_name:
-                script.append(
-                    u"""ga('create','%s','auto','%s',%s);"""
-                    % (account_id, secondary_account_name, create_args)
-                )
+            if create_args is None:
+                create_args = plan.create_args_json
+            if not create_args:
+                if secondary_account_name:
+                    yield u"""ga('create','%s','auto','%s');""" % (
+                        account_id,
+                        secondary_account_name,
+                    )
+                else:
+                    yield u"""ga('create','%s','auto');""" % account_id
             else:
-                script.append(
-                    u"""ga('create','%s','auto',%s);""" % (account_id, create_args)
-                )
+                if secondary_account_name:
+                    yield u"""ga('create','%s','auto','%s',%s);""" % (
+                        account_id,
+                        secondary_account_name,
+                        create_args,
+                    )
+                else:
+                    yield u"""ga('create','%s','auto',%s);""" % (account_id, create_args)
 
         if secondary_account is False:
+            data = self._get_data_render()
             # crossdomain
-            if self.data_struct["*crossdomain_tracking"]:
-                script.append(u"""ga('require','linker');""")
-                destination_domains = self.data_struct["*crossdomain_tracking"][
-                    "domains"
-                ]
+            if data.crossdomain_tracking:
+                yield u"""ga('require','linker');"""
+                destination_domains = data.crossdomain_tracking["domains"]
                 destination_domains = ",".join(
                     ["'%s'" % d for d in destination_domains]
                 )
-                script.append(u"""ga('linker:autoLink',[%s]);""" % destination_domains)
+                yield u"""ga('linker:autoLink',[%s]);""" % destination_domains
             # ecommerce
-            if self.data_struct["*transaction"]:
-                script.append(u"""ga('require','ecommerce');""")
+            if data.transaction:
+                yield u"""ga('require','ecommerce');"""
+
+        # everything else is stamped with the tracker_prefix
+        for (_head, _tail) in payload:
+            if _tail is None:
+                yield _head
+            else:
+                yield _head + tracker_prefix + _tail
+
+    def _render__analytics__create_args(self, plan):
+        """
+        returns the serialized dynamic `create` args, shared by every account,
+        or `None` if the render has none
+        """
+        data = self._get_data_render()
+        if not (data.crossdomain_tracking or data.user_id):
+            return None
+        create_args = plan.create_args.copy()
+        if data.crossdomain_tracking:
+            create_args["allowLinker"] = True
+        if data.user_id:
+            create_args["userId"] = data.user_id
+        return self._config.json_dumps_callable(create_args)
+
+    def _render__analytics__payload(self, plan):
+        """
+        builds the account-independent commands of an `analytics.js` render,
+        which follow the account's `create`.
+
+        yields `(head, tail)` tuples. A command is rendered for an account by
+        placing the account's tracker prefix between `head` and `tail`. If
+        `tail` is `None`, `head` is rendered as-is.
+        """
+        _json_dumps = self._config.json_dumps_callable
 
         pagehit_data = {}
+        custom_data = self._render_section(
+            "dimensions", self._render__analytics__custom_data, plan
+        )
+
+        if self._config.global_custom_data:
+            # update the entire tracker
+            if custom_data:
+                yield (u"""ga('""", u"""set',%s);""" % _json_dumps(custom_data))
+        else:
+            # update our pagedata items
+            # pagehit_data.update(custom_data)
+            pagehit_data = custom_data
+
+        # pageview
+        # ga('send', 'pageview');
+        if pagehit_data:
+            yield (u"""ga('""", u"""send','pageview',%s);""" % _json_dumps(pagehit_data))
+        else:
+            yield (u"""ga('""", u"""send','pageview');""")
+
+        # according to GA docs, the order to submit via javascript is:
+        # # ga('send', 'pageview');
+        # # ga('require', 'ecommerce');   // Load the ecommerce plug-in.
+        # # ecommerce:addTransaction
+        # # ecommerce:addItem
+        # # ga('ecommerce:send');
+
+        # ecommerce
+        for line in self._render_section(
+            "transactions", self._render__analytics__ecommerce, plan
+        ):
+            yield line
+
+        # events
+        for line in self._render_section(
+            "events", self._render__analytics__events, plan
+        ):
+            yield line
+
+    def _render__analytics__custom_data(self, plan):
+        """
+        returns the `dimension` and `metric` values of an `analytics.js` render
+        """
+        data = self._get_data_render()
         custom_data = {}
 
         # custom variables?
-        for index in sorted(self.data_struct["*custom_dimensions"].keys()):
+        for index in sorted(data.custom_dimensions.keys()):
             # for `ga.js`:
             # index == str(integer)
             # payload == (name, value, opt_scope)
             # however... we only need send the VALUE, because name+opt_scope are handled on the admin dashboard
-            _payload = self.data_struct["*custom_dimensions"][index]
+            _payload = data.custom_dimensions[index]
             if not _payload:
                 continue
             # remember, we stripped `dimension` out
             custom_data["dimension%s" % index] = _payload[1]  # value
-        for index in sorted(self.data_struct["*custom_metrics"].keys()):
+        for index in sorted(data.custom_metrics.keys()):
             # for `ga.js`:
             # index == str(integer)
             # payload == (name, value, opt_scope)
             # however... we only need send the VALUE, because name+opt_scope are handled on the admin dashboard
-            _payload = self.data_struct["*custom_metrics"][index]
+            _payload = data.custom_metrics[index]
             if not _payload:
                 continue
             # remember, we stripped `metric` out
             custom_data["metric%s" % index] = _payload[1]  # value
+        return custom_data
 
-        if self.global_custom_data:
-            # update the entire tracker
-            if custom_data:
-                script.append(
-                    u"""ga('%sset',%s);"""
-                    % (tracker_prefix, self._json_dumps(custom_data))
-                )
-        else:
-            # update our pagedata items
-            # pagehit_data.update(custom_data)
-            pagehit_data = custom_data
-
-        # pageview
-        # ga('send', 'pageview');
-        if pagehit_data:
-            formatted_line = u"""ga('%ssend','pageview',%s);""" % (
-                tracker_prefix,
-                self._json_dumps(pagehit_data),
-            )
-            script.append(formatted_line)
-        else:
-            script.append(u"""ga('%ssend','pageview');""" % tracker_prefix)
-
-        # according to GA docs, the order to submit via javascript is:
-        # # ga('send', 'pageview');
-        # # ga('require', 'ecommerce');   // Load the ecommerce plug-in.
-        # # ecommerce:addTransaction
-        # # ecommerce:addItem
-        # # ga('ecommerce:send');
+    def _render__analytics__ecommerce(self, plan):
+        """
+        yields the `(head, tail)` ecommerce commands of an `analytics.js` render
+        """
+        data = self._get_data_render()
+        _json_dumps = self._config.json_dumps_callable
 
         # ecommerce
-        if self.data_struct["*transaction"]:
-            _txn_fields_required = field_requirements["*transaction"][
-                AnalyticsMode.ANALYTICS
-            ]["required"]
-            # _txn_fields_optional = field_requirements['*transaction'][AnalyticsMode.ANALYTICS]['optional']
-            _item_fields_required = field_requirements["*transaction_item"][
-                AnalyticsMode.ANALYTICS
-            ]["required"]
-            # _item_fields_optional = field_requirements['*transaction_item'][AnalyticsMode.ANALYTICS]['optional']
+        if data.transaction:
+            # records are validated against `field_requirements` once, then cached
 
             # used to decide if we `send`
             _valid_transactions = False
-            for transaction_id in self.data_struct["*transaction"].keys():
-                _transaction_dict = self.data_struct["*transaction"][transaction_id]
-                try:
-                    for _field in _txn_fields_required:
-                        _value = _transaction_dict.get(_field, None)
-                        if _value is None:
-                            raise InvalidTag()
-                except Exception as e:
-                    _formatted = "/* invalid transaction */"
-                    script.append(_formatted)
+            for transaction_id in data.transaction.keys():
+                _transaction_dict = data.transaction[transaction_id]
+                if AnalyticsMode.ANALYTICS not in data.transaction_api_modes(
+                    transaction_id
+                ):
+                    yield ("/* invalid transaction */", None)
                     continue
 
                 _transaction_clean = source_dict_to_api_dict(
                     _transaction_dict, "*transaction", AnalyticsMode.ANALYTICS
                 )
-                _formatted = u"""ga('%secommerce:addTransaction',%s)""" % (
-                    tracker_prefix,
-                    self._json_dumps(_transaction_clean),
+                yield (
+                    u"""ga('""",
+                    u"""ecommerce:addTransaction',%s)"""
+                    % _json_dumps(_transaction_clean),
                 )
-                script.append(_formatted)
 
                 # enough to `send` !
                 _valid_transactions = True
 
-                if transaction_id in self.data_struct["*transaction_items"]:
-                    for _item_dict in self.data_struct["*transaction_items"][
-                        transaction_id
-                    ]:
-                        try:
-                            for _field in _item_fields_required:
-                                _value = _item_dict.get(_field, None)
-                                if _value is None:
-                                    raise InvalidTag()
-                        except Exception:
-                            _formatted = "/* invalid transaction item */"
-                            script.append(_formatted)
-                            continue
-                        _item_clean = source_dict_to_api_dict(
-                            _item_dict, "*transaction_item", AnalyticsMode.ANALYTICS
-                        )
-                        _formatted = u"""ga('%secommerce:addItem',%s)""" % (
-                            tracker_prefix,
-                            self._json_dumps(_item_clean),
-                        )
-                        script.append(_formatted)
+                if transaction_id in data.transaction_items:
+                    for line in self._render_section(
+                        "items", self._render__analytics__items, plan, transaction_id
+                    ):
+                        yield line
 
             if _valid_transactions:
-                script.append(u"""ga('%secommerce:send');""" % tracker_prefix)
+                yield (u"""ga('""", u"""ecommerce:send');""")
 
         else:
-            if self.data_struct["*transaction_items"]:
+            if data.transaction_items:
                 log.error("no transaction registered, but transaction_items added")
 
+    def _render__analytics__items(self, plan, transaction_id):
+        """
+        yields the `(head, tail)` `ecommerce:addItem` commands of an
+        `analytics.js` transaction
+        """
+        data = self._get_data_render()
+        _json_dumps = self._config.json_dumps_callable
+        for (_item_clean, _item_modes) in zip(
+            iter_api_dicts(
+                data.transaction_items[transaction_id],
+                "*transaction_item",
+                AnalyticsMode.ANALYTICS,
+            ),
+            data.transaction_item_api_modes(transaction_id),
+        ):
+            if AnalyticsMode.ANALYTICS not in _item_modes:
+                yield ("/* invalid transaction item */", None)
+                continue
+            yield (
+                u"""ga('""",
+                u"""ecommerce:addItem',%s)""" % _json_dumps(_item_clean),
+            )
+
+    def _render__analytics__events(self, plan):
+        """
+        yields the `(head, tail)` event commands of an `analytics.js` render
+        """
+        data = self._get_data_render()
+        _json_dumps = self._config.json_dumps_callable
+
         # EVENTS
         # example: ga('send', 'event', [eventCategory], [eventAction], [eventLabel], [eventValue], [fieldsObject]);
-        _events = []
-        _event_fields_required = ("*category", "*action")
-        _event_fields_optional = ("*label", "*value")
-        _event_fields_optional_fieldobject = (("*non_interaction", "nonInteraction"),)
-        for _event_dict in self.data_struct["*tracked_events"]:
-            _event_args = []
-            _event_args_optional = []
+        # the optional args of every event are encoded in one batch
+        for (_event, _event_args_optional) in zip(
+            data.tracked_events,
+            encode_ordered_args(
+                data.tracked_events,
+                _EVENT_ARGS_OPTIONAL__ANALYTICS,
+                remove_undefined=True,
+            ),
+        ):
             _event_fieldobject = {}
             # events are expected to be a series of args
-            try:
-                for _field in _event_fields_required:
-                    _value = _event_dict.get(_field)
-                    if not _value:
-                        raise InvalidTag()
-                    _value = "'%s'" % _value  # pop it in a quote
-                    _event_args.append(_value)
-            except:
-                # catch all Exceptions
-                _events.append(INVALID_TAG)
+            # the `Event` was validated when it was tracked
+            if not _event.has_category_action:
+                yield (u"""/* ga('""", u"""send': incompatible event */""")
                 continue
-            # figure out the optional args, if any...
-            for _field in _event_fields_optional:
-                # set the value to a default of `None`
-                # don't set it to `undefined` yet.
-                # we need the `None` for tests...
-                _value = _event_dict.get(_field, None)
-                _event_args_optional.append(_value)
-            if _event_args_optional:
-                if not any(_event_args_optional):
-                    # reset this
-                    _event_args_optional = []
-                else:
-                    # upgrade `None` to `"undefined"`, other items are strings
-                    for _idx, _value in enumerate(_event_args_optional):
-                        if _value is None:
-                            _value = "undefined"  # it's undefined(js keyword)
-                        else:
-                            if type(_value) in (int, float):
-                                _value = "%s" % _value  # turn it into a string
-                            elif type(_value) is bool:
-                                _value = (
-                                    "%s" % _value
-                                ).lower()  # turn it into a string
-                            else:
-                                _value = "'%s'" % _value  # pop it in a quote
-                        _event_args_optional[_idx] = _value
-                    # remove every 'undefined' from the tail of the list
-                    _max_defined = None
-                    for _idx, value in enumerate(_event_args_optional):
-                        if _value != "undefined":
-                            _max_defined = _idx
-                    if _max_defined is not None:
-                        _event_args_optional = _event_args_optional[
-                            : (_max_defined + 1)
-                        ]
-                    else:
-                        _event_args_optional = []
+            _event_args = ["'%s'" % _event.category, "'%s'" % _event.action]
             # figure out the fieldobject args if any.
-            for (_field_src, _field_dest) in _event_fields_optional_fieldobject:
-                # set the value to a default of `None`
-                # don't set it to `undefined` yet.
-                # we need the `None` for tests...
-                _value = _event_dict.get(_field_src, None)
-                if _value is not None:
-                    _event_fieldobject[_field_dest] = _value
+            if _event.non_interaction is not None:
+                _event_fieldobject["nonInteraction"] = _event.non_interaction
 
             _event_args_all = _event_args + _event_args_optional
             if _event_fieldobject:
-                _event_args_all.append(self._json_dumps(_event_fieldobject))
-            _events.append(
-                u"""ga('%ssend','event',%s);"""
-                % (tracker_prefix, ",".join(_event_args_all))
-            )
-
-        if _events:
-            for _event in _events:
-                if _event is INVALID_TAG:
-                    script.append(
-                        "/* ga('%ssend': incompatible event */" % tracker_prefix
-                    )
-                else:
-                    script.append(_event)
-
-        return script
-
-    def _render__analytics(self, render_async=None):
-        script = []
-        if self.use_comments:
-            script.append(u"""<!-- Google Analytics -->""")
-        script.append(u"""<script type="text/javascript">""")
-        script.append(
-            u"""\
-(function(i,s,o,g,r,a,m){i['GoogleAnalyticsObject']=r;i[r]=i[r]||function(){
-(i[r].q=i[r].q||[]).push(arguments)},i[r].l=1*new Date();a=s.createElement(o),
-m=s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m)
-})(window,document,'script','https://www.google-analytics.com/analytics.js','ga');"""
-        )
-
-        account_id = self.data_struct["*account_id"]
-        script = self._render__analytics__inner(
-            script, account_id, secondary_account=False
-        )
-
-        for (idx, account_id) in enumerate(self.data_struct["*additional_accounts"]):
-            script = self._render__analytics__inner(
-                script, account_id, secondary_account=idx
-            )
-
-        script.append(u"""</script>""")
-        if self.use_comments:
-            script.append("<!-- End Google Analytics -->")
-        return u"""\n""".join(script)
+                _event_args_all.append(_json_dumps(_event_fieldobject))
+            yield (u"""ga('""", u"""send','event',%s);""" % ",".join(_event_args_all))
+
+    def _render__analytics(self, plan, render_async=None):
+        data = self._get_data_render()
+        # the account-independent commands are only computed once
+        create_args = self._render__analytics__create_args(plan)
+        payload = self._render__analytics__payload(plan)
+        if data.additional_accounts:
+            payload = list(payload)
+
+        for line in plan.head:
+            yield line
+        for line in self._render__analytics__inner(
+            plan,
+            plan.account_id,
+            secondary_account=False,
+            create_args=create_args,
+            payload=payload,
+        ):
+            yield line
+        for (idx, account_id) in enumerate(data.additional_accounts):
+            for line in self._render__analytics__inner(
+                plan,
+                account_id,
+                secondary_account=idx,
+                create_args=create_args,
+                payload=payload,
+            ):
+                yield line
+        for line in plan.tail:
+            yield line
 
-    def _render__gtag(self):
+    def _render__gtag(self, plan):
         """
         migration guide: https://developers.google.com/analytics/devguides/collection/djs/migration
         """
-        script = []
-        account_id = self.data_struct["*account_id"]
-        if self.use_comments:
-            # script.append(u"""<!-- Google Analytics -->""")
-            script.append(u"""<!-- Global site tag (gtag.js) - Google Analytics -->""")
-        script.append(
-            u"""\
-<script async src="https://www.googletagmanager.com/gtag/js?id=%(account_id)s"></script>
-<script>
-  window.dataLayer = window.dataLayer || [];
-  function gtag(){dataLayer.push(arguments);}
-  gtag('js', new Date());
-"""
-            % {"account_id": account_id}
-        )
+        data = self._get_data_render()
+        for line in plan.head:
+            yield line
+        account_id = plan.account_id
 
         # initial config args
-        create_args = {}
-        if self.amp_clientid_integration:
-            create_args["use_amp_client_id"] = True
-        if self.data_struct["*crossdomain_tracking"]:
+        create_args = None
+        if (
+            data.crossdomain_tracking
+            or data.user_id
+            or data.custom_dimensions
+        ):
+            create_args = plan.create_args.copy()
+        if data.crossdomain_tracking:
             create_args["linker"] = {}
-            if self.data_struct["*crossdomain_tracking"]["accept_incoming"]:
+            if data.crossdomain_tracking["accept_incoming"]:
                 create_args["linker"]["accept_incoming"] = True
-            create_args["linker"]["domains"] = self.data_struct[
-                "*crossdomain_tracking"
-            ]["domains"]
+            create_args["linker"]["domains"] = data.crossdomain_tracking["domains"]
 
-        if self.data_struct["*user_id"]:
-            create_args["user_id"] = self.data_struct["*user_id"]
+        if data.user_id:
+            create_args["user_id"] = data.user_id
         jsons_custom_values = None
-        if self.data_struct["*custom_dimensions"]:
-            # this will be: 'dimension%s' = name
-            custom_map = {}
-            # this will be: name = value
-            custom_values = {}
-            for index in sorted(self.data_struct["*custom_dimensions"].keys()):
-                _payload = self.data_struct["*custom_dimensions"][index]
-                custom_map["dimension%s" % index] = _payload[0]
-                custom_values[_payload[0]] = _payload[1]
+        if data.custom_dimensions:
+            (custom_map, jsons_custom_values) = self._render_section(
+                "dimensions", self._render__gtag__dimensions, plan
+            )
             create_args["custom_map"] = custom_map
-            jsons_custom_values = self._json_dumps(custom_values)
 
         if jsons_custom_values:
             # if we have custom_variables, set before config
-            if self.gtag_dimensions_strategy == GtagDimensionsStrategy.SET_CONFIG:
-                if self.global_custom_data:
-                    script.append("""gtag('set',%s);""" % jsons_custom_values)
-            elif (
-                self.gtag_dimensions_strategy
-                == GtagDimensionsStrategy.CONFIGNOPAGEVIEW_SET_EVENT
-            ):
+            if plan.gtag_set_before_config:
+                yield """gtag('set',%s);""" % jsons_custom_values
+            if not plan.gtag_send_page_view:
                 create_args["send_page_view"] = False
 
         # set the main account_id config
-        if not create_args:
-            script.append("""gtag('config','%s');""" % account_id)
-            for (idx, alt_account_id) in enumerate(
-                self.data_struct["*additional_accounts"]
-            ):
-                script.append(
-                    """gtag('config','%s');""" % alt_account_id
-                )  # ,{'groups':'core'}
+        jsons_create_args = None
+        if create_args is None:
+            # the plan has the primary account's `config` without dynamic args
+            yield plan.create_line
+            jsons_create_args = plan.create_args_json
         else:
-            jsons_create_args = self._json_dumps(create_args)
-            script.append(
-                """gtag('config','%s',%s);""" % (account_id, jsons_create_args)
-            )
-            for (idx, alt_account_id) in enumerate(
-                self.data_struct["*additional_accounts"]
-            ):
-                script.append(
-                    """gtag('config','%s',%s);""" % (alt_account_id, jsons_create_args)
-                )  # ,{'groups':'core'}
+            jsons_create_args = self._config.json_dumps_callable(create_args)
+            yield """gtag('config','%s',%s);""" % (account_id, jsons_create_args)
+        for alt_account_id in data.additional_accounts:
+            if jsons_create_args is None:
+                # ,{'groups':'core'}
+                yield """gtag('config','%s');""" % alt_account_id
+            else:
+                # ,{'groups':'core'}
+                yield """gtag('config','%s',%s);""" % (alt_account_id, jsons_create_args)
 
         # if we have custom_variables, they're done via a config update + event
         if jsons_custom_values:
-            if self.gtag_dimensions_strategy == GtagDimensionsStrategy.SET_CONFIG:
-                if self.global_custom_data:
-                    pass
-                else:
-                    script.append(
-                        """gtag('event','pageview',%s);""" % jsons_custom_values
-                    )
-            elif (
-                self.gtag_dimensions_strategy
-                == GtagDimensionsStrategy.CONFIGNOPAGEVIEW_SET_EVENT
-            ):
-                if self.global_custom_data:
-                    if jsons_custom_values:
-                        script.append("""gtag('set',%s);""" % jsons_custom_values)
-                    # the gtag() event automatically tracks a pageview, which we disabled, so this must be sent in an event of `pageview`
-                    script.append("""gtag('event','pageview');""")
-                else:
-                    script.append(
-                        """gtag('event','pageview',%s);""" % jsons_custom_values
-                    )
+            if plan.gtag_set_after_config:
+                yield """gtag('set',%s);""" % jsons_custom_values
+                # the gtag() event automatically tracks a pageview, which we disabled, so this must be sent in an event of `pageview`
+                yield """gtag('event','pageview');"""
+            elif plan.gtag_event_pageview:
+                yield """gtag('event','pageview',%s);""" % jsons_custom_values
+
+        # ecommerce
+        for line in self._render_section(
+            "transactions", self._render__gtag__ecommerce, plan
+        ):
+            yield line
+
+        # track_pageview is automatic and part of the config
+
+        # events
+        for line in self._render_section("events", self._render__gtag__events, plan):
+            yield line
+
+        for line in plan.tail:
+            yield line
+
+    def _render__gtag__dimensions(self, plan):
+        """
+        returns the `custom_map` of a `gtag.js` render, and its serialized
+        dimension values
+        """
+        data = self._get_data_render()
+        # this will be: 'dimension%s' = name
+        custom_map = {}
+        # this will be: name = value
+        custom_values = {}
+        for index in sorted(data.custom_dimensions.keys()):
+            _payload = data.custom_dimensions[index]
+            custom_map["dimension%s" % index] = _payload[0]
+            custom_values[_payload[0]] = _payload[1]
+        return (custom_map, self._config.json_dumps_callable(custom_values))
+
+    def _render__gtag__ecommerce(self, plan):
+        """
+        yields the ecommerce lines of a `gtag.js` render
+        """
+        data = self._get_data_render()
 
         # ecommerce
-        if self.data_struct["*transaction"]:
-            _txn_fields_required = field_requirements["*transaction"][
-                AnalyticsMode.GTAG
-            ]["required"]
-            # _txn_fields_optional = field_requirements['*transaction'][AnalyticsMode.GTAG]['optional']
-            _item_fields_required = field_requirements["*transaction_item"][
-                AnalyticsMode.GTAG
-            ]["required"]
-            # _item_fields_optional = field_requirements['*transaction_item'][AnalyticsMode.GTAG]['optional']
+        if data.transaction:
+            # records are validated against `field_requirements` once, then cached
 
             # used to decide if we `send`
             _valid_transactions = False
@@ -1932,14 +3386,11 @@ m=s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m)
             # consolidated error logging
             _errors = []
 
-            for transaction_id in self.data_struct["*transaction"].keys():
-                _transaction_dict = self.data_struct["*transaction"][transaction_id]
-                try:
-                    for _field in _txn_fields_required:
-                        _value = _transaction_dict.get(_field, None)
-                        if _value is None:
-                            raise InvalidTag()
-                except Exception as e:
+            for transaction_id in data.transaction.keys():
+                _transaction_dict = data.transaction[transaction_id]
+                if AnalyticsMode.GTAG not in data.transaction_api_modes(
+                    transaction_id
+                ):
                     _formatted = "/* invalid transaction */"
                     _errors.append(_formatted)
                     continue
@@ -1951,124 +3402,234 @@ m=s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m)
                 # enough to `send` !
                 _valid_transactions = True
 
-                # now we do items
+                # now we do items; each is encoded once, so the purchase can be
+                # split by size without encoding it again
                 items = []
-                if transaction_id in self.data_struct["*transaction_items"]:
-                    for _item_dict in self.data_struct["*transaction_items"][
-                        transaction_id
-                    ]:
-                        try:
-                            for _field in _item_fields_required:
-                                _value = _item_dict.get(_field, None)
-                                if _value is None:
-                                    raise InvalidTag()
-                        except Exception:
-                            _formatted = "/* invalid transaction item */"
-                            _errors.append(_formatted)
-                            continue
-                        _item_clean = source_dict_to_api_dict(
-                            _item_dict, "*transaction_item", AnalyticsMode.GTAG
-                        )
-                        items.append(_item_clean)
-
-                _transaction_clean["items"] = items
+                if transaction_id in data.transaction_items:
+                    (items, _item_errors) = self._render_section(
+                        "items", self._render__gtag__items, plan, transaction_id
+                    )
+                    _errors.extend(_item_errors)
 
-                _formatted = u"""gtag('event', 'purchase', %s""" % self._json_dumps(
-                    _transaction_clean
-                )
-                script.append(_formatted)
+                _transaction_clean["items"] = [_GTAG_ITEMS_PLACEHOLDER]
+                for _formatted in self._render__gtag__purchase(
+                    transaction_id, _transaction_clean, items
+                ):
+                    yield _formatted
 
             if _valid_transactions:
                 # TODO: does this require a send?
                 pass
 
-            if _errors:
-                script.extend(_errors)
+            for _error in _errors:
+                yield _error
 
-        # track_pageview is automatic and part of the config
+    def _render__gtag__items(self, plan, transaction_id):
+        """
+        returns the encoded items of a `gtag.js` transaction, and the comments
+        for its invalid items
+        """
+        data = self._get_data_render()
+        _dumps = self._config.json_dumps_callable
+        items = []
+        errors = []
+        for (_item_clean, _item_modes) in zip(
+            iter_api_dicts(
+                data.transaction_items[transaction_id],
+                "*transaction_item",
+                AnalyticsMode.GTAG,
+            ),
+            data.transaction_item_api_modes(transaction_id),
+        ):
+            if AnalyticsMode.GTAG not in _item_modes:
+                errors.append("/* invalid transaction item */")
+                continue
+            items.append(_dumps(_item_clean))
+        return (items, errors)
+
+    def _render__gtag__purchase(self, transaction_id, transaction_clean, items):
+        """
+        yields the `purchase` calls of a `gtag.js` transaction.
+
+        `items` are the encoded items. If the purchase would be larger than
+        `GTAG_PURCHASE_MAX_BYTES`, the items are packed into several calls;
+        only the first carries the transaction's fields, the others just the
+        `transaction_id`, so the revenue is recorded once.
+        """
+        _dumps = self._config.json_dumps_callable
+        placeholder = _dumps([_GTAG_ITEMS_PLACEHOLDER])
+        head = u"""gtag('event', 'purchase', %s""" % _dumps(transaction_clean)
+        sizes = [len(i.encode("utf-8")) + 1 for i in items]
+        capacity = GTAG_PURCHASE_MAX_BYTES - (
+            len(head.encode("utf-8")) - len(placeholder) + 2
+        )
+        if sum(sizes) <= capacity:
+            yield head.replace(placeholder, u"""[%s]""" % u""",""".join(items), 1)
+            return
+        tail = u"""gtag('event', 'purchase', %s""" % _dumps(
+            {"transaction_id": transaction_id, "items": [_GTAG_ITEMS_PLACEHOLDER]}
+        )
+        for (idx, _bin) in enumerate(_pack_by_size(sizes, capacity)):
+            _items = u"""[%s]""" % u""",""".join(items[i] for i in _bin)
+            yield (tail if idx else head).replace(placeholder, _items, 1)
+
+    def _render__gtag__events(self, plan):
+        """
+        yields the event lines of a `gtag.js` render
+        """
+        data = self._get_data_render()
 
         # events
         # ga('send', 'event', 'category', 'action', 'opt_label', opt_value, {'nonInteraction': 1});
-        _events = []
-        _event_fields_optional_fieldobject = (
-            ("*category", "event_category"),
-            ("*label", "event_label"),
-            ("*value", "value"),
-            ("*non_interaction", "non_interaction"),  # TODO: is this legit?
-        )
-        for _event_dict in self.data_struct["*tracked_events"]:
+        for _event in data.tracked_events:
             # all events require an action
-            _event_action = _event_dict.get("*action")
-            try:
-                if not _event_action:
-                    raise InvalidTag()
-            except:
-                # catch all Exceptions
-                _events.append(INVALID_TAG)
+            # the `Event` was validated when it was tracked
+            if not _event.has_action:
+                yield "/* gtag('event': incompatible event */"
                 continue
+            _event_action = _event.action
 
-            _event_fieldobject = {}
             # figure out the fieldobject args if any.
-            for (_field_src, _field_dest) in _event_fields_optional_fieldobject:
-                # set the value to a default of `None`
-                # don't set it to `undefined` yet.
-                # we need the `None` for tests...
-                _value = _event_dict.get(_field_src, None)
-                if _value is not None:
-                    _event_fieldobject[_field_dest] = _value
+            # TODO: is `non_interaction` legit?
+            _event_fieldobject = _event.api_dict(AnalyticsMode.GTAG)
 
             if _event_fieldobject:
-                _formatted = u"""gtag('event','%s',%s""" % (
+                yield u"""gtag('event','%s',%s""" % (
                     _event_action,
-                    self._json_dumps(_event_fieldobject),
+                    self._config.json_dumps_callable(_event_fieldobject),
                 )
-                _events.append(_formatted)
             else:
-                _formatted = u"""gtag('event','%s');""" % _event_action
-                _events.append(_formatted)
+                yield u"""gtag('event','%s');""" % _event_action
 
-        if _events:
-            for _event in _events:
-                if _event is INVALID_TAG:
-                    script.append("/* gtag('event': incompatible event */")
-                else:
-                    script.append(_event)
-
-        script.append(u"""</script>""")
-        if self.use_comments:
-            script.append("<!-- End Google Analytics -->")
-        return u"""\n""".join(script)
-
-    def _render__amp(self):
-        script = [
-            '<amp-analytics type="googleanalytics">',
-            '<script type="application/json">',
-        ]
+    def _render__amp(self, plan):
+        data = self._get_data_render()
+        for line in plan.head:
+            yield line
         payload = {
-            "vars": {"account": self.data_struct["*account_id"]},
+            "vars": {"account": plan.account_id},
             "triggers": {"trackPageview": {"on": "visible", "request": "pageview"}},
         }
 
         # these are optional
         extra_url_params = {}
-        if self.data_struct["*user_id"]:
-            extra_url_params["user_id"] = self.data_struct["*user_id"]
+        if data.user_id:
+            extra_url_params["user_id"] = data.user_id
 
-        if self.data_struct["*custom_dimensions"]:
-            for _key, _dimension in self.data_struct["*custom_dimensions"].items():
+        if data.custom_dimensions:
+            for _key, _dimension in data.custom_dimensions.items():
                 # _dimension = ('name', 'value', True/False/None)
                 extra_url_params["cd%s" % _key] = _dimension[1]
 
         # cleanup this
         if extra_url_params:
             payload["extraUrlParams"] = extra_url_params
-        script.append(self._json_dumps(payload))
+        yield self._config.json_dumps_callable(payload)
+
+        for line in plan.tail:
+            yield line
+
+    def _get_render_plan(self, mode):
+        """
+        returns the shared `RenderPlan` for the current configuration
+        """
+        return get_render_plan(self._config, self.account_id, mode)
+
+    def _is_pageview_only(self):
+        """
+        returns ``True`` if no data has been recorded that affects a render.
+        the output of these renders is fully determined by the `RenderPlan`.
+        """
+        data = self._data
+        if data is None:
+            return True
+        return not (
+            data.additional_accounts
+            or data.tracked_events
+            or data.custom_dimensions
+            or data.custom_metrics
+            or data.transaction
+            or data.transaction_items
+            or data.crossdomain_tracking
+            or data.user_id
+        )
 
-        script.extend(["</script>", "</amp-analytics>"])
-        if self.use_comments:
-            script.insert(0, u"""<!-- Google Analytics -->""")
-            script.append("<!-- End Google Analytics -->")
-        return u"""\n""".join(script)
+    def _render_memo_get(self, plan):
+        """
+        returns the last render for `plan`, if the data has not changed since
+        """
+        renders = self._renders
+        if renders is not None:
+            memo = renders.get(plan)
+            if (memo is not None) and (memo[0] == self._get_data_render()._version):
+                return memo[1]
+        return None
+
+    def _render_memo_set(self, plan, rendered):
+        renders = self._renders
+        if renders is None:
+            renders = self._renders = {}
+        renders[plan] = (self._get_data_render()._version, rendered)
+
+    def _render_lines(self, plan):
+        """
+        returns an iterable of the lines of a render, without line breaks
+        """
+        mode = plan.mode
+        if mode == AnalyticsMode.GA_JS:
+            return self._render__ga_js(plan)
+        elif mode == AnalyticsMode.ANALYTICS:
+            return self._render__analytics(plan, render_async=True)
+        elif mode == AnalyticsMode.GTAG:
+            return self._render__gtag(plan)
+        elif mode == AnalyticsMode.AMP:
+            return self._render__amp(plan)
+        return ("<!-- unsupported AnalyticsMode -->",)
+
+    def _render_data_fingerprint(self):
+        """
+        returns the `fingerprint` of the recorded data, which is shared by the
+        `RenderCache` keys of every mode
+        """
+        data = self._get_data_render()
+        return tuple(fingerprint(getattr(data, f)) for f in _WriterData_fields)
+
+    def _render_cache_key(self, plan, data_fingerprint=None):
+        """
+        returns the `RenderCache` key for this writer, or `None` if the data
+        can not be hashed
+        """
+        if data_fingerprint is None:
+            data_fingerprint = self._render_data_fingerprint()
+        key = (self._config, plan.account_id, plan.mode, data_fingerprint)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _render_prepare(self, mode, refresh=True):
+        """
+        validates `mode` and marks the writer as rendered. The data handed out
+        by `data_struct` is refreshed, unless `refresh` is ``False``.
+
+        returns a tuple of `(plan, rendered)`; `rendered` is the full output if
+        it is already known, otherwise `None`.
+        """
+        if (mode is not None) and (mode not in AnalyticsMode._valid_modes):
+            raise ValueError("invalid mode")
+        mode = mode if mode is not None else self._config.mode
+        if refresh:
+            self._refresh_data()
+        if not self._rendered:
+            self._rendered = True
+            if self._config.metrics is not None:
+                self._config.metrics.increment("writers_rendered", self._config.mode)
+        plan = self._get_render_plan(mode)
+        if self._is_pageview_only():
+            if plan.empty_html is None:
+                plan.empty_html = u"""\n""".join(self._render_lines(plan))
+            return (plan, plan.empty_html)
+        return (plan, self._render_memo_get(plan))
 
     def render(self, mode=None):
         """
@@ -2081,19 +3642,208 @@ m=s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m)
 
         Notice that you have to escape under Mako.
         For more information on mako escape options - http://www.makotemplates.org/docs/filtering.html
+
+        The last render of each mode is kept, and returned again until the
+        writer's data is changed. The writer stores copies of the dicts passed
+        to `add_transaction` and `add_transaction_item`, so altering those
+        dicts afterwards has no effect.
+
+        If the config has an `instrumentation` callable, it is called with a
+        report of every render, a dict of:
+
+            mode, account_id
+            cached = ``True`` if the render was reused, not generated
+            duration = the seconds spent in `render`
+            sections = a dict of the seconds spent generating each section:
+                       `dimensions`, `transactions`, `items`, `events`, and
+                       `bootstrap` for everything else
+            bytes = the size of the render, encoded as UTF-8
+            lines = the number of lines rendered
+            invalid = the number of invalid tags rendered
+            records = a dict of the number of `accounts`, `dimensions`,
+                      `metrics`, `events`, `transactions` and `items`
         """
-        if (mode is not None) and (mode not in AnalyticsMode._valid_modes):
-            raise ValueError("invalid mode")
-        mode = mode if mode is not None else self.mode
-        if mode == AnalyticsMode.GA_JS:
-            return self._render__ga_js()
-        elif mode == AnalyticsMode.ANALYTICS:
-            return self._render__analytics(render_async=True)
-        elif mode == AnalyticsMode.GTAG:
-            return self._render__gtag()
-        elif mode == AnalyticsMode.AMP:
-            return self._render__amp()
-        return "<!-- unsupported AnalyticsMode -->"
+        if self._config.instrumentation is not None:
+            return self._render_instrumented(mode)
+        (plan, rendered) = self._render_prepare(mode)
+        if rendered is not None:
+            return rendered
+        return self._render_plan(plan)
+
+    def _render_section(self, section, builder, *args):
+        """
+        returns `builder(*args)`.
+
+        During an instrumented render, the builder is run to completion by the
+        render's `_SectionTimer`, which charges the time to `section`.
+        """
+        timer = self._timer
+        if timer is None:
+            return builder(*args)
+        return timer.run(section, builder, *args)
+
+    def _render_plan(self, plan, data_fingerprint=None, timer=None):
+        """
+        renders `plan`, using the `RenderCache` if one is configured.
+
+        If a `_SectionTimer` is provided, the time spent generating each
+        section is recorded on it; nothing is recorded if the render was cached.
+        """
+        rendered = None
+        cache = self._config.render_cache
+        key = None
+        if cache is not None:
+            key = self._render_cache_key(plan, data_fingerprint=data_fingerprint)
+        if key is not None:
+            rendered = cache.get(key)
+        if rendered is None:
+            if timer is None:
+                rendered = u"""\n""".join(self._render_lines(plan))
+            else:
+                # everything outside of a section is charged to `bootstrap`
+                self._timer = timer
+                try:
+                    lines = timer.run("bootstrap", self._render_lines, plan)
+                finally:
+                    self._timer = None
+                rendered = u"""\n""".join(lines)
+            if key is not None:
+                cache.set(key, rendered)
+        self._render_memo_set(plan, rendered)
+        return rendered
+
+    def _render_instrumented(self, mode, data_fingerprint=None, refresh=True):
+        """
+        renders `mode`, then hands a report of the render to the config's
+        `instrumentation` callable. Errors in the callable are logged.
+        """
+        start = _perf_counter()
+        (plan, rendered) = self._render_prepare(mode, refresh=refresh)
+        timer = _SectionTimer()
+        if rendered is None:
+            rendered = self._render_plan(
+                plan, data_fingerprint=data_fingerprint, timer=timer
+            )
+        duration = _perf_counter() - start
+        data = self._get_data_render()
+        report = {
+            "mode": plan.mode,
+            "account_id": plan.account_id,
+            "cached": not timer.sections,
+            "duration": duration,
+            "sections": timer.sections,
+            "bytes": len(rendered.encode("utf-8")),
+            "lines": rendered.count(u"""\n""") + 1,
+            # "invalid transaction" also matches invalid items
+            "invalid": rendered.count("invalid transaction")
+            + rendered.count("incompatible event"),
+            "records": {
+                "accounts": 1 + len(data.additional_accounts),
+                "dimensions": len(data.custom_dimensions),
+                "metrics": len(data.custom_metrics),
+                "events": len(data.tracked_events),
+                "transactions": len(data.transaction),
+                "items": sum(len(v) for v in data.transaction_items.values()),
+            },
+        }
+        try:
+            self._config.instrumentation(report)
+        except Exception as exc:
+            log.exception("g_analytics_writer.instrumentation: %s", exc)
+        return rendered
+
+    def render_many(self, modes=None):
+        """
+        renders the writer in several modes, e.g. a canonical page and its AMP
+        variant; `modes` defaults to every supported mode.
+
+        returns an `OrderedDict` of `{mode: render}`, in the order of `modes`.
+
+        Every mode is validated before anything is rendered. The recorded
+        transactions and items are validated once for all modes, and the data
+        is fingerprinted once for the `RenderCache`.
+        """
+        if modes is None:
+            modes = AnalyticsMode._valid_modes
+        for mode in modes:
+            if mode not in AnalyticsMode._valid_modes:
+                raise ValueError("invalid mode")
+        self._refresh_data()
+        data = self._get_data_render()
+        for transaction_id in data.transaction:
+            data.transaction_api_modes(transaction_id)
+        for transaction_id in data.transaction_items:
+            data.transaction_item_api_modes(transaction_id)
+        data_fingerprint = None
+        if (self._config.render_cache is not None) and not self._is_pageview_only():
+            data_fingerprint = self._render_data_fingerprint()
+        renders = OrderedDict()
+        for mode in modes:
+            if mode in renders:
+                continue
+            if self._config.instrumentation is not None:
+                renders[mode] = self._render_instrumented(
+                    mode, data_fingerprint=data_fingerprint, refresh=False
+                )
+                continue
+            # the data was refreshed above
+            (plan, rendered) = self._render_prepare(mode, refresh=False)
+            if rendered is None:
+                rendered = self._render_plan(plan, data_fingerprint=data_fingerprint)
+            renders[mode] = rendered
+        return renders
+
+    def iter_render(self, mode=None):
+        """
+        yields the output of `render` as a series of text fragments, in order.
+        joined together, the fragments are identical to `render`.
+
+        Lines are generated as they are yielded, so a large render (such as an
+        ecommerce confirmation with hundreds of items) is never held in memory
+        as a single string. The writer's data should not be altered until the
+        iteration is exhausted.
+
+        This can be used for a streaming template; `iter_render_bytes` is
+        suitable for a WSGI iterable.
+        """
+        (plan, rendered) = self._render_prepare(mode)
+        if (rendered is None) and (self._config.render_cache is not None):
+            key = self._render_cache_key(plan)
+            if key is not None:
+                rendered = self._config.render_cache.get(key)
+        if rendered is not None:
+            return iter((rendered,))
+        return _iter_fragments(self._render_lines(plan))
+
+    def iter_render_bytes(self, mode=None, encoding="utf-8"):
+        """
+        yields the output of `render` as a series of `bytes` fragments, in
+        order. This is suitable as a WSGI iterable.
+        """
+        for fragment in self.iter_render(mode=mode):
+            yield fragment.encode(encoding)
+
+    def render_bytes(self, mode=None, encoding="utf-8"):
+        """
+        returns the output of `render` as `bytes`
+        """
+        return self.render(mode=mode).encode(encoding)
+
+    def render_to(self, stream, mode=None, encoding=None):
+        """
+        writes the output of `render` to `stream`, which must have a `write`
+        method that accepts text, such as a template buffer or `io.StringIO`.
+
+        If `encoding` is provided, `bytes` are written instead; e.g. to a
+        socket file or `io.BytesIO`.
+        """
+        write = stream.write
+        if encoding is None:
+            fragments = self.iter_render(mode=mode)
+        else:
+            fragments = self.iter_render_bytes(mode=mode, encoding=encoding)
+        for fragment in fragments:
+            write(fragment)
 
     def render_head(self, mode=None):
         """
@@ -2101,15 +3851,20 @@ m=s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m)
         """
         if (mode is not None) and (mode not in AnalyticsMode._valid_modes):
             raise ValueError("invalid mode")
-        mode = mode if mode is not None else self.mode
-        if mode == AnalyticsMode.AMP:
-            if self.amp_clientid_integration:
-                return """<meta name="amp-google-client-id-api" content="googleanalytics">\n<script async custom-element="amp-analytics" src="https://cdn.ampproject.org/v0/amp-analytics-0.1.js"></script>"""
-            return """<script async custom-element="amp-analytics" src="https://cdn.ampproject.org/v0/amp-analytics-0.1.js"></script>"""
-        return ""  # no head
+        mode = mode if mode is not None else self._config.mode
+        return self._get_render_plan(mode).head_html
 
 
 # ==============================================================================
 
 
-__all__ = ("AnalyticsWriter", "AnalyticsMode")
+__all__ = (
+    "AnalyticsWriter",
+    "AnalyticsMode",
+    "Event",
+    "WriterConfig",
+    "RenderCache",
+    "MetricsRegistry",
+    "ItemColumns",
+    "get_json_encoder",
+)
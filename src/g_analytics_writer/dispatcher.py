@@ -0,0 +1,430 @@
+"""
+Background delivery of Measurement Protocol hits.
+
+A `HitDispatcher` queues hits in memory and sends them from a background
+thread, in batches, over persistent HTTP connections; request threads only
+append to the queue and never block on network I/O.
+"""
+import os
+import socket
+import threading
+import time
+
+import six
+from six.moves import http_client
+from six.moves import queue
+from six.moves.urllib.parse import urlsplit
+
+from . import measurement_protocol
+
+# logging
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# ==============================================================================
+
+
+# placed on the queue by `close` to stop a worker
+_STOP = object()
+
+# raised by a pooled connection which the server closed while it was idle
+_STALE_ERRORS = (http_client.BadStatusLine, socket.error)
+
+
+class ConnectionPool(object):
+    """
+    A small pool of persistent `http_client` connections to one endpoint.
+
+    Connections are created on demand, reused after a successful request, and
+    discarded after an error. A request which fails on an idle connection,
+    which the server may have closed, is retried once on a new connection.
+    """
+
+    def __init__(self, endpoint, size=1, timeout=5.0):
+        parsed = urlsplit(endpoint)
+        if parsed.scheme not in ("http", "https"):
+            raise ValueError("`endpoint` must be a http or https url")
+        self.endpoint = endpoint
+        self.size = size
+        self.timeout = timeout
+        self._host = parsed.netloc
+        self._path = parsed.path or "/"
+        if parsed.query:
+            self._path = "%s?%s" % (self._path, parsed.query)
+        self._connection_class = (
+            http_client.HTTPSConnection
+            if parsed.scheme == "https"
+            else http_client.HTTPConnection
+        )
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _get(self):
+        """
+        returns a tuple of `(connection, reused)`
+        """
+        with self._lock:
+            if self._idle:
+                return (self._idle.pop(), True)
+        return (self._connection_class(self._host, timeout=self.timeout), False)
+
+    def _put(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def post(self, body, headers=None):
+        """
+        posts `body` to the endpoint and returns the response status.
+        raises any network error, after discarding the connection.
+        """
+        if isinstance(body, six.text_type):
+            body = body.encode("utf-8")
+        (connection, reused) = self._get()
+        try:
+            status = self._request(connection, body, headers)
+        except _STALE_ERRORS as exc:
+            if (not reused) or isinstance(exc, socket.timeout):
+                raise
+            log.debug("g_analytics_writer.dispatcher: stale connection: %s", exc)
+            connection = self._connection_class(self._host, timeout=self.timeout)
+            status = self._request(connection, body, headers)
+        self._put(connection)
+        return status
+
+    def _request(self, connection, body, headers):
+        """
+        posts `body` on `connection` and returns the response status.
+        raises any network error, after closing the connection.
+        """
+        try:
+            connection.request("POST", self._path, body, headers or {})
+            response = connection.getresponse()
+            # the response must be read before the connection is reused
+            response.read()
+        except Exception:
+            connection.close()
+            raise
+        return response.status
+
+    def close(self):
+        """closes every idle connection"""
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection in idle:
+            connection.close()
+
+
+class HitDispatcher(object):
+    """
+    Queues Measurement Protocol hits and sends them in batches from a
+    background thread.
+
+    kwargs:
+        endpoint = the url hits are posted to; defaults to the Measurement
+                   Protocol `BATCH_URL`. Tests and staging can point this at a
+                   local server.
+        batch_size = the maximum hits per request; the api accepts 20.
+        flush_interval = the maximum seconds a hit waits for a batch to fill.
+        max_queue = the maximum queued hits; hits are dropped once it is full,
+                    so memory use stays bounded if the endpoint is down.
+                    Hits larger than `HIT_MAX_BYTES` are dropped as well.
+        timeout = the socket timeout of a request, in seconds.
+        workers = the number of background threads (and pooled connections).
+        spool = an optional `DiskSpool`. Queued hits are then written to the
+                spool by one thread and sent from it by another, so hits are
+                kept on disk, rather than dropped, while the endpoint is slow
+                or down. Hits left in the spool by a previous process are
+                replayed. `workers` must be 1.
+                A spool can only be used by the process which opened it; if
+                the dispatcher is created before a fork, pass a callable which
+                returns a `DiskSpool` instead (e.g. a `functools.partial` of
+                `DiskSpool.for_process`), and it is called in each process.
+        retry_interval = with a `spool`, the initial seconds to wait before
+                         retrying a failed request; this doubles up to 60
+                         seconds.
+
+    Threads are started on the first `enqueue`, and restarted after a fork.
+    """
+
+    def __init__(
+        self,
+        endpoint=measurement_protocol.BATCH_URL,
+        batch_size=measurement_protocol.BATCH_MAX_HITS,
+        flush_interval=1.0,
+        max_queue=10000,
+        timeout=5.0,
+        workers=1,
+        spool=None,
+        retry_interval=1.0,
+    ):
+        if not 0 < batch_size <= measurement_protocol.BATCH_MAX_HITS:
+            raise ValueError(
+                "`batch_size` must be between 1 and %s"
+                % measurement_protocol.BATCH_MAX_HITS
+            )
+        if workers < 1:
+            raise ValueError("`workers` must be at least 1")
+        if (spool is not None) and (workers != 1):
+            raise ValueError("a `spool` requires exactly 1 worker")
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.workers = workers
+        self.pool = ConnectionPool(endpoint, size=workers, timeout=timeout)
+        self._spool_factory = None
+        if callable(spool):
+            self._spool_factory = spool
+            spool = None
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._threads = []
+        self._closed = False
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.requests = 0
+
+    def _ensure_started(self):
+        """starts the workers, once per process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._spool_factory is not None:
+                self.spool = self._spool_factory()
+            elif (self.spool is not None) and (self.spool.pid != os.getpid()):
+                raise ValueError(
+                    "the `spool` was opened by another process; pass a callable "
+                    "which opens it instead"
+                )
+            # a forked child inherits the queue, but not the threads; the
+            # queued hits are left to the parent
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._threads = []
+            if self.spool is None:
+                targets = [self._run] * self.workers
+            else:
+                self._spooled = threading.Event()
+                self._stopping = threading.Event()
+                targets = [self._run_spooler, self._run_sender]
+            for (idx, target) in enumerate(targets):
+                thread = threading.Thread(
+                    target=target, name="g_analytics_writer.dispatcher-%s" % idx
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+            self._pid = os.getpid()
+
+    def enqueue(self, hits):
+        """
+        queues `hits` (a list of Measurement Protocol hits) without blocking.
+        returns the number of hits which were dropped because the queue is full.
+        """
+        if self._closed:
+            raise ValueError("the dispatcher is closed")
+        self._ensure_started()
+        dropped = 0
+        for hit in hits:
+            try:
+                self._queue.put_nowait(hit)
+            except queue.Full:
+                dropped += 1
+        if dropped:
+            self._count("dropped", dropped)
+            log.error(
+                "g_analytics_writer.dispatcher: queue full, dropped %s hits", dropped
+            )
+        return dropped
+
+    def _count(self, counter, value):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def dispatch(self, writer, **kwargs):
+        """
+        builds the hits of `writer` with `measurement_protocol.build_hits` and
+        queues them. `kwargs` are passed to `build_hits`.
+        """
+        return self.enqueue(measurement_protocol.build_hits(writer, **kwargs))
+
+    def _next_batch(self, _queue):
+        """
+        blocks for a hit, then collects up to `batch_size` hits, waiting at
+        most `flush_interval` for more.
+        """
+        batch = [_queue.get()]
+        if batch[0] is _STOP:
+            return batch
+        try:
+            while len(batch) < self.batch_size:
+                hit = _queue.get(timeout=self.flush_interval)
+                batch.append(hit)
+                if hit is _STOP:
+                    break
+        except queue.Empty:
+            pass
+        return batch
+
+    def _post(self, body, count):
+        """posts a batch of `count` hits; returns `True` on success"""
+        try:
+            status = self.pool.post(
+                body, {"Content-Type": "application/x-www-form-urlencoded"}
+            )
+        except Exception as exc:
+            self._count("failed", count)
+            log.error("g_analytics_writer.dispatcher: %s", exc)
+            return False
+        self._count("requests", 1)
+        if 200 <= status < 300:
+            self._count("sent", count)
+            return True
+        self._count("failed", count)
+        log.error("g_analytics_writer.dispatcher: status %s", status)
+        return False
+
+    def _send(self, hits):
+        posted = 0
+        for body in measurement_protocol.iter_batches(hits, max_hits=self.batch_size):
+            count = body.count("\n") + 1
+            self._post(body, count)
+            posted += count
+        if posted < len(hits):
+            # `iter_batches` skips hits larger than `HIT_MAX_BYTES`
+            self._count("dropped", len(hits) - posted)
+
+    def _run(self):
+        _queue = self._queue
+        while True:
+            batch = self._next_batch(_queue)
+            stop = batch[-1] is _STOP
+            hits = batch[:-1] if stop else batch
+            try:
+                if hits:
+                    self._send(hits)
+            finally:
+                for _hit in batch:
+                    _queue.task_done()
+            if stop:
+                return
+
+    def _run_spooler(self):
+        """moves queued hits to the spool"""
+        _queue = self._queue
+        while True:
+            batch = self._next_batch(_queue)
+            stop = batch[-1] is _STOP
+            hits = batch[:-1] if stop else batch
+            oversize = 0
+            try:
+                records = []
+                for hit in hits:
+                    _encoded = measurement_protocol.encode_hit(hit)
+                    if len(_encoded) > measurement_protocol.HIT_MAX_BYTES:
+                        # the api rejects these; spooling them would only
+                        # fail their batch
+                        oversize += 1
+                        continue
+                    records.append(_encoded)
+                if oversize:
+                    self._count("dropped", oversize)
+                    log.error(
+                        "g_analytics_writer.dispatcher: spool: dropped %s hits "
+                        "larger than `HIT_MAX_BYTES`",
+                        oversize,
+                    )
+                self.spool.append(records)
+            except Exception as exc:
+                self._count("dropped", len(hits) - oversize)
+                log.error("g_analytics_writer.dispatcher: spool: %s", exc)
+            finally:
+                for _hit in batch:
+                    _queue.task_done()
+            self._spooled.set()
+            if stop:
+                self.spool.sync()
+                self._stopping.set()
+                self._spooled.set()
+                return
+
+    def _run_sender(self):
+        """sends hits from the spool, oldest first"""
+        retry = 0
+        while True:
+            (records, token) = self.spool.read(
+                self.batch_size, measurement_protocol.BATCH_MAX_BYTES
+            )
+            if not records:
+                if self._stopping.is_set():
+                    return
+                self._spooled.wait(self.flush_interval)
+                self._spooled.clear()
+                continue
+            if self._post("\n".join(records), len(records)):
+                self.spool.commit(token)
+                retry = 0
+                continue
+            # the records stay in the spool; back off, unless stopping
+            if self._stopping.is_set():
+                return
+            self._stopping.wait(min(self.retry_interval * (2 ** retry), 60))
+            retry += 1
+
+    def flush(self, timeout=None):
+        """
+        blocks until every queued hit has been sent (or has failed).
+        with a `spool`, this waits until the spool is drained, or `timeout`.
+        """
+        if self._queue is None or self._pid != os.getpid():
+            return
+        self._queue.join()
+        if self.spool is not None:
+            deadline = None if timeout is None else time.time() + timeout
+            while self.spool.pending():
+                if deadline is not None and time.time() > deadline:
+                    break
+                time.sleep(0.01)
+
+    def close(self, timeout=None):
+        """
+        sends the queued hits, then stops the workers and closes the
+        connections. the dispatcher can not be used afterwards.
+        """
+        self._closed = True
+        if self._queue is not None and self._pid == os.getpid():
+            for _thread in self._threads:
+                self._queue.put(_STOP)
+            for _thread in self._threads:
+                _thread.join(timeout)
+        self.pool.close()
+        if (self.spool is not None) and (self.spool.pid == os.getpid()):
+            self.spool.close()
+
+    def stats(self):
+        """returns a dict of the dispatcher's counters"""
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "requests": self.requests,
+            "spooled_bytes": self.spool.pending() if self.spool is not None else 0,
+        }
+
+
+__all__ = (
+    "ConnectionPool",
+    "HitDispatcher",
+)
@@ -0,0 +1,286 @@
+"""
+Server-side hits for the (Universal Analytics) Measurement Protocol.
+
+The data recorded on an `AnalyticsWriter` can only become client-side
+javascript through `render`. This module builds the same data into
+Measurement Protocol hits, which the server can send on behalf of clients
+that never run javascript (bots, no-js clients, api calls).
+
+Fields are translated with `translation_matrix` into their `analytics.js`
+names, then into Measurement Protocol parameters with `parameter_matrix`.
+Transactions and items are validated with `field_requirements`, exactly as
+they are for an `analytics.js` render.
+
+Docs:
+    https://developers.google.com/analytics/devguides/collection/protocol/v1/parameters
+"""
+from collections import OrderedDict
+
+import six
+from six.moves.urllib.parse import urlencode
+
+from . import AnalyticsMode
+from . import iter_api_dicts
+from . import source_dict_to_api_dict
+
+# logging
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# ==============================================================================
+
+
+MEASUREMENT_PROTOCOL_VERSION = "1"
+COLLECT_URL = "https://www.google-analytics.com/collect"
+BATCH_URL = "https://www.google-analytics.com/batch"
+
+# limits of the api
+HIT_MAX_BYTES = 8192
+BATCH_MAX_HITS = 20
+BATCH_MAX_BYTES = 16384
+
+
+# maps the `analytics.js` api fields of `translation_matrix` to Measurement
+# Protocol parameters. `analytics.js` fields which are not listed here (e.g. a
+# transaction's `city`) have no equivalent and are not sent.
+parameter_matrix = {
+    "*event": {
+        "eventCategory": "ec",
+        "eventAction": "ea",
+        "eventLabel": "el",
+        "eventValue": "ev",
+        "nonInteraction": "ni",
+    },
+    "*transaction": {
+        "id": "ti",
+        "affiliation": "ta",
+        "revenue": "tr",
+        "tax": "tt",
+        "shipping": "ts",
+        "coupon": "tcc",
+    },
+    "*transaction_item": {
+        "id": "ti",
+        "name": "in",
+        "sku": "ic",
+        "category": "iv",
+        "price": "ip",
+        "quantity": "iq",
+    },
+}
+
+
+def _format_value(value):
+    """formats a value as a Measurement Protocol parameter"""
+    if value is True:
+        return "1"
+    if value is False:
+        return "0"
+    if isinstance(value, six.text_type):
+        return value
+    return six.text_type(value)
+
+
+def api_dict_to_parameters(api_dict, api_concept):
+    """
+    translates an `analytics.js` api dict into a list of `(parameter, value)`
+    tuples for `api_concept`, in a stable order.
+    """
+    _parameters = parameter_matrix[api_concept]
+    return [
+        (_parameters[k], _format_value(api_dict[k]))
+        for k in sorted(api_dict.keys())
+        if k in _parameters
+    ]
+
+
+def client_id_from_cookie(value):
+    """
+    returns the client id of an `analytics.js` `_ga` cookie, or `None`.
+
+    The cookie is formatted as `GA1.{domain depth}.{random}.{timestamp}`; the
+    client id is the last two fields.
+    """
+    if not value:
+        return None
+    parts = value.split(".")
+    if len(parts) < 4:
+        return None
+    return ".".join(parts[-2:])
+
+
+def build_hits(
+    writer,
+    client_id=None,
+    document_location=None,
+    document_host=None,
+    document_path=None,
+    document_title=None,
+    user_agent=None,
+    ip_override=None,
+):
+    """
+    builds the data recorded on `writer` into a list of Measurement Protocol
+    hits. Each hit is an `OrderedDict` of `{parameter: value}`.
+
+    The hits of each account (the primary, then any additional accounts) are
+    ordered like an `analytics.js` render: the pageview, then the
+    transactions and their items, then the events. Custom dimensions and
+    metrics are sent with every hit if the writer's `global_custom_data` is
+    enabled, otherwise only with the pageview.
+
+    Invalid transactions, items and events are skipped.
+
+    args:
+        writer = the `AnalyticsWriter`
+        client_id = the `cid`, usually read from the `_ga` cookie. A
+                    `client_id` is required, unless a `user_id` is set on the
+                    writer.
+        document_location, document_host, document_path, document_title
+            = the `dl`, `dh`, `dp` and `dt` of the pageview
+        user_agent = the `ua` of the client
+        ip_override = the `uip` of the client
+    """
+    writer._refresh_data()
+    data = writer._get_data_render()
+    if not client_id and not data.user_id:
+        raise ValueError("a `client_id` or a `user_id` is required")
+
+    common = []
+    if client_id:
+        common.append(("cid", _format_value(client_id)))
+    if data.user_id:
+        common.append(("uid", _format_value(data.user_id)))
+    if user_agent:
+        common.append(("ua", user_agent))
+    if ip_override:
+        common.append(("uip", ip_override))
+
+    custom_data = []
+    for index in sorted(data.custom_dimensions.keys()):
+        _payload = data.custom_dimensions[index]
+        if not _payload:
+            continue
+        custom_data.append(("cd%s" % index, _format_value(_payload[1])))
+    for index in sorted(data.custom_metrics.keys()):
+        _payload = data.custom_metrics[index]
+        if not _payload:
+            continue
+        custom_data.append(("cm%s" % index, _format_value(_payload[1])))
+    if writer._config.global_custom_data:
+        common.extend(custom_data)
+        custom_data = []
+
+    # the account-independent hits are only computed once
+    hits = []
+
+    pageview = [("t", "pageview")]
+    for (_parameter, _value) in (
+        ("dl", document_location),
+        ("dh", document_host),
+        ("dp", document_path),
+        ("dt", document_title),
+    ):
+        if _value:
+            pageview.append((_parameter, _value))
+    pageview.extend(custom_data)
+    hits.append(pageview)
+
+    for transaction_id in data.transaction.keys():
+        if AnalyticsMode.ANALYTICS not in data.transaction_api_modes(transaction_id):
+            log.debug("skipping invalid transaction: %s", transaction_id)
+            continue
+        _transaction_clean = source_dict_to_api_dict(
+            data.transaction[transaction_id], "*transaction", AnalyticsMode.ANALYTICS
+        )
+        hits.append(
+            [("t", "transaction")]
+            + api_dict_to_parameters(_transaction_clean, "*transaction")
+        )
+        if transaction_id not in data.transaction_items:
+            continue
+        for (_item_clean, _item_modes) in zip(
+            iter_api_dicts(
+                data.transaction_items[transaction_id],
+                "*transaction_item",
+                AnalyticsMode.ANALYTICS,
+            ),
+            data.transaction_item_api_modes(transaction_id),
+        ):
+            if AnalyticsMode.ANALYTICS not in _item_modes:
+                log.debug("skipping invalid transaction item: %s", transaction_id)
+                continue
+            hits.append(
+                [("t", "item")]
+                + api_dict_to_parameters(_item_clean, "*transaction_item")
+            )
+
+    for _event in data.tracked_events:
+        # the `Event` was validated when it was tracked
+        if not _event.has_category_action:
+            log.debug("skipping incompatible event: %r", _event)
+            continue
+        hits.append(
+            [("t", "event")]
+            + api_dict_to_parameters(
+                _event.api_dict(AnalyticsMode.ANALYTICS), "*event"
+            )
+        )
+
+    rval = []
+    for account_id in [writer._account_id] + list(data.additional_accounts):
+        prefix = [("v", MEASUREMENT_PROTOCOL_VERSION), ("tid", account_id)] + common
+        for _hit in hits:
+            rval.append(OrderedDict(prefix + _hit))
+    return rval
+
+
+def encode_hit(hit):
+    """
+    encodes a hit into the body of a `COLLECT_URL` request, as a native string
+    """
+    return urlencode(
+        [
+            (k, v.encode("utf-8") if isinstance(v, six.text_type) else v)
+            for (k, v) in hit.items()
+        ]
+    )
+
+
+def iter_batches(hits, max_hits=BATCH_MAX_HITS, max_bytes=BATCH_MAX_BYTES):
+    """
+    encodes `hits` into the bodies of `BATCH_URL` requests; each body holds
+    at most `max_hits` hits (one per line) and `max_bytes` bytes.
+
+    Hits larger than `HIT_MAX_BYTES` are rejected by the api; they are logged
+    and skipped.
+    """
+    batch = []
+    batch_bytes = 0
+    for hit in hits:
+        encoded = encode_hit(hit)
+        if len(encoded) > HIT_MAX_BYTES:
+            log.error("skipping hit larger than `HIT_MAX_BYTES`: %s", encoded[:64])
+            continue
+        encoded_bytes = len(encoded) + 1  # the line break
+        if batch and (
+            (len(batch) >= max_hits) or (batch_bytes + encoded_bytes > max_bytes)
+        ):
+            yield "\n".join(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(encoded)
+        batch_bytes += encoded_bytes
+    if batch:
+        yield "\n".join(batch)
+
+
+__all__ = (
+    "build_hits",
+    "client_id_from_cookie",
+    "encode_hit",
+    "iter_batches",
+    "parameter_matrix",
+)
@@ -0,0 +1,247 @@
+"""
+Framework-agnostic integration via WSGI middleware.
+
+`WSGIMiddleware` creates an `AnalyticsWriter` from a shared `WriterConfig` for
+every request and exposes it in the environ. The writer's markup is spliced
+into `text/html` 200 responses as they stream through, without buffering the
+body, and the data of writers which were never rendered can be handed to a
+`HitDispatcher`.
+
+The ASGI equivalent is `g_analytics_writer.middleware_asgi.ASGIMiddleware`;
+both share `StreamInjector`.
+"""
+from six.moves.http_cookies import SimpleCookie
+
+from . import AnalyticsMode
+from . import AnalyticsWriter
+from . import measurement_protocol
+
+# logging
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# ==============================================================================
+
+
+_TAG_HEAD = b"</head>"
+_TAG_BODY = b"</body>"
+
+
+def parse_content_type(content_type):
+    """returns a tuple of `(media_type, charset)`; `charset` may be `None`"""
+    if not content_type:
+        return (None, None)
+    parts = content_type.split(";")
+    charset = None
+    for part in parts[1:]:
+        (key, _, value) = part.strip().partition("=")
+        if key.lower() == "charset":
+            charset = value.strip().strip('"')
+    return (parts[0].strip().lower(), charset)
+
+
+def should_inject(status_code, content_type, content_encoding):
+    """``True`` if the writer's markup can be spliced into the response"""
+    if status_code != 200 or content_encoding:
+        return False
+    return parse_content_type(content_type)[0] == "text/html"
+
+
+def client_id_from_cookie_header(cookie_header):
+    """returns the client id of the `_ga` cookie in a `Cookie` header"""
+    if not cookie_header:
+        return None
+    cookies = SimpleCookie()
+    try:
+        cookies.load(cookie_header)
+    except Exception:
+        return None
+    if "_ga" not in cookies:
+        return None
+    return measurement_protocol.client_id_from_cookie(cookies["_ga"].value)
+
+
+class StreamInjector(object):
+    """
+    Splices a writer's markup into a streamed HTML body.
+
+    `render_head()` is placed before `</head>`. `render()` is placed before
+    `</head>`, or before `</body>` if `placement` is `body`; AMP renders are
+    always placed in the body. If a page placing `render()` in the body has no
+    `</head>`, the `render_head()` markup is placed before `</body>` with it.
+    Tags are matched case-insensitively. The writer is only rendered once its
+    tag is found. Chunks are passed through as they arrive, except for a few
+    trailing bytes which are held back in case a tag spans two chunks.
+    """
+
+    def __init__(self, writer, placement="head", charset=None):
+        self.writer = writer
+        self.charset = charset or "utf-8"
+        in_body = (placement == "body") or (writer.mode == AnalyticsMode.AMP)
+        # a list of `(tag, callable)`, in the order the tags are expected
+        self._targets = []
+        if in_body:
+            if writer.render_head():
+                self._targets.append((_TAG_HEAD, writer.render_head))
+            self._targets.append((_TAG_BODY, writer.render))
+        else:
+            self._targets.append((_TAG_HEAD, self._render_head_and_body))
+        self._carry = b""
+
+    def _render_head_and_body(self):
+        head_html = self.writer.render_head()
+        if head_html:
+            return u"""%s\n%s""" % (head_html, self.writer.render())
+        return self.writer.render()
+
+    def feed(self, chunk):
+        """returns the bytes of `chunk` which can be sent"""
+        if not self._targets:
+            return chunk
+        data = self._carry + chunk if self._carry else chunk
+        # tags are matched case-insensitively; `lower()` only changes ASCII
+        # letters, so offsets into `data_lower` are offsets into `data`
+        data_lower = data.lower()
+        output = []
+        while self._targets:
+            idx = data_lower.find(self._targets[0][0])
+            count = 1
+            if (idx == -1) and (len(self._targets) > 1):
+                # the body ended without a `</head>`; every markup goes there
+                idx = data_lower.find(self._targets[-1][0])
+                count = len(self._targets)
+            if idx == -1:
+                break
+            output.append(data[:idx])
+            for (tag, markup) in self._targets[:count]:
+                output.append(markup().encode(self.charset) + b"\n")
+            data = data[idx:]
+            data_lower = data_lower[idx:]
+            del self._targets[:count]
+        if self._targets:
+            # hold back enough to find a tag spanning the next chunk
+            keep = len(self._targets[0][0]) - 1
+            self._carry = data[-keep:]
+            output.append(data[:-keep])
+        else:
+            self._carry = b""
+            output.append(data)
+        return b"".join(output)
+
+    def finish(self):
+        """returns the bytes held back, once the body is complete"""
+        carry = self._carry
+        self._carry = b""
+        self._targets = []
+        return carry
+
+
+class WSGIMiddleware(object):
+    """
+    args/kwargs:
+        app = the WSGI application
+        account_id = the primary account id
+        config = a `WriterConfig` shared by every writer
+        environ_key = the environ key of the request's writer
+        inject = splice the writer's markup into `text/html` 200 responses
+        placement = `head` or `body`, see `StreamInjector`
+        dispatcher = an optional `HitDispatcher`; the data of writers which
+                     were never rendered is sent to it once the response is
+                     complete
+    """
+
+    def __init__(
+        self,
+        app,
+        account_id,
+        config=None,
+        environ_key="g_analytics_writer",
+        inject=True,
+        placement="head",
+        dispatcher=None,
+    ):
+        if placement not in ("head", "body"):
+            raise ValueError("`placement` must be `head` or `body`")
+        self.app = app
+        self.account_id = account_id
+        self.config = config
+        self.environ_key = environ_key
+        self.inject = inject
+        self.placement = placement
+        self.dispatcher = dispatcher
+
+    def __call__(self, environ, start_response):
+        writer = AnalyticsWriter(self.account_id, config=self.config)
+        environ[self.environ_key] = writer
+        state = {}
+
+        def _start_response(status, headers, exc_info=None):
+            if self.inject:
+                _headers = dict((k.lower(), v) for (k, v) in headers)
+                if should_inject(
+                    int(status.split(" ", 1)[0]),
+                    _headers.get("content-type"),
+                    _headers.get("content-encoding"),
+                ):
+                    # the length changes; the body is streamed instead
+                    headers = [
+                        (k, v) for (k, v) in headers if k.lower() != "content-length"
+                    ]
+                    state["injector"] = StreamInjector(
+                        writer,
+                        placement=self.placement,
+                        charset=parse_content_type(_headers["content-type"])[1],
+                    )
+            return start_response(status, headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+        return self._iter_response(environ, writer, app_iter, state)
+
+    def _iter_response(self, environ, writer, app_iter, state):
+        try:
+            for chunk in app_iter:
+                injector = state.get("injector")
+                if injector is not None:
+                    chunk = injector.feed(chunk)
+                if chunk:
+                    yield chunk
+            injector = state.get("injector")
+            if injector is not None:
+                chunk = injector.finish()
+                if chunk:
+                    yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            self.dispatch_unrendered(environ, writer)
+
+    def dispatch_unrendered(self, environ, writer):
+        """
+        queues the data of a writer which was never rendered on the
+        `dispatcher`. `HitDispatcher.enqueue` does not block, and this is only
+        called once the response is complete.
+        """
+        if self.dispatcher is None or writer.rendered or not writer.has_data:
+            return
+        client_id = client_id_from_cookie_header(environ.get("HTTP_COOKIE"))
+        if not client_id and not writer.data_struct["*user_id"]:
+            return
+        try:
+            self.dispatcher.dispatch(
+                writer,
+                client_id=client_id,
+                document_host=environ.get("HTTP_HOST"),
+                document_path=environ.get("PATH_INFO"),
+                user_agent=environ.get("HTTP_USER_AGENT"),
+                ip_override=environ.get("REMOTE_ADDR"),
+            )
+        except Exception as exc:
+            log.exception("g_analytics_writer.middleware: %s", exc)
+
+
+__all__ = (
+    "StreamInjector",
+    "WSGIMiddleware",
+)
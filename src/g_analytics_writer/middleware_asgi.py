@@ -0,0 +1,140 @@
+"""
+Framework-agnostic integration via ASGI middleware; this requires Python 3.
+
+`ASGIMiddleware` is the ASGI equivalent of
+`g_analytics_writer.middleware.WSGIMiddleware`: the request's writer is
+exposed in the scope, its markup is spliced into streamed `text/html` 200
+responses, and the data of writers which were never rendered is handed to a
+`HitDispatcher` on the event loop's default executor.
+"""
+import asyncio
+
+from . import AnalyticsWriter
+from .middleware import StreamInjector
+from .middleware import client_id_from_cookie_header
+from .middleware import parse_content_type
+from .middleware import should_inject
+
+# logging
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# ==============================================================================
+
+
+class ASGIMiddleware(object):
+    """
+    args/kwargs:
+        app = the ASGI application
+        account_id = the primary account id
+        config = a `WriterConfig` shared by every writer
+        scope_key = the scope key of the request's writer
+        inject = splice the writer's markup into `text/html` 200 responses
+        placement = `head` or `body`, see `StreamInjector`
+        dispatcher = an optional `HitDispatcher`; the data of writers which
+                     were never rendered is sent to it once the response is
+                     complete, without blocking the event loop
+    """
+
+    def __init__(
+        self,
+        app,
+        account_id,
+        config=None,
+        scope_key="g_analytics_writer",
+        inject=True,
+        placement="head",
+        dispatcher=None,
+    ):
+        if placement not in ("head", "body"):
+            raise ValueError("`placement` must be `head` or `body`")
+        self.app = app
+        self.account_id = account_id
+        self.config = config
+        self.scope_key = scope_key
+        self.inject = inject
+        self.placement = placement
+        self.dispatcher = dispatcher
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        writer = AnalyticsWriter(self.account_id, config=self.config)
+        scope[self.scope_key] = writer
+        injector = None
+
+        async def _send(message):
+            nonlocal injector
+            if message["type"] == "http.response.start":
+                if self.inject:
+                    headers = dict(
+                        (k.decode("latin-1").lower(), v.decode("latin-1"))
+                        for (k, v) in message.get("headers", ())
+                    )
+                    if should_inject(
+                        message["status"],
+                        headers.get("content-type"),
+                        headers.get("content-encoding"),
+                    ):
+                        # the length changes; the body is streamed instead
+                        message = dict(message)
+                        message["headers"] = [
+                            (k, v)
+                            for (k, v) in message.get("headers", ())
+                            if k.lower() != b"content-length"
+                        ]
+                        injector = StreamInjector(
+                            writer,
+                            placement=self.placement,
+                            charset=parse_content_type(headers["content-type"])[1],
+                        )
+            elif message["type"] == "http.response.body" and injector is not None:
+                body = injector.feed(message.get("body", b""))
+                if not message.get("more_body", False):
+                    body += injector.finish()
+                message = dict(message)
+                message["body"] = body
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            self.dispatch_unrendered(scope, writer)
+
+    def dispatch_unrendered(self, scope, writer):
+        """
+        hands the data of a writer which was never rendered to the
+        `dispatcher`, on the event loop's default executor
+        """
+        if self.dispatcher is None or writer.rendered or not writer.has_data:
+            return
+        headers = dict(
+            (k.decode("latin-1").lower(), v.decode("latin-1"))
+            for (k, v) in scope.get("headers", ())
+        )
+        client_id = client_id_from_cookie_header(headers.get("cookie"))
+        if not client_id and not writer.data_struct["*user_id"]:
+            return
+        client = scope.get("client")
+        kwargs = dict(
+            client_id=client_id,
+            document_host=headers.get("host"),
+            document_path=scope.get("path"),
+            user_agent=headers.get("user-agent"),
+            ip_override=client[0] if client else None,
+        )
+        future = asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.dispatcher.dispatch(writer, **kwargs)
+        )
+        future.add_done_callback(_log_dispatch_error)
+
+
+def _log_dispatch_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error("g_analytics_writer.middleware_asgi: %s", future.exception())
+
+
+__all__ = ("ASGIMiddleware",)
@@ -1,6 +1,12 @@
 from . import AnalyticsWriter
 from . import AnalyticsMode
 from . import GtagDimensionsStrategy
+from . import RenderCache
+from . import WriterConfig
+from . import get_json_encoder
+from . import measurement_protocol
+
+import functools
 
 from pyramid.settings import asbool
 
@@ -77,10 +83,301 @@ def includeme(config):
             json_dumps_callable = config.name_resolver.resolve(json_dumps_callable)
         kwargs["json_dumps_callable"] = json_dumps_callable
 
+    """
+    :json_encoder
+    selects a `json_dumps_callable` backend by name: "stdlib", "orjson" or
+    "auto" (orjson, if it is installed).
+    this may not be combined with `json_dumps_callable`
+    """
+    json_encoder = config_settings.get("g_analytics_writer.json_encoder")
+    if json_encoder:
+        if "json_dumps_callable" in kwargs:
+            raise ValueError(
+                "`g_analytics_writer.json_encoder` and `g_analytics_writer.json_dumps_callable` may not be combined"
+            )
+        kwargs["json_dumps_callable"] = get_json_encoder(json_encoder)
+
+    """
+    :render_cache
+    memoizes renders of writers with identical data, per process.
+    `render_cache.max_size` and `render_cache.ttl` (seconds) configure a
+    dedicated cache; otherwise `g_analytics_writer.default_render_cache` is used
+    """
+    render_cache = config_settings.get("g_analytics_writer.render_cache")
+    if render_cache is not None and asbool(render_cache):
+        cache_kwargs = {}
+        for _option in ("max_size", "ttl"):
+            _value = config_settings.get("g_analytics_writer.render_cache.%s" % _option)
+            if _value is not None:
+                cache_kwargs[_option] = int(_value)
+        render_cache = RenderCache(**cache_kwargs) if cache_kwargs else True
+        kwargs["render_cache"] = render_cache
+
+    """
+    :instrumentation
+    a callable, or dotted name of a callable, which receives a report of every
+    render as `instrumentation(report)`; see `AnalyticsWriter.render`
+    """
+    instrumentation = config_settings.get("g_analytics_writer.instrumentation")
+    if instrumentation:
+        if not callable(instrumentation):
+            instrumentation = config.name_resolver.resolve(instrumentation)
+        kwargs["instrumentation"] = instrumentation
+
+    """
+    :columnar_items
+    stores the items of each transaction column by column, which saves memory
+    for very large transactions
+    """
+    columnar_items = config_settings.get("g_analytics_writer.columnar_items")
+    if columnar_items is not None:
+        kwargs["columnar_items"] = asbool(columnar_items)
+
+    """
+    :metrics
+    counts writers, recorded data and renders in the per-process
+    `g_analytics_writer.default_metrics` registry; `collect()` and
+    `render_prometheus()` expose it to a metrics scraper
+    """
+    metrics = config_settings.get("g_analytics_writer.metrics")
+    if metrics is not None:
+        kwargs["metrics"] = asbool(metrics)
+
+    """
+    :unrendered_sink
+    a callable, or dotted name of a callable, which is invoked at the end of a
+    request as `unrendered_sink(request, writer)` if the writer recorded data
+    but was never rendered (e.g. JSON API views).
+    if not provided, that data is simply dropped with the request.
+    """
+    unrendered_sink = config_settings.get("g_analytics_writer.unrendered_sink")
+    if unrendered_sink:
+        if not callable(unrendered_sink):
+            unrendered_sink = config.name_resolver.resolve(unrendered_sink)
+
+    """
+    :dispatcher
+    sends server-side Measurement Protocol hits from a background thread.
+    the `HitDispatcher` is stored in the registry as
+    `g_analytics_writer.dispatcher` and is available as
+    `request.g_analytics_dispatcher`.
+    `dispatcher.endpoint`, `.batch_size`, `.flush_interval`, `.max_queue`,
+    `.timeout`, `.workers` and `.retry_interval` configure it.
+    `dispatcher.spool` is a directory for `DiskSpool`s, which keep hits on
+    disk while the endpoint is down; each process opens its own spool in a
+    subdirectory when it first dispatches, so forked workers never share one.
+    `.spool.segment_bytes` and `.spool.max_bytes` configure it.
+    """
+    dispatcher = config_settings.get("g_analytics_writer.dispatcher")
+    if dispatcher is not None and asbool(dispatcher):
+        from .dispatcher import HitDispatcher
+
+        dispatcher_kwargs = {}
+        for (_option, _type) in (
+            ("endpoint", str),
+            ("batch_size", int),
+            ("flush_interval", float),
+            ("max_queue", int),
+            ("timeout", float),
+            ("workers", int),
+            ("retry_interval", float),
+        ):
+            _value = config_settings.get("g_analytics_writer.dispatcher.%s" % _option)
+            if _value is not None:
+                dispatcher_kwargs[_option] = _type(_value)
+        spool = config_settings.get("g_analytics_writer.dispatcher.spool")
+        if spool:
+            from .spool import DiskSpool
+
+            spool_kwargs = {}
+            for _option in ("segment_bytes", "max_bytes"):
+                _value = config_settings.get(
+                    "g_analytics_writer.dispatcher.spool.%s" % _option
+                )
+                if _value is not None:
+                    spool_kwargs[_option] = int(_value)
+            dispatcher_kwargs["spool"] = functools.partial(
+                DiskSpool.for_process, spool, **spool_kwargs
+            )
+        dispatcher = HitDispatcher(**dispatcher_kwargs)
+        config.registry["g_analytics_writer.dispatcher"] = dispatcher
+
+        def _g_analytics_dispatcher(request):
+            return request.registry["g_analytics_writer.dispatcher"]
+
+        config.add_request_method(
+            _g_analytics_dispatcher, "g_analytics_dispatcher", reify=True
+        )
+
+    """
+    :tween
+    renders the writer into final `text/html` 200 responses, so templates do
+    not need to call `render()`; see `analytics_tween_factory`
+    """
+    tween = config_settings.get("g_analytics_writer.tween")
+    if tween is not None and asbool(tween):
+        placement = config_settings.get("g_analytics_writer.tween.placement", "head")
+        if placement not in ("head", "body"):
+            raise ValueError(
+                "Invalid placement for g_analytics_writer.tween.placement: %s"
+                % placement
+            )
+        config.add_tween(
+            "g_analytics_writer.pyramid_integration.analytics_tween_factory"
+        )
+
     log.debug("parsed setup for g_analytics_writer: %s" % kwargs)
 
+    # validate once, then share the config with every request
+    writer_config = WriterConfig(**kwargs)
+    config.registry["g_analytics_writer.config"] = writer_config
+
+    def _finished_AnalyticsWriter(request):
+        """
+        hands data from unrendered writers to the `unrendered_sink`, then
+        discards the writer, which counts it in the `metrics`
+        """
+        writer = request.__dict__.get("g_analytics_writer")
+        if writer is None:
+            return
+        if unrendered_sink and (not writer.rendered) and writer.has_data:
+            try:
+                unrendered_sink(request, writer)
+            except Exception as exc:
+                log.exception("g_analytics_writer.unrendered_sink: %s", exc)
+        writer.discard()
+
     def _new_AnalyticsWriter(request):
         """simply creates a new hub"""
-        return AnalyticsWriter(account_id, **kwargs)
+        if unrendered_sink or (writer_config.metrics is not None):
+            request.add_finished_callback(_finished_AnalyticsWriter)
+        return AnalyticsWriter(account_id, config=writer_config)
 
     config.add_request_method(_new_AnalyticsWriter, "g_analytics_writer", reify=True)
+
+
+def dispatch_unrendered(request, writer):
+    """
+    an `unrendered_sink` which sends the data of unrendered writers as
+    server-side hits, via the configured `g_analytics_writer.dispatcher`.
+
+    The client id is read from the `_ga` cookie; writers without a client id
+    or a user id are dropped.
+
+        g_analytics_writer.unrendered_sink = g_analytics_writer.pyramid_integration.dispatch_unrendered
+    """
+    dispatcher = request.registry.get("g_analytics_writer.dispatcher")
+    if dispatcher is None:
+        log.debug("dispatch_unrendered: no `g_analytics_writer.dispatcher`")
+        return
+    client_id = measurement_protocol.client_id_from_cookie(request.cookies.get("_ga"))
+    if not client_id and not writer.data_struct["*user_id"]:
+        return
+    dispatcher.dispatch(
+        writer,
+        client_id=client_id,
+        document_location=request.url,
+        user_agent=request.headers.get("User-Agent"),
+        ip_override=request.environ.get("REMOTE_ADDR"),
+    )
+
+
+def analytics_tween_factory(handler, registry):
+    """
+    A tween which splices the writer's output into final `text/html` 200
+    responses, enabled by `g_analytics_writer.tween`. The writer is only
+    rendered for those responses, and only if the view (or a template) has
+    not already rendered it; redirects, errors and other content types are
+    passed through untouched.
+
+    `render_head()` is placed before `</head>`. `render()` is placed before
+    `</head>`, or before `</body>` if `g_analytics_writer.tween.placement` is
+    `body`; `amp-analytics` markup must be in the body, so AMP renders are
+    always placed before `</body>`.
+
+    The tags are located, regardless of case, with one bounded search each:
+    `</head>` within the first `g_analytics_writer.tween.search_bytes`
+    (default 65536) of the body, and `</body>` within the last. Compressed and
+    streamed (non-list `app_iter`) responses are skipped. The body is not
+    copied; it is served in chunks around the markup.
+    """
+    settings = registry.settings
+    in_body = settings.get("g_analytics_writer.tween.placement", "head") == "body"
+    search_bytes = int(settings.get("g_analytics_writer.tween.search_bytes", 65536))
+
+    def analytics_tween(request):
+        response = handler(request)
+        if (
+            (response.status_code != 200)
+            or (response.content_type != "text/html")
+            or response.content_encoding
+            or not isinstance(response.app_iter, (list, tuple))
+        ):
+            return response
+        writer = request.g_analytics_writer
+        if writer.rendered:
+            return response
+
+        body = response.body
+        head_html = writer.render_head()
+        render_in_body = in_body or (writer.mode == AnalyticsMode.AMP)
+        insertions = []
+        head_end = -1
+        if head_html or not render_in_body:
+            head_end = body[:search_bytes].lower().find(b"</head>")
+        body_end = -1
+        if render_in_body:
+            window = max(0, len(body) - search_bytes)
+            body_end = body[window:].lower().rfind(b"</body>")
+            if body_end == -1:
+                return response
+            body_end += window
+        elif head_end == -1:
+            return response
+
+        charset = response.charset or "utf-8"
+        if head_end != -1:
+            if render_in_body:
+                if head_html:
+                    insertions.append((head_end, head_html))
+            else:
+                insertions.append(
+                    (
+                        head_end,
+                        u"""%s\n%s""" % (head_html, writer.render())
+                        if head_html
+                        else writer.render(),
+                    )
+                )
+        if body_end != -1:
+            insertions.append((body_end, writer.render()))
+
+        insertions = [
+            (offset, markup.encode(charset) + b"\n") for (offset, markup) in insertions
+        ]
+        response.app_iter = _iter_spliced(body, insertions)
+        response.content_length = len(body) + sum(len(m) for (o, m) in insertions)
+        return response
+
+    return analytics_tween
+
+
+# the size of the chunks a spliced body is served in
+_SPLICE_CHUNK_BYTES = 65536
+
+
+def _iter_spliced(body, insertions):
+    """
+    yields `body` with the encoded markup of each `(offset, markup)` of
+    `insertions` placed before `offset`. The body is sliced through a
+    `memoryview`, so only one chunk of it is copied at a time.
+    """
+    view = memoryview(body)
+    position = 0
+    for (offset, markup) in insertions + [(len(body), None)]:
+        while position < offset:
+            end = min(offset, position + _SPLICE_CHUNK_BYTES)
+            yield view[position:end].tobytes()
+            position = end
+        if markup is not None:
+            yield markup
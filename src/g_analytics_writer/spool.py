@@ -0,0 +1,312 @@
+"""
+A disk-backed spool of encoded Measurement Protocol hits.
+
+The spool is a directory of append-only segment files, one encoded hit per
+line. New hits are appended to the active segment, which is rotated once it
+reaches `segment_bytes`; the oldest segments are evicted once the spool
+exceeds `max_bytes`. Segments are read through `mmap`, and the position of
+the reader is stored in a cursor file, so hits which were not acknowledged
+are replayed after a restart.
+
+Delivery is at-least-once: hits read but not committed before a crash are
+read again. A spool directory must only be used by one process at a time; the
+spool holds an exclusive lock on it where `fcntl` is available.
+"""
+import mmap
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+# logging
+import logging
+
+log = logging.getLogger(__name__)
+
+
+# ==============================================================================
+
+
+try:
+    _replace = os.replace
+except AttributeError:
+    # Python2
+    _replace = os.rename
+
+_SEGMENT_SUFFIX = ".seg"
+_CURSOR_FILE = "cursor"
+_LOCK_FILE = "lock"
+
+
+class SpoolLocked(Exception):
+    """
+    raised when a spool directory is already in use by another `DiskSpool`
+    """
+
+
+class DiskSpool(object):
+    """
+    args/kwargs:
+        directory = the spool directory; it is created if needed.
+        segment_bytes = the size at which the active segment is rotated.
+        max_bytes = the maximum size of the spool; the oldest segments are
+                    evicted to stay below it.
+        fsync_records = the active segment is fsynced after this many records,
+        fsync_interval = or this many seconds since the last fsync.
+
+    raises `SpoolLocked` if the directory is in use by another spool. A spool
+    must only be used by the process which opened it (see `pid`), so forked
+    workers should each open their own; see `for_process`.
+    """
+
+    def __init__(
+        self,
+        directory,
+        segment_bytes=1024 * 1024,
+        max_bytes=64 * 1024 * 1024,
+        fsync_records=100,
+        fsync_interval=1.0,
+    ):
+        if segment_bytes >= max_bytes:
+            raise ValueError("`segment_bytes` must be smaller than `max_bytes`")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self._lock = threading.RLock()
+        self._active = None  # the file object of the active segment
+        self._active_seq = None
+        self._unsynced = 0
+        self._synced_at = time.time()
+        self.evicted_bytes = 0
+        self.pid = os.getpid()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock_fh = self._lock_directory()
+
+        # sizes of the segments, by sequence number
+        self._segments = {}
+        for name in os.listdir(directory):
+            if name.endswith(_SEGMENT_SUFFIX):
+                seq = int(name[: -len(_SEGMENT_SUFFIX)])
+                self._segments[seq] = os.path.getsize(self._path(seq))
+        self._cursor = self._read_cursor()
+        for seq in sorted(self._segments):
+            if seq < self._cursor[0]:
+                self._remove(seq)
+
+    @classmethod
+    def for_process(cls, directory, **kwargs):
+        """
+        opens a spool in the first subdirectory of `directory` (`0`, `1`...)
+        which is not in use by another process. Each worker of a forking
+        server then has a spool of its own, and the hits left by a worker are
+        replayed by the next process to use its subdirectory.
+        `kwargs` are passed to `DiskSpool`.
+        """
+        slot = 0
+        while True:
+            try:
+                return cls(os.path.join(directory, str(slot)), **kwargs)
+            except SpoolLocked:
+                slot += 1
+
+    def _lock_directory(self):
+        """
+        returns the file holding an exclusive lock on the directory, or `None`
+        if `fcntl` is unavailable. raises `SpoolLocked` if it is in use.
+        """
+        if fcntl is None:
+            return None
+        fh = open(os.path.join(self.directory, _LOCK_FILE), "a")
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            fh.close()
+            raise SpoolLocked("the spool `%s` is in use" % self.directory)
+        return fh
+
+    def _path(self, seq):
+        return os.path.join(self.directory, "%016d%s" % (seq, _SEGMENT_SUFFIX))
+
+    def _read_cursor(self):
+        """returns the persisted `(seq, offset)` of the reader"""
+        try:
+            with open(os.path.join(self.directory, _CURSOR_FILE)) as fh:
+                (seq, offset) = fh.read().split()
+            return (int(seq), int(offset))
+        except (IOError, OSError, ValueError):
+            return (min(self._segments) if self._segments else 0, 0)
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, _CURSOR_FILE)
+        with open(path + ".tmp", "w") as fh:
+            fh.write("%s %s" % self._cursor)
+        _replace(path + ".tmp", path)
+
+    def _remove(self, seq):
+        size = self._segments.pop(seq)
+        try:
+            os.remove(self._path(seq))
+        except OSError:
+            pass
+        return size
+
+    @property
+    def size(self):
+        """the bytes on disk, including records which were already read"""
+        with self._lock:
+            return sum(self._segments.values())
+
+    def pending(self):
+        """the bytes which have not been committed"""
+        with self._lock:
+            (seq, offset) = self._cursor
+            return sum(v for (k, v) in self._segments.items() if k >= seq) - offset
+
+    def append(self, records):
+        """
+        appends `records`, a list of encoded hits (native strings without
+        line breaks), to the active segment.
+        """
+        if not records:
+            return
+        data = "".join("%s\n" % r for r in records).encode("ascii")
+        with self._lock:
+            if self._active is None:
+                if self._segments:
+                    seq = max(self._segments) + 1
+                else:
+                    # never reuse a segment the cursor has read from
+                    seq = self._cursor[0] + (1 if self._cursor[1] else 0)
+                self._active = open(self._path(seq), "ab")
+                self._active_seq = seq
+                self._segments[seq] = 0
+            self._active.write(data)
+            self._segments[self._active_seq] += len(data)
+            self._unsynced += len(records)
+            if (self._unsynced >= self.fsync_records) or (
+                time.time() - self._synced_at >= self.fsync_interval
+            ):
+                self._sync()
+            if self._segments[self._active_seq] >= self.segment_bytes:
+                self._rotate()
+                self._evict()
+
+    def _sync(self):
+        if self._active is not None:
+            self._active.flush()
+            os.fsync(self._active.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def sync(self):
+        """flushes and fsyncs the active segment"""
+        with self._lock:
+            self._sync()
+
+    def _rotate(self):
+        """seals the active segment; the next append starts a new one"""
+        self._sync()
+        self._active.close()
+        self._active = None
+        self._active_seq = None
+
+    def _evict(self):
+        """removes the oldest sealed segments until the spool fits `max_bytes`"""
+        while sum(self._segments.values()) > self.max_bytes:
+            seq = min(self._segments)
+            if seq == self._active_seq:
+                break
+            size = self._remove(seq)
+            self.evicted_bytes += size
+            log.error("g_analytics_writer.spool: evicted %s bytes", size)
+            if self._cursor[0] <= seq:
+                self._cursor = (seq + 1, 0)
+                self._write_cursor()
+
+    def read(self, max_records, max_bytes=None):
+        """
+        returns a tuple of `(records, token)` with up to `max_records` of the
+        oldest uncommitted records, totalling at most `max_bytes` (with their
+        line breaks). `token` is passed to `commit` once the records have been
+        delivered. Reading does not advance the spool.
+        """
+        with self._lock:
+            (seq, offset) = self._cursor
+            while True:
+                later = [k for k in self._segments if k >= seq]
+                if not later:
+                    return ([], self._cursor)
+                if seq not in self._segments:
+                    (seq, offset) = (min(later), 0)
+                size = self._segments[seq]
+                if seq == self._active_seq:
+                    self._active.flush()
+                if offset < size:
+                    (records, end) = self._read_segment(
+                        seq, offset, size, max_records, max_bytes
+                    )
+                    if records:
+                        return (records, (seq, end))
+                if seq == self._active_seq:
+                    return ([], self._cursor)
+                # a sealed segment was read to its end; anything left is a
+                # record torn by a crash
+                self._remove(seq)
+                (seq, offset) = (seq + 1, 0)
+                self._cursor = (seq, 0)
+                self._write_cursor()
+
+    def _read_segment(self, seq, offset, size, max_records, max_bytes):
+        records = []
+        with open(self._path(seq), "rb") as fh:
+            mapped = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                position = offset
+                while len(records) < max_records:
+                    end = mapped.find(b"\n", position)
+                    if end == -1:
+                        break
+                    if (max_bytes is not None) and records:
+                        if end + 1 - offset > max_bytes:
+                            break
+                    records.append(mapped[position:end].decode("ascii"))
+                    position = end + 1
+            finally:
+                mapped.close()
+        return (records, position)
+
+    def commit(self, token):
+        """records that everything up to `token` (from `read`) was delivered"""
+        with self._lock:
+            (seq, offset) = token
+            if (seq, offset) <= self._cursor:
+                return
+            if (seq != self._active_seq) and (offset >= self._segments.get(seq, 0)):
+                if seq in self._segments:
+                    self._remove(seq)
+                (seq, offset) = (seq + 1, 0)
+            self._cursor = (seq, offset)
+            self._write_cursor()
+
+    def close(self):
+        """fsyncs and closes the active segment, and releases the directory"""
+        with self._lock:
+            if self._active is not None:
+                self._rotate()
+            if self._lock_fh is not None:
+                self._lock_fh.close()
+                self._lock_fh = None
+
+
+__all__ = (
+    "DiskSpool",
+    "SpoolLocked",
+)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+# stdlib
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from six.moves import BaseHTTPServer
+
+# local package to test
+from g_analytics_writer import AnalyticsWriter
+from g_analytics_writer import measurement_protocol
+from g_analytics_writer.dispatcher import HitDispatcher
+from g_analytics_writer.dispatcher import ConnectionPool
+from g_analytics_writer.spool import DiskSpool
+
+
+# ==============================================================================
+
+
+class _CollectorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """a stand-in for the Measurement Protocol batch endpoint"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.bodies.append(body.decode("utf-8"))
+        self.server.connections.add(self.client_address)
+        status = self.server.status
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        if self.server.close_idle:
+            # close the connection without telling the client, like a server
+            # dropping idle keep-alive connections
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class _TestCollector(object):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _CollectorHandler)
+        self.server.bodies = []
+        self.server.connections = set()
+        self.server.status = 200
+        self.server.close_idle = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.endpoint = "http://127.0.0.1:%s/batch" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _make_writer(self, events=1):
+        writer = AnalyticsWriter("UA-123123-1")
+        for idx in range(events):
+            writer.track_event({"*category": "Videos", "*action": "Play%s" % idx})
+        return writer
+
+    def _make_hits(self):
+        """a pageview, an event and an event larger than `HIT_MAX_BYTES`"""
+        hits = measurement_protocol.build_hits(
+            self._make_writer(events=2), client_id="555"
+        )
+        hits[-1]["el"] = "x" * measurement_protocol.HIT_MAX_BYTES
+        return hits
+
+
+class TestHitDispatcher(_TestCollector, unittest.TestCase):
+    def test_dispatch(self):
+        dispatcher = HitDispatcher(endpoint=self.endpoint, flush_interval=0.05)
+        # a pageview and 44 events
+        dispatcher.dispatch(self._make_writer(events=44), client_id="555")
+        dispatcher.flush()
+        self.assertEqual(
+            sorted(len(b.split("\n")) for b in self.server.bodies), [5, 20, 20]
+        )
+        # the connection was reused
+        self.assertEqual(len(self.server.connections), 1)
+        stats = dispatcher.stats()
+        self.assertEqual((stats["sent"], stats["requests"]), (45, 3))
+        dispatcher.close()
+        self.assertRaises(ValueError, dispatcher.enqueue, [])
+
+    def test_failed(self):
+        self.server.status = 500
+        dispatcher = HitDispatcher(endpoint=self.endpoint, flush_interval=0.05)
+        dispatcher.dispatch(self._make_writer(), client_id="555")
+        dispatcher.close()
+        stats = dispatcher.stats()
+        self.assertEqual((stats["sent"], stats["failed"]), (0, 2))
+
+    def test_unreachable(self):
+        self.tearDown()
+        dispatcher = HitDispatcher(
+            endpoint=self.endpoint, flush_interval=0.05, timeout=1
+        )
+        dispatcher.dispatch(self._make_writer(), client_id="555")
+        dispatcher.close()
+        self.assertEqual(dispatcher.stats()["failed"], 2)
+        self.setUp()
+
+    def test_queue_full(self):
+        started = threading.Event()
+
+        class _PausedDispatcher(HitDispatcher):
+            def _run(self):
+                started.wait()
+                HitDispatcher._run(self)
+
+        dispatcher = _PausedDispatcher(endpoint=self.endpoint, max_queue=1)
+        # a pageview and 10 events
+        dropped = dispatcher.dispatch(self._make_writer(events=10), client_id="555")
+        self.assertEqual(dropped, 10)
+        self.assertEqual(dispatcher.stats()["dropped"], 10)
+        started.set()
+        dispatcher.close()
+        self.assertEqual(dispatcher.stats()["sent"], 1)
+
+    def test_oversize(self):
+        dispatcher = HitDispatcher(endpoint=self.endpoint, flush_interval=0.05)
+        dispatcher.enqueue(self._make_hits())
+        dispatcher.close()
+        stats = dispatcher.stats()
+        self.assertEqual((stats["sent"], stats["dropped"]), (2, 1))
+
+    def test_stale_connection(self):
+        self.server.close_idle = True
+        pool = ConnectionPool(self.endpoint)
+        for idx in range(3):
+            self.assertEqual(pool.post(u"hit%s" % idx), 200)
+        self.assertEqual(self.server.bodies, [u"hit0", u"hit1", u"hit2"])
+        self.assertEqual(len(self.server.connections), 3)
+        pool.close()
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, HitDispatcher, batch_size=21)
+        self.assertRaises(ValueError, HitDispatcher, workers=0)
+        self.assertRaises(ValueError, ConnectionPool, "ftp://example.com")
+
+
+class TestHitDispatcherSpool(_TestCollector, unittest.TestCase):
+    def setUp(self):
+        _TestCollector.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        _TestCollector.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def _make_dispatcher(self):
+        return HitDispatcher(
+            endpoint=self.endpoint,
+            flush_interval=0.05,
+            retry_interval=0.05,
+            spool=DiskSpool(self.directory),
+        )
+
+    def test_dispatch(self):
+        dispatcher = self._make_dispatcher()
+        dispatcher.dispatch(self._make_writer(events=44), client_id="555")
+        dispatcher.flush(timeout=10)
+        self.assertEqual(sum(len(b.split("\n")) for b in self.server.bodies), 45)
+        self.assertEqual(dispatcher.stats()["spooled_bytes"], 0)
+        dispatcher.close()
+
+    def test_outage(self):
+        # hits are kept in the spool while the endpoint fails, then sent
+        self.server.status = 503
+        dispatcher = self._make_dispatcher()
+        dispatcher.dispatch(self._make_writer(events=4), client_id="555")
+        dispatcher.flush(timeout=0.2)
+        self.assertGreater(dispatcher.stats()["spooled_bytes"], 0)
+        self.server.status = 200
+        dispatcher.flush(timeout=10)
+        self.assertEqual(dispatcher.stats()["sent"], 5)
+        dispatcher.close()
+
+    def test_oversize(self):
+        dispatcher = self._make_dispatcher()
+        dispatcher.enqueue(self._make_hits())
+        dispatcher.flush(timeout=10)
+        stats = dispatcher.stats()
+        self.assertEqual((stats["sent"], stats["dropped"]), (2, 1))
+        self.assertEqual(stats["spooled_bytes"], 0)
+        dispatcher.close()
+
+    def test_replay(self):
+        self.server.status = 503
+        dispatcher = self._make_dispatcher()
+        dispatcher.dispatch(self._make_writer(events=4), client_id="555")
+        dispatcher.close()
+        self.assertEqual(dispatcher.stats()["sent"], 0)
+
+        # a new process replays the spooled hits
+        self.server.status = 200
+        del self.server.bodies[:]
+        dispatcher = self._make_dispatcher()
+        dispatcher.dispatch(self._make_writer(events=1), client_id="555")
+        dispatcher.flush(timeout=10)
+        self.assertEqual(dispatcher.stats()["sent"], 7)
+        dispatcher.close()
+
+    def test_spool_factory(self):
+        dispatcher = HitDispatcher(
+            endpoint=self.endpoint,
+            flush_interval=0.05,
+            spool=functools.partial(DiskSpool.for_process, self.directory),
+        )
+        self.assertIsNone(dispatcher.spool)
+        dispatcher.dispatch(self._make_writer(), client_id="555")
+        dispatcher.flush(timeout=10)
+        self.assertEqual(dispatcher.stats()["sent"], 2)
+        self.assertEqual(dispatcher.spool.directory, os.path.join(self.directory, "0"))
+        dispatcher.close()
+
+    def test_spool_forked(self):
+        # a spool opened by another process, e.g. before a fork, is refused
+        spool = DiskSpool(self.directory)
+        spool.pid = -1
+        dispatcher = HitDispatcher(endpoint=self.endpoint, spool=spool)
+        self.assertRaises(ValueError, dispatcher.enqueue, [])
+
+    def test_invalid(self):
+        self.assertRaises(
+            ValueError, HitDispatcher, spool=DiskSpool(self.directory), workers=2
+        )
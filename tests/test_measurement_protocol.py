@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+# stdlib
+import unittest
+
+# local package to test
+from g_analytics_writer import AnalyticsWriter
+from g_analytics_writer import measurement_protocol
+
+# local test utilities
+from .test_writing import data__event_1
+from .test_writing import data__transaction_dict_2
+from .test_writing import data__transaction_item_dict
+
+
+# ==============================================================================
+
+
+class TestBuildHits(unittest.TestCase):
+    def _make_writer(self):
+        writer = AnalyticsWriter("UA-123123-1")
+        writer.set_custom_dimension(1, "section", "landing")
+        writer.set_custom_metric(2, "metric2", 10)
+        writer.set_user_id("cecil")
+        writer.track_event(data__event_1)
+        writer.add_transaction(data__transaction_dict_2)
+        writer.add_transaction_item(data__transaction_item_dict)
+        return writer
+
+    def test_hits(self):
+        writer = self._make_writer()
+        hits = measurement_protocol.build_hits(
+            writer, client_id="555", document_path="/landing"
+        )
+        self.assertEqual(
+            [hit["t"] for hit in hits], ["pageview", "transaction", "item", "event"]
+        )
+        for hit in hits:
+            self.assertEqual(hit["v"], "1")
+            self.assertEqual(hit["tid"], "UA-123123-1")
+            self.assertEqual(hit["cid"], "555")
+            self.assertEqual(hit["uid"], "cecil")
+            # `global_custom_data` is enabled by default
+            self.assertEqual((hit["cd1"], hit["cm2"]), ("landing", "10"))
+        self.assertEqual(hits[0]["dp"], "/landing")
+        self.assertEqual(
+            (hits[1]["ti"], hits[1]["ta"], hits[1]["tr"]),
+            ("1234", "analytics.js", "115.00"),
+        )
+        self.assertEqual((hits[2]["ti"], hits[2]["in"]), ("1234", u"T-Shirt"))
+        self.assertEqual(hits[2]["iv"], u"Greeñ Medium")
+        self.assertEqual(
+            (hits[3]["ec"], hits[3]["ea"], hits[3]["ev"], hits[3]["ni"]),
+            ("Videos", "Play", "47", "1"),
+        )
+
+    def test_pageview_custom_data(self):
+        writer = self._make_writer()
+        writer.global_custom_data = False
+        hits = measurement_protocol.build_hits(writer, client_id="555")
+        self.assertEqual(hits[0]["cd1"], "landing")
+        for hit in hits[1:]:
+            self.assertNotIn("cd1", hit)
+
+    def test_invalid(self):
+        writer = AnalyticsWriter("UA-123123-1")
+        # no `client_id` or `user_id`
+        self.assertRaises(ValueError, measurement_protocol.build_hits, writer)
+
+        # events without a category are skipped
+        writer.track_event({"*action": "Play"})
+        hits = measurement_protocol.build_hits(writer, client_id="555")
+        self.assertEqual([hit["t"] for hit in hits], ["pageview"])
+
+    def test_additional_accounts(self):
+        writer = self._make_writer()
+        writer.set_account_additional__add("UA-123123-2")
+        hits = measurement_protocol.build_hits(writer, client_id="555")
+        self.assertEqual(len(hits), 8)
+        self.assertEqual(
+            [hit["tid"] for hit in hits], ["UA-123123-1"] * 4 + ["UA-123123-2"] * 4
+        )
+
+
+class TestClientId(unittest.TestCase):
+    def test_client_id_from_cookie(self):
+        self.assertEqual(
+            measurement_protocol.client_id_from_cookie("GA1.2.1234567890.1234567890"),
+            "1234567890.1234567890",
+        )
+        self.assertIsNone(measurement_protocol.client_id_from_cookie(None))
+        self.assertIsNone(measurement_protocol.client_id_from_cookie("invalid"))
+
+
+class TestEncoding(unittest.TestCase):
+    def test_encode_hit(self):
+        writer = AnalyticsWriter("UA-123123-1")
+        writer.add_transaction(data__transaction_dict_2)
+        writer.add_transaction_item(data__transaction_item_dict)
+        hits = measurement_protocol.build_hits(writer, client_id="555")
+        self.assertEqual(
+            measurement_protocol.encode_hit(hits[0]),
+            "v=1&tid=UA-123123-1&cid=555&t=pageview",
+        )
+        self.assertIn(
+            "iv=Gree%C3%B1+Medium", measurement_protocol.encode_hit(hits[2])
+        )
+
+    def test_iter_batches(self):
+        writer = AnalyticsWriter("UA-123123-1")
+        for idx in range(44):
+            writer.track_event({"*category": "Videos", "*action": "Play%s" % idx})
+        hits = measurement_protocol.build_hits(writer, client_id="555")
+        batches = list(measurement_protocol.iter_batches(hits))
+        self.assertEqual([len(b.split("\n")) for b in batches], [20, 20, 5])
+
+        # byte limits
+        batches = list(measurement_protocol.iter_batches(hits, max_bytes=200))
+        for batch in batches:
+            self.assertLessEqual(len(batch), 200)
+        self.assertEqual(sum(len(b.split("\n")) for b in batches), 45)
+
+    def test_oversized_hit(self):
+        hit = {"t": "event", "el": "x" * measurement_protocol.HIT_MAX_BYTES}
+        self.assertEqual(list(measurement_protocol.iter_batches([hit])), [])
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+# stdlib
+import sys
+import unittest
+
+# local package to test
+from g_analytics_writer import AnalyticsMode
+from g_analytics_writer import WriterConfig
+from g_analytics_writer.middleware import StreamInjector
+from g_analytics_writer.middleware import WSGIMiddleware
+
+# local test utilities
+from ._utils import custom_json_dumps_sorted
+
+
+# ==============================================================================
+
+
+_HTML_CHUNKS = (
+    b"<html><head><title>test</title></he",
+    b"ad><body><p>content</p></bo",
+    b"dy></html>",
+)
+
+
+class _FakeDispatcher(object):
+    def __init__(self):
+        self.dispatched = []
+
+    def dispatch(self, writer, **kwargs):
+        self.dispatched.append((writer, kwargs))
+
+
+def _make_config(mode=AnalyticsMode.ANALYTICS):
+    return WriterConfig(mode=mode, json_dumps_callable=custom_json_dumps_sorted)
+
+
+class TestStreamInjector(unittest.TestCase):
+    def _inject(self, writer, placement="head", chunks=_HTML_CHUNKS):
+        injector = StreamInjector(writer, placement=placement)
+        body = b"".join(injector.feed(chunk) for chunk in chunks)
+        return body + injector.finish()
+
+    def _writer(self, mode=AnalyticsMode.ANALYTICS):
+        from g_analytics_writer import AnalyticsWriter
+
+        return AnalyticsWriter("UA-123123-1", config=_make_config(mode))
+
+    def test_head(self):
+        writer = self._writer()
+        body = self._inject(writer)
+        self.assertEqual(
+            body,
+            b"".join(_HTML_CHUNKS).replace(
+                b"</head>", writer.render().encode("utf-8") + b"\n</head>"
+            ),
+        )
+
+    def test_body(self):
+        writer = self._writer()
+        body = self._inject(writer, placement="body")
+        self.assertEqual(
+            body,
+            b"".join(_HTML_CHUNKS).replace(
+                b"</body>", writer.render().encode("utf-8") + b"\n</body>"
+            ),
+        )
+
+    def test_amp(self):
+        writer = self._writer(AnalyticsMode.AMP)
+        body = self._inject(writer)
+        expected = (
+            b"".join(_HTML_CHUNKS)
+            .replace(b"</head>", writer.render_head().encode("utf-8") + b"\n</head>")
+            .replace(b"</body>", writer.render().encode("utf-8") + b"\n</body>")
+        )
+        self.assertEqual(body, expected)
+
+    def test_body_without_head(self):
+        for placement in ("head", "body"):
+            writer = self._writer(AnalyticsMode.AMP)
+            html = b"<html><body><p>content</p></body></html>"
+            body = self._inject(writer, placement=placement, chunks=(html,))
+            markup = u"%s\n%s\n" % (writer.render_head(), writer.render())
+            self.assertEqual(
+                body, html.replace(b"</body>", markup.encode("utf-8") + b"</body>")
+            )
+
+    def test_uppercase_tags(self):
+        writer = self._writer(AnalyticsMode.AMP)
+        html = b"<HTML><HEAD></HEAD><BODY><p>content</p></BODY></HTML>"
+        chunks = [html[i : i + 3] for i in range(0, len(html), 3)]
+        body = self._inject(writer, chunks=chunks)
+        expected = html.replace(
+            b"</HEAD>", writer.render_head().encode("utf-8") + b"\n</HEAD>"
+        ).replace(b"</BODY>", writer.render().encode("utf-8") + b"\n</BODY>")
+        self.assertEqual(body, expected)
+
+    def test_single_bytes(self):
+        writer = self._writer()
+        html = b"".join(_HTML_CHUNKS)
+        body = self._inject(writer, chunks=[html[i : i + 1] for i in range(len(html))])
+        self.assertEqual(body, self._inject(self._writer()))
+
+    def test_missing_tag(self):
+        writer = self._writer()
+        body = self._inject(writer, chunks=(b"<p>no head</p>",))
+        self.assertEqual(body, b"<p>no head</p>")
+        self.assertFalse(writer.rendered)
+
+
+class TestWSGIMiddleware(unittest.TestCase):
+    def _app(self, status="200 OK", content_type="text/html; charset=utf-8"):
+        def app(environ, start_response):
+            self.environ = environ
+            writer = environ["g_analytics_writer"]
+            writer.track_event({"*category": "Videos", "*action": "Play"})
+            start_response(
+                status,
+                [
+                    ("Content-Type", content_type),
+                    ("Content-Length", str(len(b"".join(_HTML_CHUNKS)))),
+                ],
+            )
+            return iter(_HTML_CHUNKS)
+
+        return app
+
+    def _call(self, middleware, environ=None):
+        responses = []
+
+        def start_response(status, headers, exc_info=None):
+            responses.append((status, headers))
+
+        app_iter = middleware(environ or {"PATH_INFO": "/"}, start_response)
+        body = b"".join(app_iter)
+        app_iter.close()
+        return (responses[0][0], dict(responses[0][1]), body)
+
+    def test_inject(self):
+        middleware = WSGIMiddleware(self._app(), "UA-123123-1", config=_make_config())
+        (status, headers, body) = self._call(middleware)
+        writer = self.environ["g_analytics_writer"]
+        self.assertEqual(writer.config, middleware.config)
+        self.assertTrue(writer.rendered)
+        self.assertNotIn("Content-Length", headers)
+        self.assertIn(b"ga('send','event','Videos','Play');", body)
+        self.assertEqual(body.count(b"</head>"), 1)
+
+    def test_passthrough(self):
+        for app in (
+            self._app(status="302 Found"),
+            self._app(content_type="application/json"),
+        ):
+            middleware = WSGIMiddleware(app, "UA-123123-1")
+            (status, headers, body) = self._call(middleware)
+            self.assertEqual(body, b"".join(_HTML_CHUNKS))
+            self.assertIn("Content-Length", headers)
+            self.assertFalse(self.environ["g_analytics_writer"].rendered)
+
+    def test_dispatch_unrendered(self):
+        dispatcher = _FakeDispatcher()
+        middleware = WSGIMiddleware(
+            self._app(content_type="application/json"),
+            "UA-123123-1",
+            dispatcher=dispatcher,
+        )
+        # no client id
+        self._call(middleware)
+        self.assertEqual(dispatcher.dispatched, [])
+
+        environ = {
+            "PATH_INFO": "/api",
+            "HTTP_COOKIE": "_ga=GA1.2.1234567890.1234567890; other=1",
+        }
+        self._call(middleware, environ=environ)
+        (writer, kwargs) = dispatcher.dispatched[0]
+        self.assertIs(writer, self.environ["g_analytics_writer"])
+        self.assertEqual(kwargs["client_id"], "1234567890.1234567890")
+        self.assertEqual(kwargs["document_path"], "/api")
+
+        # rendered writers are not dispatched
+        middleware.app = self._app()
+        self._call(middleware, environ=environ)
+        self.assertEqual(len(dispatcher.dispatched), 1)
+
+    def test_invalid(self):
+        self.assertRaises(
+            ValueError, WSGIMiddleware, self._app(), "UA-123123-1", placement="footer"
+        )
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "ASGI requires Python 3.7")
+class TestASGIMiddleware(unittest.TestCase):
+    def _app(self, status=200, content_type=b"text/html; charset=utf-8"):
+        async def app(scope, receive, send):
+            self.scope = scope
+            writer = scope["g_analytics_writer"]
+            writer.track_event({"*category": "Videos", "*action": "Play"})
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [
+                        (b"content-type", content_type),
+                        (b"content-length", b"%d" % len(b"".join(_HTML_CHUNKS))),
+                    ],
+                }
+            )
+            for (idx, chunk) in enumerate(_HTML_CHUNKS):
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk,
+                        "more_body": idx < len(_HTML_CHUNKS) - 1,
+                    }
+                )
+
+        return app
+
+    def _call(self, middleware, headers=()):
+        import asyncio
+
+        messages = []
+
+        async def receive():
+            return {"type": "http.request"}
+
+        async def send(message):
+            messages.append(message)
+
+        async def run():
+            scope = {"type": "http", "path": "/", "headers": list(headers)}
+            await middleware(scope, receive, send)
+            # let the executor run any dispatch
+            await asyncio.sleep(0.05)
+
+        asyncio.run(run())
+        headers = dict(messages[0]["headers"])
+        body = b"".join(m["body"] for m in messages[1:])
+        return (headers, body)
+
+    def test_inject(self):
+        from g_analytics_writer.middleware_asgi import ASGIMiddleware
+
+        middleware = ASGIMiddleware(self._app(), "UA-123123-1", config=_make_config())
+        (headers, body) = self._call(middleware)
+        self.assertTrue(self.scope["g_analytics_writer"].rendered)
+        self.assertNotIn(b"content-length", headers)
+        self.assertIn(b"ga('send','event','Videos','Play');", body)
+
+    def test_dispatch_unrendered(self):
+        from g_analytics_writer.middleware_asgi import ASGIMiddleware
+
+        dispatcher = _FakeDispatcher()
+        middleware = ASGIMiddleware(
+            self._app(content_type=b"application/json"),
+            "UA-123123-1",
+            dispatcher=dispatcher,
+        )
+        (headers, body) = self._call(
+            middleware, headers=[(b"cookie", b"_ga=GA1.2.1234567890.1234567890")]
+        )
+        self.assertEqual(body, b"".join(_HTML_CHUNKS))
+        self.assertIn(b"content-length", headers)
+        self.assertEqual(len(dispatcher.dispatched), 1)
+        self.assertEqual(
+            dispatcher.dispatched[0][1]["client_id"], "1234567890.1234567890"
+        )
@@ -1,4 +1,7 @@
 # stdlib
+import os
+import shutil
+import tempfile
 import unittest
 
 # local package to test
@@ -57,6 +60,8 @@ class _TestHarness(object):
                 "g_analytics_writer.amp_clientid_integration"
             ] = self._gwriter_amp_clientid_integration
 
+        self._update_settings(settings)
+
         if self._expected_setup_fail:
             self.assertRaises(
                 ValueError,
@@ -76,6 +81,10 @@ class _TestHarness(object):
         # copy the writer onto the request...
         self.request.g_analytics_writer = request_writer
 
+    def _update_settings(self, settings):
+        """hook for subclasses to add additional settings"""
+        pass
+
     def tearDown(self):
         testing.tearDown()
 
@@ -154,6 +163,22 @@ class _TestSetup(_TestHarness):
                 self._gwriter_amp_clientid_integration,
             )
 
+    def test_pyramid_config_shared(self):
+        """
+        test every request shares the `WriterConfig` built during setup
+        """
+        if self._expected_setup_fail:
+            raise unittest.SkipTest(
+                "This test should have successfully failed during setUp; no further testing needed"
+            )
+        writer_config = self.config.registry["g_analytics_writer.config"]
+        self.assertIs(self.request.g_analytics_writer.config, writer_config)
+
+        exts = self.config.registry.getUtility(IRequestExtensions)
+        request_2 = testing.DummyRequest()
+        writer_2 = exts.descriptors["g_analytics_writer"].wrapped(request_2)
+        self.assertIs(writer_2.config, writer_config)
+
 
 class TestSetupSimple(_TestSetup, unittest.TestCase):
     pass
@@ -204,6 +229,188 @@ class TestSetupAmpClientidIntegrationFalse(_TestSetup, unittest.TestCase):
     _gwriter_amp_clientid_integration = False
 
 
+class TestSetupJsonEncoder(_TestHarness, unittest.TestCase):
+    def _update_settings(self, settings):
+        del settings["g_analytics_writer.json_dumps_callable"]
+        settings["g_analytics_writer.json_encoder"] = "stdlib"
+
+    def test_json_encoder(self):
+        self.assertIs(
+            self.request.g_analytics_writer.config.json_dumps_callable,
+            g_analytics_writer.json_dumps,
+        )
+
+
+class TestSetupJsonEncoderCombined(_TestSetup, unittest.TestCase):
+    _expected_setup_fail = True
+
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.json_encoder"] = "stdlib"
+
+
+class TestSetupRenderCache(_TestHarness, unittest.TestCase):
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.render_cache"] = "true"
+        settings["g_analytics_writer.render_cache.max_size"] = "10"
+
+    def test_render_cache(self):
+        render_cache = self.request.g_analytics_writer.config.render_cache
+        self.assertIsInstance(render_cache, g_analytics_writer.RenderCache)
+        self.assertEqual(render_cache.max_size, 10)
+
+
+class TestSetupInstrumentation(_TestHarness, unittest.TestCase):
+    def _update_settings(self, settings):
+        self.reports = []
+        settings["g_analytics_writer.instrumentation"] = self.reports.append
+
+    def test_instrumentation(self):
+        self.request.g_analytics_writer.render()
+        self.assertEqual(len(self.reports), 1)
+
+
+class TestSetupColumnarItems(_TestHarness, unittest.TestCase):
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.columnar_items"] = "true"
+
+    def test_columnar_items(self):
+        self.assertTrue(self.request.g_analytics_writer.config.columnar_items)
+
+
+class TestSetupMetrics(_TestHarness, unittest.TestCase):
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.metrics"] = "true"
+
+    def test_metrics(self):
+        writer = self.request.g_analytics_writer
+        self.assertIs(writer.config.metrics, g_analytics_writer.default_metrics)
+
+    def _discarded(self):
+        counters = g_analytics_writer.default_metrics.collect()["counters"]
+        return sum(counters.get("writers_discarded", {}).values())
+
+    def test_discarded(self):
+        discarded = self._discarded()
+        self.request.g_analytics_writer.track_event(
+            {"*category": "api", "*action": "fetch"}
+        )
+        self.request._process_finished_callbacks()
+        self.assertEqual(self._discarded(), discarded + 1)
+
+    def test_rendered(self):
+        discarded = self._discarded()
+        self.request.g_analytics_writer.render()
+        self.request._process_finished_callbacks()
+        self.assertEqual(self._discarded(), discarded)
+
+
+class TestSetupDispatcher(_TestHarness, unittest.TestCase):
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.dispatcher"] = "true"
+        settings["g_analytics_writer.dispatcher.endpoint"] = "http://127.0.0.1/batch"
+        settings["g_analytics_writer.dispatcher.batch_size"] = "10"
+        settings["g_analytics_writer.dispatcher.flush_interval"] = "0.5"
+
+    def test_dispatcher(self):
+        from g_analytics_writer.dispatcher import HitDispatcher
+
+        dispatcher = self.config.registry["g_analytics_writer.dispatcher"]
+        self.assertIsInstance(dispatcher, HitDispatcher)
+        self.assertEqual(dispatcher.endpoint, "http://127.0.0.1/batch")
+        self.assertEqual(
+            (dispatcher.batch_size, dispatcher.flush_interval), (10, 0.5)
+        )
+
+    def test_dispatch_unrendered(self):
+        hits = []
+        dispatcher = self.config.registry["g_analytics_writer.dispatcher"]
+        dispatcher.enqueue = hits.extend
+        writer = self.request.g_analytics_writer
+        writer.track_event({"*category": "api", "*action": "fetch"})
+
+        # no client id
+        g_analytics_writer.pyramid_integration.dispatch_unrendered(
+            self.request, writer
+        )
+        self.assertEqual(hits, [])
+
+        self.request.cookies["_ga"] = "GA1.2.1234567890.1234567890"
+        g_analytics_writer.pyramid_integration.dispatch_unrendered(
+            self.request, writer
+        )
+        self.assertEqual([hit["t"] for hit in hits], ["pageview", "event"])
+        self.assertEqual(hits[0]["cid"], "1234567890.1234567890")
+
+
+class TestSetupDispatcherSpool(_TestHarness, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        _TestHarness.setUp(self)
+
+    def tearDown(self):
+        _TestHarness.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.dispatcher"] = "true"
+        settings["g_analytics_writer.dispatcher.spool"] = self.directory
+        settings["g_analytics_writer.dispatcher.spool.max_bytes"] = "10000000"
+
+    def test_spool(self):
+        from g_analytics_writer.spool import DiskSpool
+
+        dispatcher = self.config.registry["g_analytics_writer.dispatcher"]
+        # the spool is opened by each process, when it first dispatches
+        self.assertIsNone(dispatcher.spool)
+        dispatcher.enqueue([])
+        self.assertIsInstance(dispatcher.spool, DiskSpool)
+        self.assertEqual(
+            dispatcher.spool.directory, os.path.join(self.directory, "0")
+        )
+        self.assertEqual(dispatcher.spool.max_bytes, 10000000)
+        dispatcher.close()
+
+
+class TestUnrenderedSink(_TestHarness, unittest.TestCase):
+    _gwriter_mode = g_analytics_writer.AnalyticsMode.ANALYTICS
+
+    def setUp(self):
+        self.sunk = []
+
+        def _sink(request, writer):
+            self.sunk.append((request, writer.data_struct["*tracked_events"][:]))
+
+        self._sink = _sink
+        _TestHarness.setUp(self)
+
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.unrendered_sink"] = self._sink
+
+    def test_unrendered(self):
+        self.request.g_analytics_writer.track_event(
+            {"*category": "api", "*action": "fetch"}
+        )
+        self.request._process_finished_callbacks()
+        self.assertEqual(len(self.sunk), 1)
+        self.assertIs(self.sunk[0][0], self.request)
+        self.assertEqual(
+            self.sunk[0][1], [{"*category": "api", "*action": "fetch"}]
+        )
+        self.assertFalse(self.request.g_analytics_writer.has_data)
+
+    def test_rendered(self):
+        self.request.g_analytics_writer.track_event(
+            {"*category": "api", "*action": "fetch"}
+        )
+        self.request.g_analytics_writer.render()
+        self.request._process_finished_callbacks()
+        self.assertEqual(self.sunk, [])
+
+    def test_no_data(self):
+        self.request._process_finished_callbacks()
+        self.assertEqual(self.sunk, [])
+
+
 class _TestPageviews(_TestHarness):
     """
     core class for tests.
@@ -347,3 +554,113 @@ ga('create','UA-12345678987654321-12','auto');
 ga('set',{"dimension1":"account","dimension2":"home","dimension5":"1"});
 ga('send','pageview');
 </script>"""
+
+
+class TestTween(_TestHarness, unittest.TestCase):
+    _gwriter_mode = g_analytics_writer.AnalyticsMode.ANALYTICS
+    _tween_placement = None
+
+    _html = (
+        b"<html><head><title>test</title></head>"
+        b"<body><p>content</p></body></html>"
+    )
+
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.tween"] = "true"
+        if self._tween_placement is not None:
+            settings["g_analytics_writer.tween.placement"] = self._tween_placement
+
+    def _render(self, response, request=None):
+        from pyramid.interfaces import ITweens
+
+        tweens = self.config.registry.queryUtility(ITweens)
+        self.assertIn(
+            "g_analytics_writer.pyramid_integration.analytics_tween_factory",
+            [name for (name, factory) in tweens.implicit()],
+        )
+        tween = g_analytics_writer.pyramid_integration.analytics_tween_factory(
+            lambda request: response, self.config.registry
+        )
+        return tween(request or self.request)
+
+    def _response(self, body=None, **kwargs):
+        from pyramid.response import Response
+
+        return Response(body=self._html if body is None else body, **kwargs)
+
+    def _expected(self, html, head=b"</head>", body=b"</body>"):
+        return html.replace(
+            head,
+            self.request.g_analytics_writer.render().encode("utf-8") + b"\n" + head,
+        )
+
+    def test_placement(self):
+        response = self._render(self._response())
+        self.assertTrue(self.request.g_analytics_writer.rendered)
+        expected = self._expected(self._html)
+        self.assertEqual(response.body, expected)
+        self.assertEqual(response.content_length, len(expected))
+
+    def test_case_insensitive(self):
+        html = self._html.replace(b"</head>", b"</HEAD>").replace(
+            b"</body>", b"</Body>"
+        )
+        response = self._render(self._response(body=html))
+        self.assertTrue(self.request.g_analytics_writer.rendered)
+        self.assertEqual(
+            response.body, self._expected(html, head=b"</HEAD>", body=b"</Body>")
+        )
+
+    def test_large(self):
+        html = self._html.replace(b"<p>", b"<p>" + b"x" * 1000000)
+        response = self._render(self._response(body=html))
+        expected = self._expected(html)
+        self.assertEqual(response.content_length, len(expected))
+        self.assertEqual(response.body, expected)
+
+    def test_passthrough(self):
+        for response in (
+            self._response(status=302),
+            self._response(status=500),
+            self._response(content_type="application/json"),
+            self._response(body=b"<p>no head</p>"),
+        ):
+            body = response.body
+            self.assertEqual(self._render(response).body, body)
+        self.assertFalse(self.request.g_analytics_writer.rendered)
+
+    def test_already_rendered(self):
+        self.request.g_analytics_writer.render()
+        response = self._render(self._response())
+        self.assertEqual(response.body, self._html)
+
+
+class TestTweenBody(TestTween):
+    _tween_placement = "body"
+
+    def _expected(self, html, head=b"</head>", body=b"</body>"):
+        return html.replace(
+            body,
+            self.request.g_analytics_writer.render().encode("utf-8") + b"\n" + body,
+        )
+
+
+class TestTweenAmp(TestTween):
+    _gwriter_mode = g_analytics_writer.AnalyticsMode.AMP
+
+    def _expected(self, html, head=b"</head>", body=b"</body>"):
+        writer = self.request.g_analytics_writer
+        return html.replace(
+            head, writer.render_head().encode("utf-8") + b"\n" + head
+        ).replace(body, writer.render().encode("utf-8") + b"\n" + body)
+
+
+class TestSetupTweenInvalid(_TestHarness, unittest.TestCase):
+    _expected_setup_fail = True
+
+    def _update_settings(self, settings):
+        settings["g_analytics_writer.tween"] = "true"
+        settings["g_analytics_writer.tween.placement"] = "footer"
+
+    def test_setup(self):
+        pass
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+
+# local package to test
+from g_analytics_writer.spool import DiskSpool
+from g_analytics_writer.spool import SpoolLocked
+
+
+# ==============================================================================
+
+
+class TestDiskSpool(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _records(self, count, start=0):
+        return ["v=1&t=event&ea=Play%04d" % idx for idx in range(start, start + count)]
+
+    def test_read_commit(self):
+        spool = DiskSpool(self.directory)
+        spool.append(self._records(5))
+        (records, token) = spool.read(3)
+        self.assertEqual(records, self._records(3))
+        # reading does not advance the spool
+        self.assertEqual(spool.read(3)[0], self._records(3))
+        spool.commit(token)
+        (records, token) = spool.read(10)
+        self.assertEqual(records, self._records(2, start=3))
+        spool.commit(token)
+        self.assertEqual(spool.read(10)[0], [])
+        self.assertEqual(spool.pending(), 0)
+
+    def test_max_bytes(self):
+        spool = DiskSpool(self.directory)
+        spool.append(self._records(5))
+        record_bytes = len(self._records(1)[0]) + 1
+        (records, token) = spool.read(10, max_bytes=record_bytes * 2 + 1)
+        self.assertEqual(len(records), 2)
+        # a single record is always returned
+        (records, token) = spool.read(10, max_bytes=1)
+        self.assertEqual(len(records), 1)
+
+    def test_rotation(self):
+        record_bytes = len(self._records(1)[0]) + 1
+        spool = DiskSpool(
+            self.directory, segment_bytes=record_bytes * 10, max_bytes=10000
+        )
+        for idx in range(5):
+            spool.append(self._records(10, start=idx * 10))
+        segments = [f for f in os.listdir(self.directory) if f.endswith(".seg")]
+        self.assertEqual(len(segments), 5)
+
+        # reads span segments, and drained segments are removed
+        read = []
+        while True:
+            (records, token) = spool.read(7)
+            if not records:
+                break
+            read.extend(records)
+            spool.commit(token)
+        self.assertEqual(read, self._records(50))
+        segments = [f for f in os.listdir(self.directory) if f.endswith(".seg")]
+        self.assertEqual(segments, [])
+
+    def test_eviction(self):
+        record_bytes = len(self._records(1)[0]) + 1
+        spool = DiskSpool(
+            self.directory,
+            segment_bytes=record_bytes * 10,
+            max_bytes=record_bytes * 30,
+        )
+        for idx in range(6):
+            spool.append(self._records(10, start=idx * 10))
+        self.assertLessEqual(spool.size, record_bytes * 30)
+        self.assertEqual(spool.evicted_bytes, record_bytes * 30)
+        # the oldest records were evicted
+        self.assertEqual(spool.read(1)[0], self._records(1, start=30))
+
+    def test_replay(self):
+        spool = DiskSpool(self.directory)
+        spool.append(self._records(5))
+        (records, token) = spool.read(2)
+        spool.commit(token)
+        # a record torn by a crash
+        spool._active.write(b"v=1&t=ev")
+        spool.close()
+
+        spool = DiskSpool(self.directory)
+        (records, token) = spool.read(10)
+        self.assertEqual(records, self._records(3, start=2))
+        spool.commit(token)
+        spool.append(self._records(1, start=5))
+        self.assertEqual(spool.read(10)[0], self._records(1, start=5))
+
+    def test_locked(self):
+        spool = DiskSpool(self.directory)
+        self.assertRaises(SpoolLocked, DiskSpool, self.directory)
+        spool.close()
+        DiskSpool(self.directory).close()
+
+    def test_for_process(self):
+        spools = [DiskSpool.for_process(self.directory) for idx in range(2)]
+        self.assertEqual(
+            [s.directory for s in spools],
+            [os.path.join(self.directory, "0"), os.path.join(self.directory, "1")],
+        )
+        # a released subdirectory is reused, and its hits replayed
+        spools[0].append(self._records(1))
+        spools[0].close()
+        spool = DiskSpool.for_process(self.directory)
+        self.assertEqual(spool.directory, os.path.join(self.directory, "0"))
+        self.assertEqual(spool.read(10)[0], self._records(1))
+
+    def test_invalid(self):
+        self.assertRaises(
+            ValueError, DiskSpool, self.directory, segment_bytes=10, max_bytes=10
+        )
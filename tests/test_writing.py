@@ -11,10 +11,17 @@ it stays with a u prefix for Python3
 note that we strings are still prefixed with `u` for Python2
 """
 # stdlib
+from decimal import Decimal
+import json
 import os
 import re
 import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 # local package to test
 import g_analytics_writer
 from g_analytics_writer import AnalyticsWriter
@@ -1582,3 +1589,1090 @@ class TestSetup(unittest.TestCase):
         self.assertTrue(writer.single_push)
         self.assertTrue(writer.force_ssl)
         self.assertFalse(writer.global_custom_data)
+
+
+class TestWriterConfig(unittest.TestCase):
+    def test_shared(self):
+        config = g_analytics_writer.WriterConfig(
+            mode=AnalyticsMode.GTAG,
+            use_comments=False,
+            json_dumps_callable=custom_json_dumps_sorted,
+        )
+        writer_1 = AnalyticsWriter("UA-123123-1", config=config)
+        writer_2 = AnalyticsWriter("UA-123123-1", config=config)
+        self.assertIs(writer_1.config, config)
+        self.assertIs(writer_2.config, config)
+        self.assertEqual(writer_1.mode, AnalyticsMode.GTAG)
+        self.assertFalse(writer_1.use_comments)
+
+        # changing an option on a writer does not alter the shared config
+        writer_1.use_comments = True
+        self.assertTrue(writer_1.use_comments)
+        self.assertIsNot(writer_1.config, config)
+        self.assertFalse(config.use_comments)
+        self.assertFalse(writer_2.use_comments)
+
+    def test_immutable(self):
+        config = g_analytics_writer.WriterConfig()
+        self.assertRaises(AttributeError, setattr, config, "use_comments", False)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, g_analytics_writer.WriterConfig, mode=100)
+        self.assertRaises(
+            ValueError,
+            g_analytics_writer.WriterConfig,
+            gtag_dimensions_strategy=100,
+        )
+        config = g_analytics_writer.WriterConfig()
+        self.assertRaises(ValueError, config.replace, mode=100)
+        writer = AnalyticsWriter("UA-123123-1", config=config)
+        self.assertRaises(ValueError, setattr, writer, "mode", 100)
+
+
+class TestLazy(unittest.TestCase):
+    def test_lazy(self):
+        writer = AnalyticsWriter(
+            "UA-123123-1", json_dumps_callable=custom_json_dumps_sorted
+        )
+        self.assertIsNone(writer._data)
+        self.assertFalse(writer.has_data)
+        self.assertFalse(writer.rendered)
+
+        writer.set_account("UA-123123-2")
+        self.assertIsNone(writer._data)
+        self.assertEqual(writer.account_id, "UA-123123-2")
+
+        writer.track_event({"*category": "Videos", "*action": "Play"})
+        self.assertIsNotNone(writer._data)
+        self.assertTrue(writer.has_data)
+        self.assertEqual(writer.data_struct["*account_id"], "UA-123123-2")
+
+        writer.discard()
+        self.assertIsNone(writer._data)
+        self.assertFalse(writer.has_data)
+        self.assertEqual(writer.account_id, "UA-123123-2")
+
+        writer.render()
+        self.assertTrue(writer.rendered)
+        self.assertIsNone(writer._data)
+
+
+class TestWriterData(unittest.TestCase):
+    def test_data_struct_view(self):
+        writer = AnalyticsWriter(
+            "UA-123123-1", json_dumps_callable=custom_json_dumps_sorted
+        )
+        writer.set_custom_dimension("dimension9", "name", "jonathan")
+        writer.set_user_id("cecil")
+        data_struct = writer.data_struct
+        self.assertEqual(data_struct["*account_id"], "UA-123123-1")
+        self.assertEqual(
+            data_struct["*custom_dimensions"], {"9": ("name", "jonathan", None)}
+        )
+        self.assertIs(data_struct["*custom_dimensions"], writer._data.custom_dimensions)
+        self.assertEqual(data_struct["*user_id"], "cecil")
+        self.assertIn("*tracked_events", data_struct)
+        self.assertEqual(len(dict(data_struct)), 9)
+
+        # writes go to the storage
+        data_struct["*user_id"] = "rose"
+        self.assertEqual(writer._data.user_id, "rose")
+        data_struct["*account_id"] = "UA-123123-2"
+        self.assertEqual(writer.account_id, "UA-123123-2")
+
+        self.assertRaises(KeyError, data_struct.__getitem__, "*unknown")
+        self.assertRaises(KeyError, data_struct.__setitem__, "*unknown", 1)
+        self.assertRaises(TypeError, data_struct.__delitem__, "*user_id")
+
+    def test_data_struct_events(self):
+        # `track_event` style dicts may be added through the view
+        for mode in AnalyticsMode._valid_modes:
+            expected = AnalyticsWriter("UA-123123-1", mode=mode)
+            expected.track_event(data__event_1)
+            writer = AnalyticsWriter("UA-123123-1", mode=mode)
+            tracked_events = writer.data_struct["*tracked_events"]
+            writer.render()
+            tracked_events.append(dict(data__event_1))
+            self.assertEqual(writer.render(), expected.render())
+
+            writer = AnalyticsWriter("UA-123123-1", mode=mode)
+            writer.data_struct["*tracked_events"] = [dict(data__event_1)]
+            self.assertEqual(writer.render(), expected.render())
+
+    def test_data_struct_transaction(self):
+        # transactions altered in place through the view are validated again
+        writer = AnalyticsWriter("UA-123123-1", mode=AnalyticsMode.GA_JS)
+        writer.add_transaction(data__transaction_dict_2)
+        self.assertIn("invalid transaction", writer.render())
+        transaction = writer.data_struct["*transaction"]
+        transaction["1234"]["*total"] = "115.00"
+        as_html = writer.render()
+        self.assertNotIn("invalid transaction", as_html)
+        self.assertIn("_addTrans", as_html)
+
+        expected = AnalyticsWriter("UA-123123-1", mode=AnalyticsMode.GA_JS)
+        expected.add_transaction(dict(data__transaction_dict_2, **{"*total": "115.00"}))
+        self.assertEqual(as_html, expected.render())
+
+    def test_slots(self):
+        data = g_analytics_writer.WriterData()
+        self.assertRaises(AttributeError, setattr, data, "unknown", 1)
+
+
+class TestEvent(unittest.TestCase):
+    def test_from_dict(self):
+        event = g_analytics_writer.Event.from_dict(data__event_4__ANALYTICS_hit)
+        self.assertEqual(event.category, "category")
+        self.assertEqual(event.action, "action")
+        self.assertIsNone(event.label)
+        self.assertEqual(event.extra, {"metric18": 8000})
+        self.assertTrue(event.has_action)
+        self.assertTrue(event.has_category_action)
+        self.assertEqual(event.as_dict(), data__event_4__ANALYTICS_hit)
+        self.assertEqual(event.get("*category"), "category")
+        self.assertEqual(event.get("metric18"), 8000)
+        self.assertIsNone(event.get("*label"))
+
+    def test_mapping(self):
+        event = g_analytics_writer.Event.from_dict(data__event_4__ANALYTICS_hit)
+        self.assertEqual(event["*category"], "category")
+        self.assertEqual(event["metric18"], 8000)
+        self.assertRaises(KeyError, lambda: event["*label"])
+        self.assertNotIn("*label", event)
+        self.assertEqual(sorted(event.keys()), sorted(data__event_4__ANALYTICS_hit))
+        self.assertEqual(len(event), len(data__event_4__ANALYTICS_hit))
+        self.assertEqual(dict(event), data__event_4__ANALYTICS_hit)
+        self.assertEqual(event, data__event_4__ANALYTICS_hit)
+        self.assertEqual(data__event_4__ANALYTICS_hit, event)
+        self.assertFalse(hasattr(event, "__dict__"))
+
+        writer = AnalyticsWriter("UA-123123-1")
+        writer.track_event(data__event_4__ANALYTICS_hit)
+        self.assertEqual(
+            writer.data_struct["*tracked_events"][0]["*category"], "category"
+        )
+
+    def test_validation(self):
+        event = g_analytics_writer.Event(action="Play")
+        self.assertTrue(event.has_action)
+        self.assertFalse(event.has_category_action)
+        event = g_analytics_writer.Event(category="Videos")
+        self.assertFalse(event.has_action)
+        self.assertFalse(event.has_category_action)
+
+    def test_api_dict(self):
+        event = g_analytics_writer.Event.from_dict(data__event_1)
+        self.assertEqual(
+            event.api_dict(AnalyticsMode.GTAG),
+            {
+                "event_category": "Videos",
+                "event_label": "action",
+                "value": 47,
+                "non_interaction": True,
+            },
+        )
+        self.assertIs(
+            event.api_dict(AnalyticsMode.GTAG), event.api_dict(AnalyticsMode.GTAG)
+        )
+
+    def test_track(self):
+        for mode in (AnalyticsMode.GA_JS, AnalyticsMode.ANALYTICS, AnalyticsMode.GTAG):
+            writer_dict = AnalyticsWriter(
+                "UA-123123-1", mode=mode, json_dumps_callable=custom_json_dumps_sorted
+            )
+            writer_event = AnalyticsWriter(
+                "UA-123123-1", mode=mode, json_dumps_callable=custom_json_dumps_sorted
+            )
+            for event in (data__event_1, data__event_2, {"*category": "Videos"}):
+                writer_dict.track_event(event)
+                writer_event.track_event(g_analytics_writer.Event.from_dict(event))
+            self.assertEqual(writer_dict.render(), writer_event.render())
+            self.assertIsInstance(
+                writer_dict.data_struct["*tracked_events"][0], g_analytics_writer.Event
+            )
+
+
+class TestRenderPlan(unittest.TestCase):
+    def test_shared(self):
+        writer_1 = AnalyticsWriter(
+            "UA-123123-1", json_dumps_callable=custom_json_dumps_sorted
+        )
+        writer_2 = AnalyticsWriter(
+            "UA-123123-1", json_dumps_callable=custom_json_dumps_sorted
+        )
+        plan_1 = writer_1._get_render_plan(AnalyticsMode.ANALYTICS)
+        plan_2 = writer_2._get_render_plan(AnalyticsMode.ANALYTICS)
+        self.assertIs(plan_1, plan_2)
+
+        # a different configuration gets a different plan
+        writer_2.use_comments = False
+        plan_3 = writer_2._get_render_plan(AnalyticsMode.ANALYTICS)
+        self.assertIsNot(plan_1, plan_3)
+
+    def test_empty_html(self):
+        writer = AnalyticsWriter(
+            "UA-123123-1", mode=AnalyticsMode.GTAG, use_comments=False
+        )
+        plan = writer._get_render_plan(AnalyticsMode.GTAG)
+        as_html = writer.render()
+        self.assertEqual(plan.empty_html, as_html)
+        self.assertIs(writer.render(), as_html)
+
+        # recording data bypasses the cached render
+        writer.set_user_id("cecil")
+        as_html_user = writer.render()
+        self.assertNotEqual(as_html_user, as_html)
+        self.assertEqual(plan.empty_html, as_html)
+
+
+class TestSecondaryAccounts(unittest.TestCase):
+    def _make_writer(self, mode, json_dumps_callable, additional_accounts):
+        writer = AnalyticsWriter(
+            "UA-123123-1", mode=mode, json_dumps_callable=json_dumps_callable
+        )
+        for account_id in additional_accounts:
+            writer.set_account_additional__add(account_id)
+        writer.set_custom_dimension(1, "section", "account")
+        writer.set_user_id("cecil")
+        writer.track_event(data__event_1)
+        writer.track_event({"*category": "Videos", "*non_interaction": True})
+        return writer
+
+    def test_payload_shared(self):
+        calls = []
+
+        def _json_dumps(obj):
+            calls.append(obj)
+            return custom_json_dumps_sorted(obj)
+
+        for mode in (AnalyticsMode.GA_JS, AnalyticsMode.ANALYTICS):
+            counts = []
+            for additional_accounts in ((), ("UA-123123-2", "UA-123123-3")):
+                writer = self._make_writer(mode, _json_dumps, additional_accounts)
+                del calls[:]
+                writer.render()
+                counts.append(len(calls))
+            # serializing the payload does not scale with the accounts
+            self.assertEqual(counts[0], counts[1])
+
+    def test_tracker_prefix(self):
+        for mode in (AnalyticsMode.GA_JS, AnalyticsMode.ANALYTICS):
+            writer = self._make_writer(
+                mode, custom_json_dumps_sorted, ("UA-123123-2", "UA-123123-3")
+            )
+            as_html = writer.render()
+            lines = as_html.split("\n")
+            for prefix in ("", "trkr0.", "trkr1."):
+                if mode == AnalyticsMode.GA_JS:
+                    self.assertIn(
+                        u"""_gaq.push(['%s_setCustomVar',1,'section','account']);"""
+                        % prefix,
+                        lines,
+                    )
+                    self.assertIn(u"""_gaq.push(['%s_trackPageview']);""" % prefix, lines)
+                else:
+                    self.assertIn(
+                        u"""ga('%sset',{"dimension1":"account"});""" % prefix,
+                        lines,
+                    )
+                    self.assertIn(
+                        u"""/* ga('%ssend': incompatible event */""" % prefix, lines
+                    )
+            if mode == AnalyticsMode.ANALYTICS:
+                self.assertIn(
+                    u"""ga('create','UA-123123-3','auto','trkr1',{"userId":"cecil"});""",
+                    lines,
+                )
+
+
+class TestStreaming(unittest.TestCase):
+    def _make_writers(self):
+        for mode in (
+            AnalyticsMode.GA_JS,
+            AnalyticsMode.ANALYTICS,
+            AnalyticsMode.GTAG,
+            AnalyticsMode.AMP,
+        ):
+            for single_push in (False, True):
+                writer = AnalyticsWriter(
+                    "UA-123123-1",
+                    mode=mode,
+                    single_push=single_push,
+                    json_dumps_callable=custom_json_dumps_sorted,
+                )
+                yield writer
+                writer = AnalyticsWriter(
+                    "UA-123123-1",
+                    mode=mode,
+                    single_push=single_push,
+                    json_dumps_callable=custom_json_dumps_sorted,
+                )
+                writer.set_account_additional__add("UA-123123-2")
+                writer.set_custom_dimension(1, "section", "account")
+                writer.track_event(data__event_1)
+                writer.add_transaction(data__transaction_dict_1)
+                writer.add_transaction_item(data__transaction_item_dict)
+                yield writer
+
+    def test_iter_render(self):
+        for writer in self._make_writers():
+            fragments = list(writer.iter_render())
+            self.assertTrue(writer.rendered)
+            self.assertEqual(u"".join(fragments), writer.render())
+            if writer.has_data:
+                self.assertTrue(len(fragments) > 1)
+
+    def test_render_to(self):
+        for writer in self._make_writers():
+            stream = StringIO()
+            writer.render_to(stream)
+            self.assertEqual(stream.getvalue(), writer.render())
+
+    def test_invalid_mode(self):
+        writer = AnalyticsWriter("UA-123123-1")
+        self.assertRaises(ValueError, writer.iter_render, mode=99)
+        self.assertFalse(writer.rendered)
+
+
+class TestJsonEncoder(unittest.TestCase):
+    def test_get_json_encoder(self):
+        self.assertIs(
+            g_analytics_writer.get_json_encoder("stdlib"), g_analytics_writer.json_dumps
+        )
+        self.assertIn(
+            g_analytics_writer.get_json_encoder("auto"),
+            g_analytics_writer.JSON_ENCODERS.values(),
+        )
+        self.assertRaises(ValueError, g_analytics_writer.get_json_encoder, "invalid")
+
+    def test_orjson(self):
+        if "orjson" not in g_analytics_writer.JSON_ENCODERS:
+            raise unittest.SkipTest("`orjson` is not installed")
+        json_dumps__orjson = g_analytics_writer.get_json_encoder("orjson")
+        self.assertIs(g_analytics_writer.get_json_encoder("auto"), json_dumps__orjson)
+        for mode in (AnalyticsMode.ANALYTICS, AnalyticsMode.GTAG, AnalyticsMode.AMP):
+            renders = []
+            for json_dumps_callable in (
+                g_analytics_writer.json_dumps,
+                json_dumps__orjson,
+            ):
+                writer = AnalyticsWriter(
+                    "UA-123123-1", mode=mode, json_dumps_callable=json_dumps_callable
+                )
+                writer.set_custom_dimension(1, "section", "account")
+                writer.set_user_id("cecil")
+                writer.track_event(data__event_1)
+                renders.append(writer.render())
+            # the backends are interchangeable for ascii data
+            self.assertEqual(renders[0], renders[1])
+
+    def test_orjson_parity(self):
+        if "orjson" not in g_analytics_writer.JSON_ENCODERS:
+            raise unittest.SkipTest("`orjson` is not installed")
+        json_dumps__orjson = g_analytics_writer.get_json_encoder("orjson")
+        for data in (
+            # keys which are not strings
+            {1: "a", None: "b"},
+            {"nested": {2: [1, 2]}},
+            # integers larger than 64 bits fall back to the stdlib
+            {"value": 2 ** 70},
+            [-(2 ** 64), 1],
+        ):
+            self.assertEqual(
+                json_dumps__orjson(data), g_analytics_writer.json_dumps(data)
+            )
+
+    def test_render_bytes(self):
+        writer = AnalyticsWriter(
+            "UA-123123-1",
+            mode=AnalyticsMode.GTAG,
+            json_dumps_callable=custom_json_dumps_sorted,
+        )
+        writer.add_transaction(data__transaction_dict_1)
+        writer.add_transaction_item(data__transaction_item_dict)
+        as_bytes = writer.render_bytes()
+        self.assertIsInstance(as_bytes, bytes)
+        self.assertEqual(as_bytes, writer.render().encode("utf-8"))
+        self.assertEqual(b"".join(writer.iter_render_bytes()), as_bytes)
+
+
+class TestTranslationTables(unittest.TestCase):
+    def test_compiled(self):
+        tables = g_analytics_writer.translation_tables
+        for (api_concept, local_keys) in g_analytics_writer.translation_matrix.items():
+            for (local_key, api_modes) in local_keys.items():
+                for (api_mode, api_key) in api_modes.items():
+                    table = tables[(api_concept, api_mode)]
+                    if api_key is None:
+                        self.assertNotIn(local_key, table)
+                    else:
+                        self.assertEqual(table[local_key], api_key)
+
+    def test_source_dict_to_api_dict(self):
+        source_dict = {
+            "*transaction_id": 1234,
+            "*sku": "DD44",
+            "*name": "T-Shirt",
+            "*unknown": "unknown",
+        }
+        self.assertEqual(
+            g_analytics_writer.source_dict_to_api_dict(
+                source_dict, "*transaction_item", AnalyticsMode.GTAG
+            ),
+            {"id": "DD44", "name": "T-Shirt"},
+        )
+        self.assertEqual(
+            g_analytics_writer.source_dict_to_api_dict(
+                source_dict, "*transaction_item", AnalyticsMode.ANALYTICS
+            ),
+            {"id": 1234, "sku": "DD44", "name": "T-Shirt"},
+        )
+        self.assertEqual(
+            g_analytics_writer.source_dict_to_api_dict(
+                source_dict, "*unknown", AnalyticsMode.GTAG
+            ),
+            {},
+        )
+
+
+class TestFieldValidators(unittest.TestCase):
+    def test_source_dict_api_modes(self):
+        self.assertEqual(
+            g_analytics_writer.source_dict_api_modes(
+                data__transaction_dict_1, "*transaction"
+            ),
+            frozenset(
+                (AnalyticsMode.GA_JS, AnalyticsMode.ANALYTICS, AnalyticsMode.GTAG)
+            ),
+        )
+        self.assertEqual(
+            g_analytics_writer.source_dict_api_modes(
+                {"*id": 1234, "*total": None}, "*transaction"
+            ),
+            frozenset((AnalyticsMode.ANALYTICS, AnalyticsMode.GTAG)),
+        )
+        self.assertEqual(
+            g_analytics_writer.source_dict_api_modes(
+                {"*transaction_id": 1234}, "*transaction_item"
+            ),
+            frozenset(),
+        )
+
+    def test_cached(self):
+        writer = AnalyticsWriter(
+            "UA-123123-1", json_dumps_callable=custom_json_dumps_sorted
+        )
+        writer.add_transaction(data__transaction_dict_1)
+        writer.add_transaction_item(data__transaction_item_dict)
+        writer.render(mode=AnalyticsMode.GA_JS)
+        data = writer._data
+        transaction_modes = data.transaction_api_modes("1234")
+        item_modes = data.transaction_item_api_modes("1234")
+        self.assertEqual(len(item_modes), 1)
+        writer.render(mode=AnalyticsMode.GTAG)
+        self.assertIs(data.transaction_api_modes("1234"), transaction_modes)
+        self.assertIs(data.transaction_item_api_modes("1234")[0], item_modes[0])
+
+        # new items are validated as they are needed
+        writer.add_transaction_item({"*transaction_id": 1234, "*sku": "DD44"})
+        self.assertEqual(len(data.transaction_item_api_modes("1234")), 2)
+        self.assertIn("/* invalid transaction item */", writer.render())
+
+        # replacing a transaction resets its validation
+        writer.add_transaction({"*id": 1234})
+        self.assertNotIn(
+            AnalyticsMode.GA_JS, data.transaction_api_modes("1234")
+        )
+
+
+class TestOrderedArgs(unittest.TestCase):
+    def test_encode_ordered_args(self):
+        records = [
+            {"*a": "a", "*b": 1, "*c": 1.5, "*d": True},
+            {"*a": None, "*b": 2, "*c": None, "*d": None},
+            {"*d": False},
+            {},
+        ]
+        order = ("*a", "*b", "*c", "*d")
+        self.assertEqual(
+            g_analytics_writer.encode_ordered_args(records, order),
+            [
+                ["'a'", "1", "1.5", "true"],
+                ["undefined", "2", "undefined", "undefined"],
+                ["undefined", "undefined", "undefined", "false"],
+                ["undefined", "undefined", "undefined", "undefined"],
+            ],
+        )
+        self.assertEqual(
+            g_analytics_writer.encode_ordered_args(
+                records, order, remove_undefined=True
+            ),
+            [
+                ["'a'", "1", "1.5", "true"],
+                ["undefined", "2"],
+                ["undefined", "undefined", "undefined", "false"],
+                [],
+            ],
+        )
+        self.assertEqual(
+            g_analytics_writer.source_dict_to_ordered_args(
+                records[1], order, remove_undefined=True
+            ),
+            ["undefined", "2"],
+        )
+
+    def test_event_label_only(self):
+        event = {"*category": "Videos", "*action": "Play", "*label": "action"}
+        writer = AnalyticsWriter("UA-123123-1", mode=AnalyticsMode.ANALYTICS)
+        writer.track_event(event)
+        self.assertIn(u"""ga('send','event','Videos','Play','action');""", writer.render())
+        writer = AnalyticsWriter("UA-123123-1", mode=AnalyticsMode.GA_JS)
+        writer.track_event(event)
+        self.assertIn(
+            u"""_gaq.push(['_trackEvent','Videos','Play','action']);""", writer.render()
+        )
+
+
+class _WriterFactory(object):
+    """
+    builds the writers of the tests below.
+
+    `_make_writer` records a custom dimension, `_writer_event` and, if
+    `_writer_transaction`, a transaction with one item. `kwargs` and
+    `_writer_kwargs()` are passed to the `AnalyticsWriter`.
+    """
+
+    _writer_event = data__event_1
+    _writer_transaction = True
+
+    def _writer_kwargs(self):
+        return {}
+
+    def _new_writer(self, **kwargs):
+        kwargs.setdefault("json_dumps_callable", custom_json_dumps_sorted)
+        kwargs.update(self._writer_kwargs())
+        return AnalyticsWriter("UA-123123-1", **kwargs)
+
+    def _make_writer(self, mode=AnalyticsMode.ANALYTICS, event=None, **kwargs):
+        writer = self._new_writer(mode=mode, **kwargs)
+        writer.set_custom_dimension(1, "section", "landing")
+        event = event or self._writer_event
+        if event is not None:
+            writer.track_event(event)
+        if self._writer_transaction:
+            writer.add_transaction(data__transaction_dict_2)
+            writer.add_transaction_item(data__transaction_item_dict)
+        return writer
+
+
+class TestRenderCache(_WriterFactory, unittest.TestCase):
+    _writer_transaction = False
+
+    def test_hit(self):
+        cache = g_analytics_writer.RenderCache()
+        as_html = self._make_writer(render_cache=cache).render()
+        self.assertEqual(as_html, self._make_writer().render())
+        self.assertIs(self._make_writer(render_cache=cache).render(), as_html)
+        self.assertEqual(
+            u"".join(self._make_writer(render_cache=cache).iter_render()), as_html
+        )
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+        # different data is a miss
+        event = dict(data__event_1)
+        event["*non_interaction"] = 1
+        as_html_2 = self._make_writer(render_cache=cache, event=event).render()
+        self.assertNotEqual(as_html, as_html_2)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_fingerprint_numbers(self):
+        # equal numbers which render differently are kept apart
+        fingerprint = g_analytics_writer.fingerprint
+        values = (10, 10.0, True, Decimal("10.00"), Decimal("10"), "10")
+        fingerprints = set(fingerprint({"*value": v}) for v in values)
+        self.assertEqual(len(fingerprints), len(values))
+        self.assertEqual(
+            fingerprint({"*value": Decimal("10.00")}),
+            fingerprint({"*value": Decimal("10.00")}),
+        )
+
+    def test_unhashable(self):
+        cache = g_analytics_writer.RenderCache()
+        writer = self._make_writer(render_cache=cache)
+        # the transaction is unhashable, due to the unused `set`
+        transaction = dict(data__transaction_dict_2)
+        transaction["*unused"] = set()
+        writer.add_transaction(transaction)
+        writer.render()
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_eviction(self):
+        cache = g_analytics_writer.RenderCache(max_size=2)
+        for idx in range(3):
+            cache.set(idx, u"%s" % idx)
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(2), u"2")
+        stats = cache.stats()
+        self.assertEqual((stats["size"], stats["evictions"]), (2, 1))
+
+    def test_expiration(self):
+        cache = g_analytics_writer.RenderCache(ttl=-1)
+        cache.set("key", u"rendered")
+        self.assertIsNone(cache.get("key"))
+        stats = cache.stats()
+        self.assertEqual((stats["size"], stats["expirations"]), (0, 1))
+
+    def test_config(self):
+        config = g_analytics_writer.WriterConfig(render_cache=True)
+        self.assertIs(config.render_cache, g_analytics_writer.default_render_cache)
+        self.assertIsNone(g_analytics_writer.WriterConfig().render_cache)
+        self.assertRaises(
+            ValueError, g_analytics_writer.WriterConfig, render_cache="invalid"
+        )
+
+
+class TestIncremental(_WriterFactory, unittest.TestCase):
+    _writer_event = None
+
+    def _populate(self, writer, render=False):
+        for step in (
+            lambda: writer.track_event(data__event_1),
+            lambda: writer.set_user_id("cecil"),
+            lambda: writer.set_custom_metric(1, "metric1", 10),
+            lambda: writer.set_account_additional__add("UA-123123-2"),
+            lambda: writer.track_event(data__event_2),
+            lambda: writer.add_transaction_item(data__transaction_item_dict),
+            lambda: writer.set_crossdomain_tracking(["example.com"]),
+        ):
+            step()
+            if render:
+                writer.render()
+
+    def test_memo(self):
+        calls = []
+
+        def _json_dumps(obj):
+            calls.append(obj)
+            return custom_json_dumps_sorted(obj)
+
+        for mode in AnalyticsMode._valid_modes:
+            writer = self._make_writer(mode, json_dumps_callable=_json_dumps)
+            writer.track_event(data__event_1)
+            as_html = writer.render()
+            del calls[:]
+            self.assertIs(writer.render(), as_html)
+            self.assertEqual(u"".join(writer.iter_render()), as_html)
+            self.assertEqual(calls, [])
+
+    def test_caller_dicts(self):
+        transaction = dict(data__transaction_dict_2)
+        item = dict(data__transaction_item_dict)
+        for mode in AnalyticsMode._valid_modes:
+            writer = AnalyticsWriter("UA-123123-1", mode=mode)
+            writer.add_transaction(transaction)
+            writer.add_transaction_item(item)
+            as_html = writer.render()
+            # the writer keeps its own copies
+            transaction["*revenue"] = "1.00"
+            item["*name"] = "Socks"
+            self.assertEqual(writer.render(), as_html)
+            self.assertEqual(u"".join(writer.iter_render()), as_html)
+            transaction["*revenue"] = data__transaction_dict_2["*revenue"]
+            item["*name"] = data__transaction_item_dict["*name"]
+
+    def test_streaming(self):
+        writer = self._make_writer(AnalyticsMode.ANALYTICS)
+        writer.track_event(data__event_1)
+        as_html = u"".join(writer.iter_render())
+        # only full renders are kept
+        self.assertIsNone(writer._renders)
+        self.assertEqual(writer.render(), as_html)
+        self.assertIsNotNone(writer._renders)
+
+    def test_equivalent(self):
+        for mode in AnalyticsMode._valid_modes:
+            writer = self._make_writer(mode)
+            writer.render()
+            self._populate(writer, render=True)
+            writer.render(mode=AnalyticsMode.GA_JS)
+
+            expected = self._make_writer(mode)
+            self._populate(expected)
+            self.assertEqual(writer.render(), expected.render())
+
+    def test_data_struct(self):
+        writer = self._make_writer(AnalyticsMode.GA_JS)
+        as_html = writer.render()
+        writer.data_struct["*tracked_events"].append(
+            g_analytics_writer.Event.from_dict(data__event_1)
+        )
+        as_html_2 = writer.render()
+        self.assertNotEqual(as_html, as_html_2)
+        self.assertIn("_trackEvent", as_html_2)
+
+    def test_discard(self):
+        writer = self._make_writer(AnalyticsMode.GA_JS)
+        writer.render()
+        writer.discard()
+        expected = AnalyticsWriter("UA-123123-1", mode=AnalyticsMode.GA_JS)
+        self.assertEqual(writer.render(), expected.render())
+
+
+class TestRenderMany(_WriterFactory, unittest.TestCase):
+    def test_render_many(self):
+        modes = (AnalyticsMode.ANALYTICS, AnalyticsMode.AMP, AnalyticsMode.AMP)
+        renders = self._make_writer().render_many(modes=modes)
+        self.assertEqual(
+            list(renders.keys()), [AnalyticsMode.ANALYTICS, AnalyticsMode.AMP]
+        )
+        for mode in renders:
+            self.assertEqual(renders[mode], self._make_writer().render(mode=mode))
+
+        renders = self._make_writer().render_many()
+        self.assertEqual(tuple(renders.keys()), AnalyticsMode._valid_modes)
+
+        # writers without data
+        writer = AnalyticsWriter("UA-123123-1")
+        renders = writer.render_many()
+        self.assertEqual(
+            renders[AnalyticsMode.GTAG], writer.render(mode=AnalyticsMode.GTAG)
+        )
+
+    def test_invalid_mode(self):
+        writer = self._make_writer()
+        self.assertRaises(
+            ValueError, writer.render_many, modes=(AnalyticsMode.GA_JS, 100)
+        )
+        self.assertFalse(writer.rendered)
+
+    def test_render_cache(self):
+        cache = g_analytics_writer.RenderCache()
+        renders = self._make_writer(render_cache=cache).render_many()
+        self.assertEqual(cache.stats()["misses"], len(renders))
+        self.assertEqual(self._make_writer(render_cache=cache).render_many(), renders)
+        self.assertEqual(cache.stats()["hits"], len(renders))
+
+
+class TestInstrumentation(_WriterFactory, unittest.TestCase):
+    def setUp(self):
+        self.reports = []
+
+    def _writer_kwargs(self):
+        return {"instrumentation": self.reports.append}
+
+    def test_report(self):
+        writer = self._make_writer()
+        rendered = writer.render()
+        self.assertEqual(rendered, self._make_writer().render())
+        report = self.reports[0]
+        self.assertEqual(report["mode"], AnalyticsMode.ANALYTICS)
+        self.assertEqual(report["account_id"], "UA-123123-1")
+        self.assertFalse(report["cached"])
+        self.assertEqual(report["bytes"], len(rendered.encode("utf-8")))
+        self.assertEqual(report["lines"], len(rendered.split("\n")))
+        self.assertEqual(report["invalid"], 0)
+        self.assertEqual(
+            report["records"],
+            {
+                "accounts": 1,
+                "dimensions": 1,
+                "metrics": 0,
+                "events": 1,
+                "transactions": 1,
+                "items": 1,
+            },
+        )
+        self.assertEqual(
+            set(report["sections"].keys()),
+            set(("bootstrap", "dimensions", "transactions", "items", "events")),
+        )
+        self.assertGreaterEqual(report["duration"], sum(report["sections"].values()))
+
+        # an unchanged writer reuses its render
+        writer.render()
+        self.assertTrue(self.reports[-1]["cached"])
+        self.assertEqual(self.reports[-1]["sections"], {})
+
+    def test_sections(self):
+        for mode in (AnalyticsMode.GA_JS, AnalyticsMode.GTAG):
+            del self.reports[:]
+            self._make_writer(mode=mode).render()
+            self.assertIn("events", self.reports[0]["sections"])
+            self.assertIn("transactions", self.reports[0]["sections"])
+
+    def test_sections_items(self):
+        # the cost of a large cart is charged to `items`, not to the
+        # transaction or to the per-account bootstrap
+        for mode in (AnalyticsMode.ANALYTICS, AnalyticsMode.GTAG):
+            for additional_account in (False, True):
+                del self.reports[:]
+                writer = self._make_writer(mode=mode)
+                if additional_account:
+                    writer.set_account_additional__add("UA-123123-2")
+                item = dict(data__transaction_item_dict, **{"*transaction_id": 1234})
+                writer.add_transaction_items([item] * 3000)
+                writer.render()
+                sections = self.reports[0]["sections"]
+                self.assertGreater(sections["items"], sections["transactions"])
+                self.assertGreater(sections["items"], sections["bootstrap"])
+
+    def test_invalid(self):
+        # `data__transaction_dict_2` is not valid for `ga.js`
+        writer = self._make_writer(mode=AnalyticsMode.GA_JS)
+        writer.render()
+        self.assertEqual(self.reports[0]["invalid"], 1)
+
+    def test_render_many(self):
+        cache = g_analytics_writer.RenderCache()
+        renders = self._make_writer(render_cache=cache).render_many()
+        self.assertEqual(
+            [r["mode"] for r in self.reports], list(AnalyticsMode._valid_modes)
+        )
+        del self.reports[:]
+        self.assertEqual(self._make_writer(render_cache=cache).render_many(), renders)
+        self.assertTrue(all(r["cached"] for r in self.reports))
+
+    def test_errors(self):
+        def instrumentation(report):
+            raise ValueError("broken exporter")
+
+        writer = AnalyticsWriter("UA-123123-1", instrumentation=instrumentation)
+        self.assertEqual(writer.render(), AnalyticsWriter("UA-123123-1").render())
+
+    def test_invalid_config(self):
+        self.assertRaises(
+            ValueError, g_analytics_writer.WriterConfig, instrumentation="statsd"
+        )
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = g_analytics_writer.MetricsRegistry()
+        self.config = g_analytics_writer.WriterConfig(
+            mode=AnalyticsMode.GA_JS, metrics=self.metrics
+        )
+
+    def test_counters(self):
+        writer = AnalyticsWriter("UA-123123-1", config=self.config)
+        writer.track_event(data__event_1)
+        writer.add_transaction(data__transaction_dict_2)
+        writer.add_transaction_item(data__transaction_item_dict)
+        writer.render()
+        writer.render(mode=AnalyticsMode.ANALYTICS)
+        # only writers which were not rendered are counted as discarded
+        writer.discard()
+        AnalyticsWriter("UA-123123-1", config=self.config).discard()
+
+        counters = self.metrics.collect()["counters"]
+        GA_JS = AnalyticsMode.GA_JS
+        self.assertEqual(counters["writers_created"], {GA_JS: 2})
+        self.assertEqual(counters["writers_rendered"], {GA_JS: 1})
+        self.assertEqual(counters["writers_discarded"], {GA_JS: 1})
+        self.assertEqual(counters["events_recorded"], {GA_JS: 1})
+        self.assertEqual(counters["transactions_recorded"], {GA_JS: 1})
+        self.assertEqual(counters["items_recorded"], {GA_JS: 1})
+        self.assertEqual(counters["renders"], {GA_JS: 1, AnalyticsMode.ANALYTICS: 1})
+        # `data__transaction_dict_2` is not valid for `ga.js`
+        self.assertEqual(counters["invalid_tags"], {GA_JS: 1})
+
+    def test_histogram(self):
+        metrics = g_analytics_writer.MetricsRegistry(buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            metrics.observe("render_seconds", value, AnalyticsMode.GTAG)
+        histogram = metrics.collect()["histograms"]["render_seconds"][
+            AnalyticsMode.GTAG
+        ]
+        self.assertEqual(histogram["buckets"], [(0.1, 1), (1, 2), (float("inf"), 3)])
+        self.assertEqual(histogram["count"], 3)
+        self.assertAlmostEqual(histogram["sum"], 5.55)
+
+        text = metrics.render_prometheus()
+        self.assertIn("# TYPE g_analytics_writer_render_seconds histogram\n", text)
+        self.assertIn(
+            'g_analytics_writer_render_seconds_bucket{mode="gtag",le="+Inf"} 3\n',
+            text,
+        )
+        metrics.reset()
+        self.assertEqual(metrics.collect(), {"counters": {}, "histograms": {}})
+
+    def test_instrumentation(self):
+        reports = []
+        config = self.config.replace(instrumentation=reports.append)
+        self.assertIs(self.config.instrumentation, self.metrics)
+        AnalyticsWriter("UA-123123-1", config=config).render()
+        self.assertEqual(len(reports), 1)
+        self.assertNotIn("renders", self.metrics.collect()["counters"])
+        # the default `instrumentation` follows `metrics`
+        self.assertIsNone(self.config.replace(metrics=None).instrumentation)
+
+    def test_default(self):
+        config = g_analytics_writer.WriterConfig(metrics=True)
+        self.assertIs(config.metrics, g_analytics_writer.default_metrics)
+        self.assertRaises(ValueError, g_analytics_writer.WriterConfig, metrics=1)
+
+
+class TestGtagPurchaseSplit(_WriterFactory, unittest.TestCase):
+    def _make_purchase(self, count):
+        writer = self._new_writer(mode=AnalyticsMode.GTAG)
+        writer.add_transaction(dict(data__transaction_dict_2))
+        for idx in range(count):
+            item = dict(data__transaction_item_dict)
+            item["*sku"] = "SKU-%04d" % idx
+            item["*name"] = "Product %s" % ("x" * (idx % 50))
+            writer.add_transaction_item(item)
+        return writer
+
+    def _purchases(self, writer):
+        return [
+            line
+            for line in writer.render().split("\n")
+            if line.startswith("gtag('event', 'purchase'")
+        ]
+
+    def test_small(self):
+        self.assertEqual(len(self._purchases(self._make_purchase(3))), 1)
+
+    def test_split(self):
+        purchases = self._purchases(self._make_purchase(300))
+        self.assertGreater(len(purchases), 1)
+        skus = []
+        for (idx, line) in enumerate(purchases):
+            self.assertLessEqual(
+                len(line.encode("utf-8")), g_analytics_writer.GTAG_PURCHASE_MAX_BYTES
+            )
+            payload = json.loads(line[len("gtag('event', 'purchase', ") :])
+            self.assertEqual(payload["transaction_id"], "1234")
+            # only the first call carries the revenue
+            self.assertEqual("value" in payload, idx == 0)
+            skus.extend(item["id"] for item in payload["items"])
+        self.assertEqual(sorted(skus), ["SKU-%04d" % idx for idx in range(300)])
+
+    def test_pack_by_size(self):
+        self.assertEqual(
+            g_analytics_writer._pack_by_size([6, 5, 4, 3, 2], 10),
+            [[0, 2], [1, 3, 4]],
+        )
+        # oversized items get their own bin
+        self.assertEqual(g_analytics_writer._pack_by_size([20, 1], 10), [[0], [1]])
+
+
+class TestBulk(_WriterFactory, unittest.TestCase):
+    def test_track_events(self):
+        writer = self._new_writer()
+        writer.track_events(e for e in (data__event_1, data__event_2))
+        expected = self._new_writer()
+        expected.track_event(data__event_1)
+        expected.track_event(data__event_2)
+        self.assertEqual(writer.render(), expected.render())
+        self.assertEqual(len(writer.data_struct["*tracked_events"]), 2)
+
+    def test_add_transaction_items(self):
+        writer = self._new_writer()
+        writer.add_transaction(dict(data__transaction_dict_2))
+        items = [
+            dict(data__transaction_item_dict, **{"*transaction_id": 1234})
+            for i in range(3)
+        ]
+        writer.add_transaction_items(iter(items))
+        expected = self._new_writer()
+        expected.add_transaction(dict(data__transaction_dict_2))
+        for item in items:
+            expected.add_transaction_item(dict(item))
+        self.assertEqual(writer.render(), expected.render())
+        for mode in (AnalyticsMode.GA_JS, AnalyticsMode.GTAG):
+            self.assertEqual(writer.render(mode=mode), expected.render(mode=mode))
+        # the caller's dicts are not altered
+        self.assertEqual(items[0]["*transaction_id"], 1234)
+        self.assertEqual(len(writer.data_struct["*transaction_items"]["1234"]), 3)
+
+        self.assertRaises(
+            ValueError,
+            writer.add_transaction_items,
+            (data__transaction_item_dict, data__transaction_item_dict_bad),
+        )
+        self.assertEqual(len(writer.data_struct["*transaction_items"]["1234"]), 3)
+
+    def test_set_custom_dimensions(self):
+        writer = self._new_writer()
+        writer.set_custom_dimensions(
+            [("dimension1", "section", "landing"), ("dimension2", "author", "jane", 1)]
+        )
+        expected = self._new_writer()
+        expected.set_custom_dimension("dimension1", "section", "landing")
+        expected.set_custom_dimension("dimension2", "author", "jane", 1)
+        self.assertEqual(writer.render(), expected.render())
+        self.assertEqual(
+            writer.data_struct["*custom_dimensions"],
+            expected.data_struct["*custom_dimensions"],
+        )
+
+    def test_empty(self):
+        writer = self._new_writer()
+        writer.track_events(())
+        writer.add_transaction_items(())
+        writer.set_custom_dimensions(())
+        self.assertFalse(writer.has_data)
+
+
+class TestColumnarItems(_WriterFactory, unittest.TestCase):
+    def _make_items(self, columnar_items):
+        writer = self._new_writer(columnar_items=columnar_items)
+        writer.add_transaction(dict(data__transaction_dict_2))
+        writer.add_transaction_item(dict(data__transaction_item_dict))
+        # an item without a `*sku` is invalid for `analytics.js` and `gtag.js`
+        writer.add_transaction_items(
+            [
+                {"*transaction_id": 1234, "*name": "Hat"},
+                {"*transaction_id": 1234, "*name": "Scarf", "*sku": "S1"},
+            ]
+        )
+        return writer
+
+    def test_render(self):
+        writer = self._make_items(True)
+        self.assertIsInstance(
+            writer.data_struct["*transaction_items"]["1234"],
+            g_analytics_writer.ItemColumns,
+        )
+        expected = self._make_items(False)
+        for mode in AnalyticsMode._valid_modes:
+            self.assertEqual(writer.render(mode=mode), expected.render(mode=mode))
+
+    def test_measurement_protocol(self):
+        from g_analytics_writer import measurement_protocol
+
+        self.assertEqual(
+            measurement_protocol.build_hits(self._make_items(True), client_id="1"),
+            measurement_protocol.build_hits(self._make_items(False), client_id="1"),
+        )
+
+    def test_sequence(self):
+        items = g_analytics_writer.ItemColumns(
+            [{"*sku": "A", "*price": None}, {"*name": "B"}]
+        )
+        self.assertEqual(len(items), 2)
+        self.assertEqual(list(items), [{"*sku": "A", "*price": None}, {"*name": "B"}])
+        self.assertEqual(items[-1], {"*name": "B"})
+        self.assertEqual(items[1:], [{"*name": "B"}])
+        self.assertRaises(IndexError, items.__getitem__, 2)
+        items.append({"*sku": "C"})
+        self.assertEqual(items[2], {"*sku": "C"})
+        self.assertEqual(
+            g_analytics_writer.fingerprint(items),
+            g_analytics_writer.fingerprint(g_analytics_writer.ItemColumns(items)),
+        )
+
+    def test_render_cache(self):
+        cache = g_analytics_writer.RenderCache()
+        config = g_analytics_writer.WriterConfig(
+            columnar_items=True, render_cache=cache
+        )
+        renders = []
+        for idx in range(2):
+            writer = AnalyticsWriter("UA-123123-1", config=config)
+            writer.add_transaction(dict(data__transaction_dict_2))
+            writer.add_transaction_item(dict(data__transaction_item_dict))
+            renders.append(writer.render())
+        self.assertEqual(renders[0], renders[1])
+        self.assertEqual(cache.stats()["hits"], 1)